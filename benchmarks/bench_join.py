@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# benchmarks/bench_join.py
+# Probes sent per join as the network grows: every earlier client in
+# CLIENT_LIST (--candidates 0) versus the server's ranked shortlist.
+# Run: python3 benchmarks/bench_join.py --sizes 4 8 16 32 --candidates 4
+
+import os, sys, time, json, argparse, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client_core import Client
+from bench_proxy import free_port, wait_for
+
+
+def join_run(size, candidates, engine):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1',
+                               '--port', str(port), '--engine', engine,
+                               '--candidates', str(candidates), '--proxy-capacity', '0'],
+                              stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    try:
+        time.sleep(0.5)
+        for i in range(size):
+            c = Client('127.0.0.1', port, free_port(), f"c{i}", False)
+            clients.append(c)
+            if i >= 2:
+                wait_for(lambda: getattr(c, 'last_selection', None) is not None)
+            else:
+                wait_for(lambda: c.id is not None)
+            time.sleep(0.05)    # let RTT_REPORTs land before the next join
+        probes = [c.last_selection['probes'] for c in clients[2:]]
+        tail = probes[-max(1, len(probes) // 4):]
+        return {'clients': size, 'candidates': candidates or 'all',
+                'probes_last_join': probes[-1], 'probes_tail_mean': round(sum(tail) / len(tail), 2),
+                'probes_max': max(probes), 'probes_total': sum(probes)}
+    finally:
+        for c in clients:
+            c.stop = True
+            try: c.server_conn.close()
+            except Exception: pass
+        server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--candidates', type=int, default=4)
+    parser.add_argument('--engine', default='threaded')
+    args = parser.parse_args()
+
+    for k in (0, args.candidates):
+        for size in args.sizes:
+            print(json.dumps(join_run(size, k, args.engine)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
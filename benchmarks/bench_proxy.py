@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# benchmarks/bench_proxy.py
+# Messages per second through a proxy: one TCP connection per chat (the old
+# send_chat) versus the pooled, pipelined PeerPool connection.
+# Run: python3 benchmarks/bench_proxy.py --messages 2000
+
+import os, sys, time, json, socket, argparse, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from codec import FrameReader, JSON
+from client_core import Client, send_json
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(cond, timeout=10.0):
+    end = time.time() + timeout
+    while not cond():
+        if time.time() > end:
+            raise TimeoutError
+        time.sleep(0.01)
+
+
+def drain(client):
+    n = 0
+    while not client.chat_queue.empty():
+        client.chat_queue.get_nowait()
+        n += 1
+    return n
+
+
+def per_connection(sender, n):
+    # What send_chat did before pooling: connect, send, wait for the result, close.
+    ip, port = sender.current_proxy['peer']
+    for i in range(n):
+        s = socket.create_connection((ip, port), timeout=2.0)
+        send_json(s, {'type':'FORWARD_TO_SERVER', 'action':'FORWARD_CHAT',
+                      'orig_id': sender.id, 'name': sender.name, 'text': f"m{i}"}, JSON)
+        FrameReader(s).read_msg()
+        s.close()
+
+
+def pooled(sender, n):
+    futs = [sender.send_chat(f"m{i}") for i in range(n)]
+    for f in futs:
+        f.result(10.0)
+
+
+def run(mode, fn, sender, receiver, n):
+    drain(receiver)
+    t0 = time.time()
+    fn(sender, n)
+    acked = time.time() - t0
+    got = 0
+    end = time.time() + 30
+    while got < n and time.time() < end:
+        got += drain(receiver)
+        time.sleep(0.001)
+    delivered = time.time() - t0
+    return {'mode': mode, 'messages': n, 'acked_s': round(acked, 4),
+            'delivered': got, 'delivered_s': round(delivered, 4),
+            'msgs_per_s': round(n / delivered, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--engine', default='threaded')
+    args = parser.parse_args()
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1',
+                               '--port', str(port), '--engine', args.engine],
+                              stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(0.5)
+        proxy = Client('127.0.0.1', port, free_port(), 'proxy', False)
+        wait_for(lambda: proxy.id is not None)
+        sender = Client('127.0.0.1', port, free_port(), 'sender', False)
+        wait_for(lambda: getattr(sender, 'current_proxy', None) is not None)
+
+        results = [run('per_connection', per_connection, sender, proxy, args.messages),
+                   run('pooled', pooled, sender, proxy, args.messages)]
+        for r in results:
+            print(json.dumps(r))
+    finally:
+        server.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# benchmarks/bench_reconnect.py
+# Mass reconnect: joins N clients, restarts the server under them and
+# records, per --interval, how many registrations the new server handled
+# and how much CPU it used until every client is back. One JSON line per
+# run, with admission control off (--admit-rate 0) and on.
+# Run: python3 benchmarks/bench_reconnect.py --clients 200 --admit-rate 50
+
+import os, sys, time, json, socket, argparse, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client_core import Client
+from bench_proxy import free_port, wait_for
+from loadgen import proc_stats
+
+
+def start_server(port, stats_port, args, admit_rate):
+    cmd = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1', '--port', str(port),
+           '--engine', args.engine, '--stats-port', str(stats_port), '--log-level', 'warning',
+           '--admit-rate', str(admit_rate), '--admit-burst', str(args.admit_burst),
+           '--admit-queue', str(args.admit_queue)]
+    server = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for(lambda: counters(stats_port) is not None, 10.0)
+    return server
+
+
+def counters(stats_port):
+    # The server's counters and gauges from its --stats-port text endpoint.
+    try:
+        with socket.create_connection(('127.0.0.1', stats_port), timeout=1.0) as s:
+            s.sendall(b'\n')
+            data = b''
+            while chunk := s.recv(65536):
+                data += chunk
+    except OSError:
+        return None
+    values = {}
+    for line in data.decode().splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] in ('counter', 'gauge'):
+            values[parts[1]] = float(parts[2])
+    return values
+
+
+def run(args, admit_rate):
+    port, stats_port = free_port(), free_port()
+    server = start_server(port, stats_port, args, 0)
+    clients = []
+    try:
+        for i in range(args.clients):
+            c = Client('127.0.0.1', port, free_port(), f"r{i}", False)
+            clients.append(c)
+            time.sleep(1.0 / args.join_rate)
+        wait_for(lambda: all(c.token for c in clients), 60.0)
+        time.sleep(args.settle)
+
+        # the restart: every client loses its connection at the same moment
+        tokens = {id(c): c.token for c in clients}
+        server.kill()
+        server.wait()
+        server = start_server(port, stats_port, args, admit_rate)
+        t0 = time.time()
+        timeline = []
+        last = counters(stats_port) or {}
+        last_cpu = proc_stats(server.pid)
+        while True:
+            time.sleep(args.interval)
+            now = counters(stats_port) or last
+            cpu = proc_stats(server.pid)
+            back = sum(1 for c in clients if c.token != tokens[id(c)])
+            timeline.append({
+                't': round(time.time() - t0, 2),
+                'registered': int(now.get('msg.in.REGISTER', 0) + now.get('msg.in.RESUME', 0)
+                                  - last.get('msg.in.REGISTER', 0) - last.get('msg.in.RESUME', 0)),
+                'rejected': int(now.get('admission.rejected', 0) - last.get('admission.rejected', 0)),
+                'waiting': int(now.get('admission.waiting', 0)),
+                'cpu_pct': round(100.0 * (cpu[0] - last_cpu[0]) / args.interval, 1) if cpu and last_cpu else None,
+                'back': back,
+            })
+            last, last_cpu = now, cpu
+            if back == len(clients) or time.time() - t0 > args.timeout:
+                break
+        elapsed = time.time() - t0
+        rates = [p['registered'] / args.interval for p in timeline]
+        cpus = [p['cpu_pct'] for p in timeline if p['cpu_pct'] is not None]
+        return {
+            'clients': args.clients, 'engine': args.engine, 'admit_rate': admit_rate or 'off',
+            'admit_burst': args.admit_burst, 'admit_queue': args.admit_queue,
+            'all_back': timeline[-1]['back'] == len(clients), 'reconnect_s': round(elapsed, 2),
+            'peak_registrations_per_s': round(max(rates), 1),
+            'peak_cpu_pct': max(cpus) if cpus else None,
+            'rejected': sum(p['rejected'] for p in timeline),
+            'peak_waiting': max(p['waiting'] for p in timeline),
+            'timeline': timeline if args.timeline else None,
+        }
+    finally:
+        for c in clients:
+            c.stop = True
+            try: c.server_conn.close()
+            except Exception: pass
+        server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--join-rate', type=float, default=100.0, help="clients started per second")
+    parser.add_argument('--settle', type=float, default=2.0)
+    parser.add_argument('--engine', default='async')
+    parser.add_argument('--admit-rate', type=float, default=50.0)
+    parser.add_argument('--admit-burst', type=int, default=20)
+    parser.add_argument('--admit-queue', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.5, help="seconds per timeline sample")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--timeline', action='store_true', help="include the per-interval samples")
+    args = parser.parse_args()
+
+    for rate in (0, args.admit_rate):
+        print(json.dumps(run(args, rate)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# benchmarks/bench_workers.py
+# Chat throughput against the number of server processes (--workers).
+# Load processes hold raw JSON connections; a few per process are closed-loop
+# senders (send a chat, wait for it to come back, send the next), so the
+# server runs as fast as it can fan out. One JSON line per worker count with
+# chats/s, frames delivered/s, and the CPU of the server's processes.
+# Run: python3 benchmarks/bench_workers.py --workers 1 2 4 --procs 4 --clients 50
+#
+# Scaling needs as many free cores as workers plus load processes.
+
+import os, sys, time, json, socket, argparse, subprocess, selectors, multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from codec import JSON
+from bench_proxy import free_port, wait_for
+from loadgen import proc_stats
+
+
+def server_pids(pid):
+    # The server process and, with --workers, its forked workers.
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def cpu_seconds(pids):
+    return sum(s[0] for s in map(proc_stats, pids) if s)
+
+
+def load(port, index, clients, senders, start_at, duration, results):
+    # One load process: `clients` connections, the first `senders` of them sending.
+    sel = selectors.DefaultSelector()
+    socks = []
+    for i in range(clients):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(JSON.encode({'type': 'REGISTER', 'name': f"w{index}-{i}", 'peer_port': 1}))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, i)
+        socks.append(s)
+    marks = {}      # sender -> (marker it waits for, bytes seen at the end of the last read)
+    lines = sent = 0
+    while time.time() < start_at:
+        for key, _ in sel.select(0.05):
+            try:
+                key.fileobj.recv(1 << 16)
+            except BlockingIOError:
+                pass
+    for i in range(senders):
+        marker = f"<{index}-{i}-0>".encode()
+        socks[i].sendall(JSON.encode({'type': 'CHAT', 'text': marker.decode()}))
+        marks[i] = (marker, b'')
+    end = start_at + duration
+    while time.time() < end:
+        for key, _ in sel.select(0.05):
+            i = key.data
+            try:
+                data = key.fileobj.recv(1 << 16)
+            except BlockingIOError:
+                continue
+            lines += data.count(b'\n')
+            if i in marks:
+                marker, tail = marks[i]
+                if marker in tail + data:
+                    sent += 1
+                    marker = f"<{index}-{i}-{sent}>".encode()
+                    key.fileobj.sendall(JSON.encode({'type': 'CHAT', 'text': marker.decode()}))
+                    tail = b''
+                marks[i] = (marker, (tail + data)[-len(marker) - 8:])
+    results.put((sent, lines))
+    for s in socks:
+        s.close()
+
+
+def run(args, workers):
+    port = free_port()
+    cmd = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1', '--port', str(port),
+           '--engine', args.engine, '--log-level', 'warning', '--idle-timeout', '0', '--admit-rate', '0',
+           '--outbox-limit', str(64 << 20)]
+    if workers > 1:
+        cmd += ['--workers', str(workers)]
+    server = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        def listening():
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                return True
+            except OSError:
+                return False
+        wait_for(listening, 10.0)
+        time.sleep(0.5)     # let every worker bind
+        results = multiprocessing.Queue()
+        start_at = time.time() + args.settle
+        procs = [multiprocessing.Process(target=load, args=(port, i, args.clients, args.senders, start_at,
+                                                            args.duration, results))
+                 for i in range(args.procs)]
+        for p in procs:
+            p.start()
+        time.sleep(max(0.0, start_at - time.time()))
+        pids = server_pids(server.pid)
+        cpu0 = cpu_seconds(pids)
+        totals = [results.get(timeout=args.settle + args.duration + 30) for _ in procs]
+        cpu = cpu_seconds(pids) - cpu0
+        for p in procs:
+            p.join()
+        chats = sum(t[0] for t in totals)
+        frames = sum(t[1] for t in totals)
+        return {
+            'workers': workers, 'engine': args.engine, 'clients': args.procs * args.clients,
+            'senders': args.procs * args.senders, 'duration_s': args.duration,
+            'chats_per_s': round(chats / args.duration, 1),
+            'frames_per_s': round(frames / args.duration, 1),
+            'server_cpu_pct': round(100.0 * cpu / args.duration, 1),
+            'server_processes': len(pids), 'cores': os.cpu_count(),
+        }
+    finally:
+        server.stdin.write(b'\n')     # ENTER stops the server and its workers
+        server.stdin.flush()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--engine', default='async')
+    parser.add_argument('--procs', type=int, default=4, help="load processes")
+    parser.add_argument('--clients', type=int, default=50, help="connections per load process")
+    parser.add_argument('--senders', type=int, default=4, help="of which closed-loop senders")
+    parser.add_argument('--settle', type=float, default=3.0, help="seconds for everyone to register")
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    base = None
+    for workers in args.workers:
+        result = run(args, workers)
+        base = base or result['frames_per_s']
+        result['speedup'] = round(result['frames_per_s'] / base, 2) if base else None
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
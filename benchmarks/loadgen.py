@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# benchmarks/loadgen.py
+# End-to-end load run: starts server.py, joins N real clients (so clients
+# from 2 up go through proxy selection and forward their chats through a
+# proxy), sends timestamped chats at a fixed rate, and reports join times,
+# delivery latency percentiles, throughput and server CPU/RSS/threads as one
+# JSON line.
+# Run: python3 benchmarks/loadgen.py --clients 20 --rate 200 --duration 10 --out results.jsonl
+#      python3 benchmarks/loadgen.py ... --baseline results.jsonl   (print changes against the last run there)
+
+import os, sys, time, json, argparse, subprocess, threading
+from queue import Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client_core import Client, FORWARD_WINDOW
+from bench_proxy import free_port, wait_for
+
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+COMPARE_KEYS = ('join_p50_ms', 'join_p99_ms', 'select_p50_ms', 'latency_p50_ms', 'latency_p99_ms',
+                'delivered_per_s', 'server_cpu_pct', 'server_rss_peak_mb', 'server_threads_peak')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def proc_stats(pid):
+    """(cpu seconds, rss MiB, threads) of a process from /proc; None off Linux."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK
+        rss = threads = 0
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024.0
+                elif line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+        return cpu, rss, threads
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Monitor:
+    """Samples the server process until stopped; keeps peaks."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.rss_peak = self.threads_peak = 0
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while self.running:
+            s = proc_stats(self.pid)
+            if s:
+                self.rss_peak = max(self.rss_peak, s[1])
+                self.threads_peak = max(self.threads_peak, s[2])
+            time.sleep(self.interval)
+
+
+def collect(client, latencies, counts, lock):
+    # Chat texts are "lg <send time>"; anything else is ignored.
+    while not client.stop:
+        try:
+            item = client.chat_queue.get(timeout=0.5)
+        except Empty:
+            continue
+        if isinstance(item, tuple) and item[0] == 'CHAT' and str(item[2]).startswith('lg '):
+            lat = (time.time() - float(item[2][3:])) * 1000.0
+            with lock:
+                latencies.append(lat)
+                counts[0] += 1
+
+
+def run(args):
+    port = free_port()
+    cmd = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1', '--port', str(port),
+           '--engine', args.engine, '--delivery', args.delivery] + args.server_arg
+    if not args.binary:
+        cmd.append('--no-binary')
+    server = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    latencies, counts, lock = [], [0], threading.Lock()
+    try:
+        time.sleep(0.5)
+        monitor = Monitor(server.pid)
+
+        # Join phase: one client at a time, as a real network grows.
+        join_ms, select_ms, probes = [], [], []
+        t_join = time.time()
+        for i in range(args.clients):
+            t0 = time.time()
+            c = Client('127.0.0.1', port, free_port(), f"lg{i}", False, args.binary,
+                       forward_window=args.forward_window_ms / 1000.0)
+            clients.append(c)
+            wait_for(lambda: c.id is not None, args.timeout)
+            join_ms.append((time.time() - t0) * 1000.0)
+            if i >= 1:
+                wait_for(lambda: getattr(c, 'current_proxy', None) is not None, args.timeout)
+                select_ms.append((time.time() - t0) * 1000.0)
+                sel = getattr(c, 'last_selection', None)
+                if sel:
+                    probes.append(sel['probes'])
+            threading.Thread(target=collect, args=(c, latencies, counts, lock), daemon=True).start()
+        join_total = time.time() - t_join
+        time.sleep(args.settle)
+
+        # Chat phase: args.rate chats/s in total, round-robin over the senders.
+        senders = clients[-args.senders:] if args.senders else clients
+        before = proc_stats(server.pid)
+        t0 = time.time()
+        sent = 0
+        while time.time() - t0 < args.duration:
+            due = int((time.time() - t0) * args.rate)
+            while sent < due:
+                senders[sent % len(senders)].send_chat(f"lg {time.time():.6f}")
+                sent += 1
+            time.sleep(0.001)
+        send_s = time.time() - t0
+        expected = sent * len(clients)
+        end = time.time() + args.drain
+        while counts[0] < expected and time.time() < end:
+            time.sleep(0.05)
+        elapsed = time.time() - t0
+        after = proc_stats(server.pid)
+        monitor.running = False
+
+        with lock:
+            lat = list(latencies)
+            delivered = counts[0]
+        cpu_s = (after[0] - before[0]) if before and after else None
+        return {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'engine': args.engine, 'delivery': args.delivery, 'binary': args.binary,
+            'forward_window_ms': args.forward_window_ms,
+            'clients': args.clients, 'senders': len(senders), 'rate': args.rate, 'duration_s': args.duration,
+            'server_args': args.server_arg,
+            'join_total_s': round(join_total, 3),
+            'join_p50_ms': rnd(percentile(join_ms, 50)), 'join_p99_ms': rnd(percentile(join_ms, 99)),
+            'select_p50_ms': rnd(percentile(select_ms, 50)), 'select_p99_ms': rnd(percentile(select_ms, 99)),
+            'probes_per_join': rnd(sum(probes) / len(probes)) if probes else None,
+            'sent': sent, 'sent_per_s': rnd(sent / send_s),
+            'expected': expected, 'delivered': delivered,
+            'delivered_per_s': rnd(delivered / elapsed),
+            'latency_p50_ms': rnd(percentile(lat, 50)), 'latency_p90_ms': rnd(percentile(lat, 90)),
+            'latency_p99_ms': rnd(percentile(lat, 99)), 'latency_max_ms': rnd(max(lat) if lat else None),
+            'server_cpu_s': rnd(cpu_s), 'server_cpu_pct': rnd(100.0 * cpu_s / elapsed) if cpu_s is not None else None,
+            'server_rss_mb': rnd(after[1]) if after else None, 'server_rss_peak_mb': rnd(monitor.rss_peak),
+            'server_threads': after[2] if after else None, 'server_threads_peak': monitor.threads_peak,
+        }
+    finally:
+        for c in clients:
+            c.stop = True
+            try: c.server_conn.close()
+            except Exception: pass
+        server.kill()
+
+
+def rnd(v):
+    return None if v is None else round(v, 3)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(result, path):
+    # Print each headline metric next to the last result recorded in path.
+    try:
+        with open(path) as f:
+            lines = [l for l in f if l.strip()]
+        base = json.loads(lines[-1])
+    except (OSError, IndexError, ValueError):
+        print(f"no baseline in {path}", file=sys.stderr)
+        return
+    print(f"{'metric':22} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+    for key in COMPARE_KEYS:
+        a, b = base.get(key), result.get(key)
+        change = f"{100.0 * (b - a) / a:+.1f}%" if a and b is not None else ''
+        print(f"{key:22} {str(a):>12} {str(b):>12} {change:>8}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--senders', type=int, default=0, help="clients that send chats (0 = all)")
+    parser.add_argument('--rate', type=float, default=200.0, help="chats per second, all senders together")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of sending")
+    parser.add_argument('--drain', type=float, default=10.0, help="seconds to wait for stragglers")
+    parser.add_argument('--settle', type=float, default=1.0, help="pause between joining and sending")
+    parser.add_argument('--timeout', type=float, default=15.0, help="per-client join timeout")
+    parser.add_argument('--engine', default='threaded')
+    parser.add_argument('--delivery', default='direct')
+    parser.add_argument('--binary', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--forward-window-ms', type=float, default=FORWARD_WINDOW * 1000.0,
+                        help="proxies batch forwarded chats over this window (0 = one FORWARDED_CHAT each)")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="extra argument passed to server.py (repeatable)")
+    parser.add_argument('--out', default=None, help="append the result as a JSON line to this file")
+    parser.add_argument('--baseline', default=None, help="compare against the last result in this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.baseline:
+        compare(result, args.baseline)
+    line = json.dumps(result)
+    print(line)
+    if args.out:
+        with open(args.out, 'a') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
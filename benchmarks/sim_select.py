@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# benchmarks/sim_select.py
+# Deterministic simulation of joins and proxy selection. The real server
+# (handle_message, the id-2 / id>=3 placement rules, ranking, capacity) and
+# the real Client.perform_latency_selection cascade run in one process over a
+# virtual transport and a virtual clock, so hundreds or thousands of clients
+# take seconds and the same --seed gives the same result.
+#
+# Clients sit in --regions clusters on a plane measured in milliseconds; a
+# link's RTT is the distance between its ends plus both access delays, and
+# every transfer adds exponential jitter and, per packet lost (--loss), a TCP
+# retransmission timeout. --links FILE overrides single links with a JSON list
+# of [a, b, rtt_ms, jitter_ms, loss] (node 0 is the server, node i the i-th
+# client to join).
+#
+# One JSON line per (--clients, --candidates) pair: time from REGISTER to
+# CHOICE, probes per join, path stretch against the best earlier client and
+# the load on each proxy.
+# Run: python3 benchmarks/sim_select.py --clients 100 1000 --candidates 0 4
+
+import os, sys, json, heapq, random, argparse, multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server, client_core, latency, rttstore
+from codec import FrameReader, JSON, DEFAULT_CHANNEL
+from client_core import Client, PROBE_WORKERS, MEASURE_TIMEOUT
+
+SYN_RTO = 1000.0        # ms before a lost connection attempt is retried
+DATA_RTO = 200.0        # ms before lost data is retransmitted (Linux's minimum RTO)
+EPOCH = 1.7e9           # virtual time starts here, so timestamps look like real ones
+
+
+class VirtualClock:
+    """Stands in for the `time` module of the simulated code."""
+
+    def __init__(self, now=EPOCH):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    monotonic = perf_counter = time
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Network:
+    """RTTs, jitter and loss between node 0 (the server) and the clients."""
+
+    def __init__(self, args, rng):
+        self.rng = rng
+        self.jitter = args.jitter_ms
+        self.loss = args.loss
+        self.links = {}     # (low node, high node) -> (rtt_ms, jitter_ms, loss)
+        self.pos = [complex(args.spread / 2, args.spread / 2)]     # points on the plane, in ms
+        self.access = [1.0]
+        self.region = [0]
+        centers = [(rng.uniform(0, args.spread), rng.uniform(0, args.spread)) for _ in range(args.regions)]
+        for i in range(1, args.size + 1):
+            r = rng.randrange(args.regions)
+            cx, cy = centers[r]
+            self.pos.append(complex(rng.gauss(cx, args.region_ms), rng.gauss(cy, args.region_ms)))
+            self.access.append(rng.uniform(0.5, args.access_ms))
+            self.region.append(r + 1)
+        if args.links:
+            with open(args.links) as f:
+                for a, b, rtt, jitter, loss in json.load(f):
+                    self.links[(min(a, b), max(a, b))] = (float(rtt), float(jitter), float(loss))
+
+    def base(self, a, b):
+        """The link's RTT without jitter or loss, in ms."""
+        link = self.links.get((min(a, b), max(a, b)))
+        if link is not None:
+            return link[0]
+        return abs(self.pos[a] - self.pos[b]) + self.access[a] + self.access[b]
+
+    def nearest(self, a, others, via_server=False):
+        """Lowest base RTT from a to any of others (plus, with via_server,
+        from there on to the server)."""
+        if self.links:
+            return min(self.base(a, b) + (self.base(b, 0) if via_server else 0.0) for b in others)
+        pos, access, p = self.pos, self.access, self.pos[a]
+        if via_server:
+            s = pos[0]
+            return min(abs(p - pos[b]) + 2 * access[b] + abs(pos[b] - s) for b in others) + access[a] + access[0]
+        return min(abs(p - pos[b]) + access[b] for b in others) + access[a]
+
+    def rtt(self, a, b, rto=DATA_RTO):
+        """One round trip over TCP: the base RTT, jitter each way, and a
+        retransmission timeout (doubling) for every packet lost."""
+        link = self.links.get((min(a, b), max(a, b)))
+        base, jitter, loss = link or (self.base(a, b), self.jitter, self.loss)
+        total = base
+        for _ in range(2):
+            if jitter:
+                total += self.rng.expovariate(2.0 / jitter)
+            wait = rto
+            while loss and self.rng.random() < loss:
+                total += wait
+                wait *= 2
+        return total
+
+    def one_way(self, a, b):
+        return self.rtt(a, b) / 2.0
+
+
+class SimClient(Client):
+    """A Client whose sockets are the simulation's: selection, CLIENT_LIST and
+    the rest of the server protocol run unchanged, while ping_peer,
+    measure_via_peer and the probe waves cost virtual time instead."""
+
+    def __init__(self, sim, node):
+        self.sim = sim
+        self.node = node
+        self.opened = set()     # peers our pool holds a connection to
+        ip, port = sim.address(node)
+        # no server address: send_server hands everything to the simulation
+        super().__init__(None, None, port, f"s{node}", False, binary=False, compress=False)
+        self.peer_addr = (ip, port)
+
+    def open_network(self, peer_backlog):
+        pass    # no sockets or threads: the simulation delivers every message
+
+    def send_server(self, obj):
+        self.sim.to_server(self, obj)
+        return True
+
+    def handle_server_msg(self, msg):
+        if msg.get('type') == 'CLIENT_LIST':
+            # run the selection now, on the virtual clock, instead of on a thread
+            self.perform_latency_selection(msg.get('clients', []))
+            return
+        super().handle_server_msg(msg)
+        if msg.get('type') == 'ASSIGN_ID':
+            self.sim.server_rtt(self)
+
+    def report_server_rtt(self):
+        pass    # the simulation sends the RTT_REPORT (see Simulation.server_rtt)
+
+    def _probe_wave(self, pool, jobs, deadline):
+        # PROBE_WORKERS slots: each job starts when a slot frees up and moves
+        # the clock by its own duration; the wave ends with its last job or at
+        # the deadline, and jobs still running then count as None.
+        clock = self.sim.clock
+        start = clock.now
+        slots = [start] * min(PROBE_WORKERS, len(jobs))
+        results = []
+        for fn, *args in jobs:
+            i = slots.index(min(slots))
+            clock.now = slots[i]
+            value = fn(*args)
+            slots[i] = clock.now
+            results.append((value, clock.now))
+        clock.now = min(max(slots, default=start), max(start, deadline))
+        return [value if end <= deadline else None for value, end in results]
+
+    def _connect(self, other, timeout):
+        # The pooled connection's handshake, charged to the probe's time but not its RTT.
+        if other.node in self.opened:
+            return True
+        took = self.sim.net.rtt(self.node, other.node, SYN_RTO) / 1000.0
+        if took > timeout:
+            self.sim.clock.now += timeout
+            return False
+        self.sim.clock.now += took
+        self.opened.add(other.node)
+        return True
+
+    def ping_peer(self, ip, port, timeout=1.0, wire=JSON):
+        other = self.sim.by_addr[(ip, port)]
+        self.sim.probes += 1
+        rtt = None
+        if self._connect(other, timeout):
+            took = self.sim.net.rtt(self.node, other.node)
+            if took / 1000.0 > timeout:
+                self.sim.clock.now += timeout
+            else:
+                self.sim.clock.now += took / 1000.0
+                rtt = took
+        self.latency.sample((ip, port), rtt)
+        return rtt
+
+    def measure_via_peer(self, peer, timeout=3.0, wire=JSON):
+        other = self.sim.by_addr[tuple(peer)]
+        self.sim.probes += 1
+        if self._connect(other, timeout):
+            # the proxy PINGs the server while our request waits
+            server_rtt = self.sim.net.rtt(other.node, 0)
+            if server_rtt / 1000.0 > MEASURE_TIMEOUT:
+                server_rtt, waited = float('inf'), MEASURE_TIMEOUT * 1000.0
+            else:
+                waited = server_rtt
+            total = self.sim.net.rtt(self.node, other.node) + waited
+            if total / 1000.0 <= timeout:
+                self.sim.clock.now += total / 1000.0
+                self.latency.sample((tuple(peer), 'server'), server_rtt if server_rtt != float('inf') else None)
+                self.latency.sample((tuple(peer), 'chain'), total)
+                return server_rtt, total
+            self.sim.clock.now += timeout
+        self.latency.sample((tuple(peer), 'chain'), None)
+        return None
+
+
+class SimOut:
+    """The server's outbox for one simulated client: frames are decoded and
+    delivered after the link's one-way delay, in order."""
+
+    codec = JSON
+    deflate = None
+    closed = False
+
+    def __init__(self, sim, client):
+        self.sim = sim
+        self.client = client
+        self.reader = FrameReader()
+
+    def push(self, data):
+        self.reader.feed(data)
+        while (msg := self.reader.next_msg()) is not None:
+            self.sim.send(self.client, 'down', self.client.handle_server_msg, msg)
+        return True
+
+    def depth(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.net = Network(args, self.rng)
+        self.clock = VirtualClock()
+        self.events = []        # heap of (time, seq, fn, args)
+        self.seq = 0
+        self.last = {}          # (node, direction) -> last delivery time, to keep each link in order
+        self.clients = []
+        self.by_addr = {}
+        self.sessions = {}
+        self.joined_at = {}     # node -> time its REGISTER was sent
+        self.choice_at = {}     # node -> time its CHOICE was sent
+        self.best_open = {}     # node -> best base RTT among earlier clients with room, at CHOICE
+        self.probes = 0
+
+    def address(self, node):
+        # clients of a region share /24 subnets, which the server's ranking uses for newcomers
+        region = self.net.region[node]
+        return (f"10.{region}.{node // 200}.{node % 200 + 1}", 20000 + node)
+
+    def at(self, when, fn, *args):
+        self.seq += 1
+        heapq.heappush(self.events, (when, self.seq, fn, args))
+
+    def send(self, client, direction, fn, *args):
+        # TCP keeps each direction of a connection in order, whatever the jitter
+        key = (client.node, direction)
+        when = max(self.clock.now + self.net.one_way(client.node, 0) / 1000.0, self.last.get(key, 0.0))
+        self.last[key] = when
+        self.at(when, fn, *args)
+
+    def to_server(self, client, obj):
+        if obj.get('type') == 'CHOICE':
+            self.choice_at[client.node] = self.clock.now
+        self.send(client, 'up', self.server_receive, client, obj)
+
+    def server_receive(self, client, msg):
+        if msg.get('type') == 'CHOICE':
+            self.note_open(client)
+        server.handle_message(self.sessions[client.node], msg)
+
+    def server_rtt(self, client):
+        # what Client.report_server_rtt measures and reports once it has an id
+        rtt = self.net.rtt(client.node, 0)
+        self.at(self.clock.now + rtt / 1000.0, client.send_server, {'type': 'RTT_REPORT', 'rtts': [[0, rtt]]})
+
+    def note_open(self, client):
+        now = self.clock.now
+        with server.lock:
+            ids = {info['peer_addr']: cid for cid, info in server.clients.items()}
+            my_id = ids.get(client.peer_addr)
+            room = [self.by_addr[addr] for addr, cid in ids.items()
+                    if my_id is not None and cid < my_id and not server.overloaded(cid, now, 1)]
+        if room:
+            self.best_open[client.node] = self.net.nearest(client.node, [c.node for c in room])
+
+    def join(self, node):
+        client = SimClient(self, node)
+        self.clients.append(client)
+        self.by_addr[client.peer_addr] = client
+        self.sessions[node] = server.new_session(SimOut(self, client), (client.peer_addr[0], 40000 + node))
+        self.joined_at[node] = self.clock.now
+        client.send_server({'type': 'REGISTER', 'peer_ip': client.peer_addr[0], 'peer_port': client.peer_addr[1],
+                            'name': client.name, 'codecs': [], 'channels': [DEFAULT_CHANNEL]})
+
+    def run(self):
+        for node in range(1, self.args.size + 1):
+            self.at(EPOCH + (node - 1) / self.args.join_rate, self.join, node)
+        while self.events:
+            when, _, fn, args = heapq.heappop(self.events)
+            self.clock.now = when
+            fn(*args)
+
+    def report(self, wall):
+        args = self.args
+        selected = [c for c in self.clients if c.last_selection]
+        proxy_of = {}
+        with server.lock:
+            by_id = {cid: self.by_addr[info['peer_addr']] for cid, info in server.clients.items()}
+            for cid, info in server.clients.items():
+                if info['proxy'] in by_id:
+                    proxy_of[by_id[cid].node] = by_id[info['proxy']].node
+            fan = [n for n in server.fan_in.values() if n > 0]
+        id_of = {c.node: cid for cid, c in by_id.items()}
+        peer, chain, open_ = [], [], []
+        for c in selected:
+            p = proxy_of.get(c.node)
+            if p is None:
+                continue
+            # ids follow the order REGISTERs reached the server, not the join order
+            earlier = [x.node for cid, x in by_id.items() if cid < id_of[c.node]]
+            best = self.net.nearest(c.node, earlier)
+            best_chain = self.net.nearest(c.node, earlier, via_server=True)
+            got = self.net.base(c.node, p)
+            peer.append(got / best)
+            chain.append((got + self.net.base(p, 0)) / best_chain)
+            if c.node in self.best_open:
+                open_.append(got / self.best_open[c.node])
+        to_choice = [(self.choice_at[c.node] - self.joined_at[c.node]) * 1000.0
+                     for c in selected if c.node in self.choice_at]
+        probes = [c.last_selection['probes'] for c in selected]
+        loads = {}
+        for n in fan:
+            loads[n] = loads.get(n, 0) + 1
+        return {
+            'clients': args.size, 'candidates': args.candidates or 'all', 'seed': args.seed,
+            'regions': args.regions, 'jitter_ms': args.jitter_ms, 'loss': args.loss,
+            'proxy_capacity': args.proxy_capacity or 'unlimited',
+            'time_to_choice_ms': summary(to_choice),
+            'selection_ms': summary([c.last_selection['elapsed_ms'] for c in selected]),
+            'probes_per_join': summary(probes), 'probes_total': self.probes,
+            'stretch_peer': summary(peer, 3), 'stretch_open': summary(open_, 3), 'stretch_chain': summary(chain, 3),
+            'optimal_pct': round(100.0 * sum(1 for s in peer if s <= 1.0 + 1e-9) / len(peer), 1) if peer else None,
+            'proxies': len(fan), 'unplaced': args.size - 1 - len(proxy_of),
+            'fan_in': summary(fan), 'fan_in_counts': dict(sorted(loads.items())),
+            'wall_s': round(wall, 2),
+        }
+
+
+def summary(values, digits=1):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+    return {'mean': round(sum(values) / len(values), digits), 'p50': round(pick(50), digits),
+            'p90': round(pick(90), digits), 'p99': round(pick(99), digits), 'max': round(values[-1], digits)}
+
+
+def prepare(args):
+    # A Simulation wired into the real modules. The server's state is
+    # module-global, so use one per process.
+    random.seed(args.seed)      # the server's shortlist sampling and the cascade's last tie-break
+    sim = Simulation(args)
+    for mod in (server, client_core, latency, rttstore):
+        mod.time = sim.clock
+    server.IDLE_TIMEOUT = 0
+    server.CANDIDATES = args.candidates
+    server.PROXY_CAPACITY = args.proxy_capacity
+    return sim
+
+
+def simulate(args, results):
+    # One run, in a fresh process.
+    import time as real_time
+    t0 = real_time.perf_counter()
+    sim = prepare(args)
+    sim.run()       # log is never configured here, so the clients' log calls are no-ops
+    results.put(sim.report(real_time.perf_counter() - t0))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--candidates', type=int, nargs='+', default=[server.CANDIDATES],
+                        help="proxies offered per CLIENT_LIST (0 = every earlier client)")
+    parser.add_argument('--proxy-capacity', type=int, default=server.PROXY_CAPACITY, help="0 = unlimited")
+    parser.add_argument('--join-rate', type=float, default=20.0, help="joins per virtual second")
+    parser.add_argument('--regions', type=int, default=8)
+    parser.add_argument('--spread', type=float, default=150.0, help="ms across the plane the regions sit on")
+    parser.add_argument('--region-ms', type=float, default=5.0, help="ms spread of a region's clients")
+    parser.add_argument('--access-ms', type=float, default=10.0, help="access delay of a node, up to")
+    parser.add_argument('--jitter-ms', type=float, default=1.0, help="mean jitter per round trip")
+    parser.add_argument('--loss', type=float, default=0.0, help="packet loss rate on every link")
+    parser.add_argument('--links', default=None, help="JSON [[a, b, rtt_ms, jitter_ms, loss], ...] overrides")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    ctx = multiprocessing.get_context('fork')
+    for size in args.clients:
+        for candidates in args.candidates:
+            run = argparse.Namespace(**vars(args), size=size)
+            run.candidates = candidates
+            results = ctx.Queue()
+            p = ctx.Process(target=simulate, args=(run, results))
+            p.start()
+            print(json.dumps(results.get()), flush=True)
+            p.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# bus.py
+# Local message bus between the processes of a multi-worker server
+# (server.py --workers N): newline-JSON frames over a Unix socketpair per
+# worker, with the parent process (the hub) at the other end of each one.
+
+import threading
+
+from codec import FrameReader, JSON
+from outbox import Outbox
+from peerpool import PendingRequests
+
+BUS_FRAME = 16 << 20    # longest bus message accepted
+BUS_LIMIT = 256 << 20   # bytes queued toward the other end before the link is dropped
+BUS_TIMEOUT = 5.0       # seconds to wait for the reply to a request()
+
+
+class BusLink:
+    """One end of a bus connection.
+
+    send() and push() never block: an Outbox writes the frames. request()
+    also returns a Future for the REPLY carrying the same req_id. Every other
+    message is passed to on_message(link, msg) on the link's reader thread, so
+    one link's messages are handled one at a time and in order. on_close(link)
+    runs once the other end is gone.
+    """
+
+    def __init__(self, sock, on_message, on_close=None):
+        self.sock = sock
+        self.on_message = on_message
+        self.on_close = on_close
+        self.out = Outbox(sock, BUS_LIMIT)
+        self.pending = PendingRequests()
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def send(self, msg):
+        return self.out.push(JSON.encode(msg))
+
+    def push(self, data):
+        """Send a message already encoded with encode()."""
+        return self.out.push(data)
+
+    def request(self, msg):
+        req_id, fut = self.pending.new()
+        msg['req_id'] = req_id
+        if not self.send(msg):
+            self.pending.resolve(req_id, None)
+        return fut
+
+    def reply(self, msg, reply):
+        reply['type'] = 'REPLY'
+        reply['req_id'] = msg.get('req_id')
+        self.send(reply)
+
+    def close(self):
+        self.out.close()
+
+    def _reader(self):
+        for msg in FrameReader(self.sock, BUS_FRAME).messages():
+            if msg.get('type') == 'REPLY':
+                self.pending.resolve(msg.get('req_id'), msg)
+            else:
+                self.on_message(self, msg)
+        self.out.close()
+        if self.on_close is not None:
+            self.on_close(self)
+
+
+encode = JSON.encode
@@ -0,0 +1,778 @@
+# client_core.py
+# Networking side of the chat client: server link, proxy selection, peer
+# listener and relay. Imports without pygame, so scripted and headless
+# clients (see run_headless) stay cheap; client.py adds the GUI on top.
+
+import socket, threading, time, sys, json, random
+from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import codec, log, metrics
+from codec import FrameReader, JSON, DEFAULT_CHANNEL
+from peerpool import PeerPool, PendingRequests
+from latency import LatencyEstimator
+from peerlistener import PeerListener, PEER_BACKLOG
+
+SELECTION_DEADLINE = 4.0   # seconds for the whole proxy selection
+PROBE_SAMPLES = 3          # max RTT samples per peer in round 1
+CLEAR_MARGIN_MS = 2.0      # a leader this far ahead of everyone else needs no more samples
+PROBE_WORKERS = 16         # concurrent probes per selection
+MEASURE_TIMEOUT = 2.0      # proxy-side server PING for a peer's MEASURE_SERVER
+RELAY_WINDOW = 1024        # chat sequence numbers remembered for duplicate suppression
+RELAY_RETRY = 1.0          # seconds before re-subscribing after a relay link drops
+BG_PROBE_INTERVAL = 5.0    # one background probe per this many seconds keeps the RTT cache warm
+BG_DROP_LOSS = 0.5         # stop background-probing a peer whose loss rate reaches this
+BACKOFF_BASE = 0.5         # seconds; first reconnect waits up to this, doubling per failed attempt
+BACKOFF_MAX = 15.0         # cap on the reconnect wait (kept under the server's resume grace)
+FORWARD_WINDOW = 0.005     # seconds a proxy gathers forwarded chats into one FORWARDED_BATCH; 0 = off
+FORWARD_BATCH = 64         # chats per FORWARDED_BATCH (the server's advertised limit caps it too)
+FORWARD_BATCH_BYTES = 65536  # and their text, so a batch stays far below the server's frame limit
+FORWARD_TIMEOUT = 2.0      # a chat the proxy hasn't acked by then goes to the server directly
+
+# ---------- Networking helpers ----------
+def send_json(conn, obj, wire=JSON):
+    try:
+        conn.sendall(wire.encode(obj))
+    except Exception:
+        pass
+
+def _in_contention(r, results):
+    # Still worth another sample: within CLEAR_MARGIN_MS of the best rival.
+    rivals = [o['rtt'] for o in results if o is not r]
+    return bool(rivals) and abs(r['rtt'] - min(rivals)) <= CLEAR_MARGIN_MS
+
+class SeqWindow:
+    """The last RELAY_WINDOW chat sequence numbers seen, to drop relay duplicates.
+
+    `low` is the highest seq up to which nothing is missing, the point a
+    RESUME asks the server to replay from.
+    """
+
+    def __init__(self, size=RELAY_WINDOW, start=0):
+        self.size = size
+        self.seen = set()
+        self.order = deque()
+        self.high = self.low = start
+        self.lock = threading.Lock()
+
+    def add(self, seq):
+        """True the first time seq is seen."""
+        with self.lock:
+            if seq in self.seen or seq <= self.high - self.size:
+                return False
+            self.seen.add(seq)
+            self.order.append(seq)
+            self.high = max(self.high, seq)
+            while self.low + 1 in self.seen:
+                self.low += 1
+            if len(self.order) > self.size:
+                self.seen.discard(self.order.popleft())
+            return True
+
+    def skip_to(self, seq):
+        """Treat everything up to seq as received (e.g. history before a JOIN)."""
+        with self.lock:
+            self.high = max(self.high, seq)
+            self.low = max(self.low, seq)
+            while self.low + 1 in self.seen:
+                self.low += 1
+
+# ---------- Client core ----------
+class Client:
+    def __init__(self, server_ip, server_port, peer_listen_port, name, use_local_ip, binary=True,
+                 peer_backlog=PEER_BACKLOG, forward_window=FORWARD_WINDOW, forward_batch=FORWARD_BATCH,
+                 compress=True):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.peer_listen_port = peer_listen_port
+        self.name = name
+        self.use_local_ip = use_local_ip
+        self.server_conn = None
+        self.server_send_lock = threading.Lock()
+        self.server_pending = PendingRequests()
+        self.wire_codecs = ('bin1',) if binary else ()
+        self.compress = compress    # offer deflate to the server and peers
+        self.server_codec = JSON
+        self.server_deflate = None  # codec.Deflater once ASSIGN_ID agrees to compress
+        self.id = None
+        self.peer_addr = None
+        self.chat_queue = Queue()
+        self.stop = False
+        self.proxy_targets = set()
+        self.delivery = 'direct'
+        self.channels = {DEFAULT_CHANNEL}   # channels we are in
+        self.windows = {}           # channel -> SeqWindow of the chats seen in it
+        self.token = None           # from ASSIGN_ID; lets server_loop RESUME after a reconnect
+        self.attempt = 0            # reconnects since the server last gave us an id
+        self.retry_after = None     # the server's RETRY_AFTER hint, in seconds
+        self.downstream = {}        # relay mode: client_id -> (peer link, codec, channels) we push chats to
+        self.relay_conn = None      # relay mode: our subscription to current_proxy
+        self.interest_lock = threading.Lock()
+        self.forward_window = forward_window
+        self.forward_batch = forward_batch
+        self.server_batch = 0       # FORWARDED_BATCH size the server accepts; 0 = send FORWARDED_CHAT
+        self.forwards = deque()     # proxy: forwarded chats waiting for the next batch
+        self.forward_bytes = 0
+        self.forward_cond = threading.Condition()
+        self.known_peers = {}       # peer addr -> codec, for background probing
+        self.deflate_peers = set()  # peer addrs that offered deflate
+        self.latency = LatencyEstimator()   # RTT estimates that outlive a single selection
+        self.current_proxy = None
+        self.last_selection = None  # timing of the latest proxy selection
+        self.open_network(peer_backlog)
+
+    def open_network(self, peer_backlog):
+        # Everything that needs real sockets: the peer pool and listener, and
+        # the threads that run the server link and the periodic work.
+        self.pool = PeerPool(on_push=self.on_chat, on_close=self.relay_closed,
+                             compress=self.deflate_peers.__contains__)
+        # peers are served by one selector thread; anything slower than a reply
+        # runs on a small worker pool, in order per peer
+        self.peer_listener = PeerListener(self.peer_listen_port, self.on_peer_message, self.handle_peer_item,
+                                          backlog=peer_backlog)
+
+        threading.Thread(target=self.server_loop, daemon=True).start()
+        threading.Thread(target=self.expire_requests, daemon=True).start()
+        threading.Thread(target=self.forward_loop, daemon=True).start()
+        threading.Thread(target=self.background_probe, daemon=True).start()
+
+    def get_local_ip(self):
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(('8.8.8.8', 80))
+            ip = s.getsockname()[0]
+            s.close()
+            return ip
+        except:
+            return socket.gethostbyname(socket.gethostname())
+
+    def server_loop(self):
+        while not self.stop:
+            try:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.connect((self.server_ip, self.server_port))
+                self.server_codec = JSON
+                self.server_deflate = None
+                self.server_pending = PendingRequests()
+                self.server_conn = s
+                my_ip = self.get_local_ip()
+                hello = {'type':'REGISTER', 'peer_ip': my_ip, 'peer_port': self.peer_listen_port, 'name': self.name,
+                         'codecs': self.offered(), 'channels': sorted(self.channels)}
+                if self.id is not None and self.token:
+                    # reconnecting: keep our id and proxy, and get the chats we missed
+                    hello.update(type='RESUME', id=self.id, token=self.token,
+                                 last_seq=self.window(DEFAULT_CHANNEL).low,
+                                 last_seqs={ch: self.window(ch).low for ch in self.channels})
+                self.send_server(hello)
+                # the only reader of server_conn; replies reach waiters via server_pending
+                for msg in FrameReader(s).messages():
+                    self.handle_server_msg(msg)
+            except Exception:
+                pass
+            finally:
+                try:
+                    if self.server_conn:
+                        self.server_conn.close()
+                except:
+                    pass
+                self.server_conn = None
+                self.server_pending.fail_all(ConnectionError('server connection lost'))
+            time.sleep(self.reconnect_delay())
+
+    def reconnect_delay(self):
+        # Capped exponential backoff with full jitter, so clients cut off together
+        # don't come back together; a RETRY_AFTER hint from the server is added on.
+        self.attempt += 1
+        cap = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.attempt - 1))
+        hint, self.retry_after = self.retry_after or 0.0, None
+        return hint + random.uniform(0, cap)
+
+    def send_server(self, obj):
+        """Write obj to the server in the negotiated codec; False if not connected."""
+        s = self.server_conn
+        if s is None:
+            return False
+        with self.server_send_lock:
+            try:
+                data = self.server_codec.encode(obj)
+                if self.server_deflate is not None:
+                    data = self.server_deflate.compress(data)
+                s.sendall(data)
+                return True
+            except OSError:
+                return False
+
+    def request_server(self, obj, timeout=MEASURE_TIMEOUT):
+        """Send obj with a req_id the server echoes; returns a Future for the reply."""
+        pending = self.server_pending
+        req_id, fut = pending.new(timeout)
+        if not self.send_server(dict(obj, req_id=req_id)):
+            pending.fail(req_id, ConnectionError('no_server_conn'))
+        return fut
+
+    def expire_requests(self):
+        while not self.stop:
+            time.sleep(0.1)
+            self.server_pending.expire()
+            self.pool.expire()
+
+    def on_peer_message(self, link, msg, wire):
+        # Selector thread: answer the cheap requests here, hand the rest to the
+        # workers. Replies go back in whatever codec the peer used.
+        t = msg.get('type')
+        if t == 'PING':
+            reply = {'type':'PONG','ts': time.time()}
+            if 'req_id' in msg:
+                reply['req_id'] = msg['req_id']
+            send_json(link, reply, wire)
+        elif t == 'FORWARD_TO_SERVER':
+            action = msg.get('action')
+            if action == 'MEASURE_SERVER':
+                link.submit(('PEER_MEASURE_REQUEST', msg.get('req_id'), link, wire))
+            elif action == 'FORWARD_CHAT':
+                link.submit(('PEER_FORWARD_CHAT', msg.get('orig_id'), msg.get('name'), msg.get('text'), link, wire,
+                             msg.get('req_id'), msg.get('channel', DEFAULT_CHANNEL)))
+        elif t == 'STATS':
+            send_json(link, {'type':'STATS_REPLY', 'stats': metrics.snapshot(), 'req_id': msg.get('req_id')}, wire)
+        elif t == 'RELAY_SUBSCRIBE':
+            link.submit(('PEER_SUBSCRIBE', msg.get('client_id'), link, wire, msg.get('req_id'),
+                         msg.get('channels')))
+        else:
+            link.submit(('PEER_MSG', msg, link))
+
+    def handle_peer_item(self, item):
+        # Worker thread; one peer's items never run concurrently.
+        if item[0] == 'PEER_MEASURE_REQUEST':
+            req_id, conn, wire = item[1], item[2], item[3]
+            metrics.incr('relay.measure')
+            if not self.server_conn:
+                send_json(conn, {'type':'FORWARD_REPLY', 'req_id': req_id, 'error': 'no_server_conn'}, wire)
+            else:
+                # completes on server_loop's thread; many may be outstanding
+                tstart = time.time()
+                fut = self.request_server({'type':'PING'})
+                fut.add_done_callback(lambda f, t=tstart, c=conn, w=wire, r=req_id:
+                                      self._measure_done(f, t, c, w, r))
+
+        elif item[0] == 'PEER_FORWARD_CHAT':
+            orig_id, nm, txt, conn, wire, req_id, channel = item[1:8]
+            if self.forward_window > 0 and self.server_batch:
+                # forward_loop sends it with the others of this window and acks it
+                with self.forward_cond:
+                    self.forwards.append((orig_id, nm, txt, channel, conn, wire, req_id))
+                    self.forward_bytes += len(txt) if isinstance(txt, str) else 0
+                    if len(self.forwards) == 1 or len(self.forwards) >= self.forward_batch:
+                        self.forward_cond.notify()
+                return
+            fwd = {'type':'FORWARDED_CHAT', 'orig_id': orig_id, 'name': nm, 'text': txt}
+            if channel != DEFAULT_CHANNEL:
+                fwd['channel'] = channel
+            if not self.send_server(fwd):
+                metrics.incr('relay.forward_failed')
+                send_json(conn, {'type':'FORWARD_CHAT_RESULT', 'ok': False, 'error':'no_server_conn', 'req_id': req_id}, wire)
+            else:
+                metrics.incr('relay.forwarded')
+                send_json(conn, {'type':'FORWARD_CHAT_RESULT', 'ok': True, 'req_id': req_id}, wire)
+
+        elif item[0] == 'PEER_SUBSCRIBE':
+            # also sent again whenever the subscriber's channels change
+            client_id, conn, wire, req_id, chans = item[1:6]
+            self.downstream[client_id] = (conn, wire, set(chans) if isinstance(chans, list)
+                                          else {DEFAULT_CHANNEL})
+            metrics.incr('relay.subscribed')
+            send_json(conn, {'type':'RELAY_SUBSCRIBED', 'ok': True, 'req_id': req_id}, wire)
+            self.announce_interest()
+
+        elif item[0] == 'PEER_CLOSED':
+            for cid, (o, _, _) in list(self.downstream.items()):
+                if o is item[1]:
+                    self.downstream.pop(cid, None)
+            self.announce_interest()
+        else:
+            self.chat_queue.put(item)
+
+    def forward_loop(self):
+        # Proxy: gather the chats forwarded within forward_window (or until a
+        # batch is full) into one FORWARDED_BATCH, then ack each to its peer.
+        # Batches go out in arrival order, so each sender's chats stay in order.
+        cond = self.forward_cond
+        while True:
+            with cond:
+                while not self.forwards:
+                    cond.wait()
+                limit = max(1, min(self.forward_batch, self.server_batch or 1))
+                deadline = time.time() + self.forward_window
+                while len(self.forwards) < limit and self.forward_bytes < FORWARD_BATCH_BYTES:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        break
+                    cond.wait(left)
+                batch, size = [], 0
+                while self.forwards and len(batch) < limit and (not batch or size < FORWARD_BATCH_BYTES):
+                    f = self.forwards.popleft()
+                    n = len(f[2]) if isinstance(f[2], str) else 0
+                    self.forward_bytes -= n
+                    size += n
+                    batch.append(f)
+            ok = self.send_server({'type':'FORWARDED_BATCH',
+                                   'chats': [[orig_id, nm, txt, channel]
+                                             for orig_id, nm, txt, channel, _, _, _ in batch]})
+            metrics.incr('relay.forwarded' if ok else 'relay.forward_failed', len(batch))
+            metrics.observe('relay.batch', len(batch))
+            for _, _, _, _, conn, wire, req_id in batch:
+                if ok:
+                    send_json(conn, {'type':'FORWARD_CHAT_RESULT', 'ok': True, 'req_id': req_id}, wire)
+                else:
+                    send_json(conn, {'type':'FORWARD_CHAT_RESULT', 'ok': False, 'error':'no_server_conn',
+                                     'req_id': req_id}, wire)
+
+    def _measure_done(self, fut, tstart, conn, wire, req_id):
+        try:
+            fut.result()
+            rtt = (time.time() - tstart) * 1000.0
+            send_json(conn, {'type':'FORWARD_REPLY', 'req_id': req_id, 'server_rtt_ms': rtt}, wire)
+        except Exception as e:
+            send_json(conn, {'type':'FORWARD_REPLY', 'req_id': req_id, 'error': str(e) or type(e).__name__}, wire)
+
+    def handle_server_msg(self, msg):
+        t = msg.get('type')
+        if t == 'PING':
+            # server heartbeat
+            self.send_server({'type':'PONG', 'ts': time.time(), 'req_id': msg.get('req_id')})
+        elif t == 'RETRY_AFTER':
+            # the server is admitting registrations slowly; hang up and come back later
+            self.retry_after = float(msg.get('seconds') or 0)
+            s = self.server_conn
+            if s is not None:
+                try: s.shutdown(socket.SHUT_RDWR)
+                except OSError: pass
+        elif t == 'ASSIGN_ID':
+            self.attempt = 0
+            self.id = msg.get('id')
+            self.server_codec = codec.CODECS.get(msg.get('codec'), JSON)
+            with self.server_send_lock:
+                self.server_deflate = codec.Deflater() if msg.get('compress') == codec.DEFLATE else None
+            self.delivery = msg.get('delivery', 'direct')
+            self.token = msg.get('token')
+            self.server_batch = msg.get('batch') or 0
+            if not msg.get('resumed'):
+                # a new id starts from the server's current seq in each channel it joined
+                seqs = msg.get('seqs') or {DEFAULT_CHANNEL: msg.get('seq', 0)}
+                self.windows = {ch: SeqWindow(start=seq) for ch, seq in seqs.items()}
+                self.channels = set(seqs)
+            threading.Thread(target=self.report_server_rtt, daemon=True).start()
+        elif t == 'USE_PROXY':
+            proxy_id = msg.get('proxy_id')
+            proxy_peer = msg.get('proxy_peer')
+            self.current_proxy = {'id': proxy_id, 'peer': tuple(proxy_peer),
+                                  'codec': self.peer_codec(msg.get('proxy_codecs'))}
+            self.note_peer(self.current_proxy['peer'], self.current_proxy['codec'], msg.get('proxy_codecs'))
+            self.relay_subscribe(self.current_proxy)
+        elif t == 'NO_PROXY':
+            # our proxy left and no other has room: talk to the server directly
+            self.current_proxy = None
+            rc, self.relay_conn = self.relay_conn, None
+            if rc is not None:
+                rc.keepalive = False
+        elif t == 'PROXY_FOR':
+            self.proxy_targets.add(msg.get('client_id'))
+        elif t == 'PROXY_DROP':
+            # the server moved this client to another proxy
+            self.proxy_targets.discard(msg.get('client_id'))
+            if self.downstream.pop(msg.get('client_id'), None) is not None:
+                self.announce_interest()
+        elif t == 'JOINED':
+            ch = msg.get('channel')
+            if msg.get('ok'):
+                self.window(ch).skip_to(msg.get('seq', 0))
+                self.channels.add(ch)
+                self.announce_interest()
+            self.chat_queue.put(('JOINED', ch, bool(msg.get('ok'))))
+        elif t == 'LEFT':
+            self.channels.discard(msg.get('channel'))
+            self.announce_interest()
+            self.chat_queue.put(('LEFT', msg.get('channel')))
+        elif t == 'CLIENT_LIST':
+            cl = msg.get('clients', [])
+            threading.Thread(target=self.perform_latency_selection, args=(cl,), daemon=True).start()
+        elif t == 'CHAT':
+            self.on_chat(msg)
+        elif t == 'RELAY_ACK':
+            rc = self.relay_conn
+            if not msg.get('ok') and rc is not None and rc.proxy_id == msg.get('proxy_id'):
+                # server refused (e.g. it would form a loop); it keeps delivering directly
+                self.relay_conn = None
+                rc.keepalive = False
+        elif t in ('MEASURE_REPLY','PONG','STATS_REPLY'):
+            self.server_pending.resolve(msg.get('req_id'), msg)
+
+    def window(self, channel):
+        w = self.windows.get(channel)
+        if w is None:
+            w = self.windows.setdefault(channel, SeqWindow())
+        return w
+
+    def on_chat(self, msg):
+        # Deliver each chat once, whichever path it arrived by, then pass it on
+        # to the downstream clients that follow its channel.
+        channel = msg.get('channel', DEFAULT_CHANNEL)
+        seq = msg.get('seq')
+        if seq is not None and not self.window(channel).add(seq):
+            return
+        if channel in self.channels:
+            self.chat_queue.put(('CHAT', msg.get('from_name'), msg.get('text'), channel))
+        if self.downstream:
+            encoded = {}
+            pushed = 0
+            for out, wire, chans in list(self.downstream.values()):
+                if channel not in chans:
+                    continue
+                key = (wire, out.deflate is not None)
+                data = encoded.get(key)
+                if data is None:
+                    data = wire.encode(msg)
+                    encoded[key] = codec.compress_shared(data) if key[1] else data
+                out.push(data)
+                pushed += 1
+            metrics.incr('relay.pushed', pushed)
+
+    def join(self, channel):
+        """Ask the server to add us to channel; JOINED confirms it."""
+        self.send_server({'type':'JOIN', 'channel': channel})
+
+    def leave(self, channel):
+        self.send_server({'type':'LEAVE', 'channel': channel})
+
+    def interest(self):
+        # Channels our proxy has to pass us: ours and those of our subscribers.
+        wanted = set(self.channels)
+        for _, _, chans in list(self.downstream.values()):
+            wanted |= chans
+        return sorted(wanted)
+
+    def announce_interest(self):
+        # Relay mode: re-subscribe with the new channel list when it changes.
+        # Peer workers call this concurrently, hence the lock.
+        rc = self.relay_conn
+        if rc is None:
+            return
+        with self.interest_lock:
+            wanted = self.interest()
+            if wanted != getattr(rc, 'channels', None):
+                rc.channels = wanted
+                rc.request({'type':'RELAY_SUBSCRIBE', 'client_id': self.id, 'channels': wanted})
+
+    def relay_subscribe(self, proxy):
+        # Relay mode: keep a persistent link to our proxy and let it push chats to us.
+        if self.delivery != 'relay' or self.id is None:
+            return
+        conn = self.pool.get(proxy['peer'], proxy.get('codec', JSON))
+        old = self.relay_conn
+        if old is not None and old is not conn:
+            self.relay_conn = None
+            old.keepalive = False
+            self.send_server({'type':'RELAY_LOST', 'proxy_id': old.proxy_id})
+        wanted = self.interest()
+        fut = conn.request({'type':'RELAY_SUBSCRIBE', 'client_id': self.id, 'channels': wanted})
+        fut.add_done_callback(lambda f: self._relay_subscribed(f, proxy, conn, wanted))
+
+    def _relay_subscribed(self, fut, proxy, conn, wanted):
+        try:
+            ok = fut.result().get('ok')
+        except Exception:
+            ok = False
+        cp = getattr(self, 'current_proxy', None)
+        if ok and cp is not None and cp['id'] == proxy['id']:
+            conn.keepalive = True
+            conn.proxy_id = proxy['id']
+            conn.channels = wanted
+            self.relay_conn = conn
+            self.send_server({'type':'RELAY_READY', 'proxy_id': proxy['id']})
+            self.announce_interest()    # in case they changed meanwhile
+
+    def relay_closed(self, conn):
+        # Pool callback: if our relay link dropped, go back to direct delivery
+        # and try the same proxy once more.
+        if conn is self.relay_conn:
+            self.relay_conn = None
+            conn.keepalive = False
+            self.send_server({'type':'RELAY_LOST', 'proxy_id': conn.proxy_id})
+            t = threading.Timer(RELAY_RETRY, self._relay_retry, (getattr(self, 'current_proxy', None),))
+            t.daemon = True
+            t.start()
+
+    def _relay_retry(self, proxy):
+        cp = getattr(self, 'current_proxy', None)
+        if proxy is not None and cp is not None and cp['id'] == proxy['id'] and self.relay_conn is None:
+            self.relay_subscribe(proxy)
+
+    def perform_latency_selection(self, client_list):
+        # Cascade: lowest peer RTT -> lowest proxy-to-server RTT -> lowest chained
+        # round trip -> random. Each round probes its peers concurrently and the
+        # whole selection shares one deadline.
+        # Steady, recent estimates from the latency cache stand in for probes.
+        t_start = time.time()
+        deadline = t_start + SELECTION_DEADLINE
+        probes = cached = 0
+        results = []
+        for entry in client_list:
+            r = {'id': entry['id'], 'peer': tuple(entry['peer']), 'name': entry.get('name'),
+                 'codec': self.peer_codec(entry.get('codecs')), 'samples': []}
+            self.note_peer(r['peer'], r['codec'], entry.get('codecs'))
+            if self.latency.fresh(r['peer'], t_start):
+                r['rtt'] = self.latency.get(r['peer'], t_start).min_rtt
+                r['samples'].append(r['rtt'])
+                r['cached'] = True
+                cached += 1
+            results.append(r)
+        if not results:
+            return
+
+        pool = ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(results)))
+        try:
+            # Round 1: peer RTT. Every peer gets one sample; further samples only
+            # go to peers still within CLEAR_MARGIN_MS of the leader.
+            wave = [r for r in results if not r.get('cached')]
+            for _ in range(PROBE_SAMPLES):
+                if not wave:
+                    break
+                rtts = self._probe_wave(pool, [(self.ping_peer, r['peer'][0], r['peer'][1],
+                                                 self._probe_timeout(1.0, deadline), r['codec'])
+                                                for r in wave], deadline)
+                probes += len(wave)
+                for r, rtt in zip(wave, rtts):
+                    if rtt is None:
+                        metrics.incr('probe.lost')
+                    else:
+                        metrics.observe('probe.peer_rtt_ms', rtt)
+                    r['samples'].append(rtt)
+                    ok = [s for s in r['samples'] if s is not None]
+                    r['rtt'] = min(ok) if ok else float('inf')
+                wave = [r for r in results if not r.get('cached') and r['samples'][-1] is not None
+                        and _in_contention(r, results)]
+                if not wave or time.time() >= deadline:
+                    break
+
+            # let the server place us among the peers we measured
+            self.send_server({'type':'RTT_REPORT',
+                              'rtts': [[r['id'], r['rtt']] for r in results if r['rtt'] < float('inf')]})
+
+            results.sort(key=lambda x: x['rtt'])
+            best = results[0]['rtt']
+            candidates = [r for r in results if r['rtt'] == best or abs(r['rtt'] - best) < 1e-6]
+
+            if len(candidates) == 1:
+                chosen = candidates[0]['id']
+            else:
+                # Rounds 2 and 3 share one MEASURE_SERVER per candidate: the proxy
+                # reports its server RTT, and the elapsed time is the chained total.
+                stale = [c for c in candidates if not (self.latency.fresh((c['peer'], 'server'))
+                                                       and self.latency.fresh((c['peer'], 'chain')))]
+                measured = dict(zip([c['id'] for c in stale],
+                                    self._probe_wave(pool, [(self.measure_via_peer, c['peer'],
+                                                             self._probe_timeout(3.0, deadline), c['codec'])
+                                                            for c in stale], deadline)))
+                probes += len(stale)
+                server_rtts = []
+                for c in candidates:
+                    if c['id'] in measured:
+                        m = measured[c['id']]
+                        if m is None or m[0] == float('inf'):
+                            metrics.incr('probe.lost')
+                        else:
+                            metrics.observe('probe.server_rtt_ms', m[0])
+                            metrics.observe('probe.chain_ms', m[1])
+                    else:
+                        m = (self.latency.get((c['peer'], 'server')).min_rtt,
+                             self.latency.get((c['peer'], 'chain')).min_rtt)
+                        cached += 1
+                    server_rtt, total = m or (float('inf'), float('inf'))
+                    server_rtts.append({'id': c['id'], 'peer': c['peer'], 'server_rtt': server_rtt,
+                                        'local_rtt': c['rtt'], 'total': total})
+
+                server_rtts.sort(key=lambda x: x['server_rtt'])
+                best2 = server_rtts[0]['server_rtt']
+                candidates2 = [r for r in server_rtts if r['server_rtt'] == best2 or abs(r['server_rtt'] - best2) < 1e-6]
+
+                if len(candidates2) == 1:
+                    chosen = candidates2[0]['id']
+                else:
+                    candidates2.sort(key=lambda x: x['total'])
+                    best3 = candidates2[0]['total']
+                    bests = [r for r in candidates2 if r['total'] == best3 or abs(r['total'] - best3) < 1e-6]
+                    chosen = bests[0]['id'] if len(bests) == 1 else random.choice(bests)['id']
+        finally:
+            # probes still running at the deadline are abandoned, not waited for
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        elapsed = (time.time() - t_start) * 1000.0
+        self.last_selection = {'chosen': chosen, 'elapsed_ms': elapsed, 'probes': probes, 'cached': cached}
+        metrics.observe('selection.ms', elapsed)
+        metrics.observe('selection.probes', probes)
+        metrics.incr('selection.cached', cached)
+        log.info('selection', "Chose proxy {proxy} in {elapsed:.0f} ms using {probes} probes ({cached} cached)",
+                 proxy=chosen, elapsed=elapsed, probes=probes, cached=cached)
+
+        for e in client_list:
+            if e['id'] == chosen:
+                self.current_proxy = {'id': chosen, 'peer': tuple(e['peer']), 'name': e.get('name'),
+                                      'codec': self.peer_codec(e.get('codecs'))}
+                break
+        # the server confirms with USE_PROXY, which also starts the relay subscription
+        self.send_server({'type':'CHOICE', 'chosen_id': chosen})
+
+    def background_probe(self):
+        # Low-rate refresh of the latency cache: every BG_PROBE_INTERVAL, ping the
+        # known peer with the oldest estimate. Peers that stop answering are dropped.
+        while not self.stop:
+            time.sleep(BG_PROBE_INTERVAL)
+            self.latency.expire()
+            addr = self.latency.stalest(list(self.known_peers))
+            if addr is None:
+                continue
+            self.ping_peer(addr[0], addr[1], 1.0, self.known_peers.get(addr, JSON))
+            est = self.latency.get(addr)
+            if est is not None and est.loss >= BG_DROP_LOSS:
+                self.known_peers.pop(addr, None)
+
+    def report_server_rtt(self):
+        # One PING to the server, reported as RTT_REPORT (node 0 is the server).
+        t0 = time.time()
+        try:
+            self.request_server({'type':'PING'}).result(MEASURE_TIMEOUT)
+        except Exception:
+            return
+        self.send_server({'type':'RTT_REPORT', 'rtts': [[0, (time.time() - t0) * 1000.0]]})
+
+    def _probe_wave(self, pool, jobs, deadline):
+        # Run (fn, *args) jobs concurrently; anything unfinished at the deadline counts as None.
+        futures = [pool.submit(*job) for job in jobs]
+        done, _ = wait(futures, timeout=max(0.0, deadline - time.time()))
+        return [f.result() if f in done else None for f in futures]
+
+    def _probe_timeout(self, cap, deadline):
+        return max(0.01, min(cap, deadline - time.time()))
+
+    def measure_via_peer(self, peer, timeout=3.0, wire=JSON):
+        """Ask a peer to time its server link; returns (server_rtt_ms, total_ms) or None."""
+        try:
+            conn = self.pool.get(peer, wire)
+            end = time.time() + timeout     # one budget for connecting and the reply
+            conn.open(timeout)
+            t0 = time.time()
+            resp = conn.call({'type':'FORWARD_TO_SERVER','action':'MEASURE_SERVER'}, max(0.0, end - t0))
+            t1 = time.time()
+        except Exception:
+            self.latency.sample((tuple(peer), 'chain'), None)
+            return None
+        server_rtt, total = resp.get('server_rtt_ms', float('inf')), (t1 - t0) * 1000.0
+        self.latency.sample((tuple(peer), 'server'), server_rtt if server_rtt != float('inf') else None)
+        self.latency.sample((tuple(peer), 'chain'), total)
+        return server_rtt, total
+
+    def peer_codec(self, offered):
+        return codec.negotiate(offered, self.wire_codecs)
+
+    def offered(self):
+        # REGISTER `codecs`: what we can read, which the server passes on to peers.
+        return list(self.wire_codecs) + ([codec.DEFLATE] if self.compress else [])
+
+    def note_peer(self, addr, wire, offered):
+        self.known_peers[addr] = wire
+        if self.compress and codec.DEFLATE in (offered or ()):
+            self.deflate_peers.add(addr)
+
+    def ping_peer(self, ip, port, timeout=1.0, wire=JSON):
+        try:
+            conn = self.pool.get((ip,port), wire)
+            end = time.time() + timeout     # one budget for connecting and the reply
+            conn.open(timeout)
+            t0 = time.time()
+            conn.call({'type':'PING'}, max(0.0, end - t0))
+            t1 = time.time()
+        except Exception:
+            self.latency.sample((ip, port), None)
+            return None
+        rtt = (t1 - t0) * 1000.0
+        self.latency.sample((ip, port), rtt)
+        return rtt
+
+    def send_chat(self, text, channel=DEFAULT_CHANNEL):
+        nm = self.name if not self.use_local_ip else self.get_local_ip()
+        cp = getattr(self, 'current_proxy', None)
+        if cp:
+            # Pipelined over the pooled proxy connection; falls back to the
+            # server if the proxy can't take it.
+            req = {'type':'FORWARD_TO_SERVER', 'action':'FORWARD_CHAT', 'orig_id': self.id, 'name': nm, 'text': text}
+            if channel != DEFAULT_CHANNEL:
+                req['channel'] = channel
+            fut = self.pool.request(cp['peer'], req, cp.get('codec', JSON), FORWARD_TIMEOUT)
+            fut.add_done_callback(lambda f: self._forward_done(f, text, nm, channel))
+            return fut
+        self.send_chat_direct(text, nm, channel)
+
+    def _forward_done(self, fut, text, nm, channel):
+        try:
+            ok = fut.result().get('ok')
+        except Exception:
+            ok = False
+        if not ok:
+            self.send_chat_direct(text, nm, channel)
+
+    def send_chat_direct(self, text, nm, channel=DEFAULT_CHANNEL):
+        msg = {'type':'CHAT', 'text': text, 'name': nm}
+        if channel != DEFAULT_CHANNEL:
+            msg['channel'] = channel
+        self.send_server(msg)
+
+# ---------- Headless mode ----------
+def run_headless(client, script=None, out=None):
+    """Drive a Client without a GUI.
+
+    Lines from `script` (a file path) or stdin are sent as chats once the
+    client has an id; `/sleep SECONDS` pauses, `/join CHANNEL` joins a
+    channel and sends the following lines there, `/leave CHANNEL` leaves one
+    and `/quit` exits. Every CHAT received is written to `out` (stdout) as
+    one JSON line. When the input runs out the client keeps running, e.g. as
+    a relay, until interrupted.
+    """
+    out = out or sys.stdout
+    channel = DEFAULT_CHANNEL
+
+    def printer():
+        while True:
+            item = client.chat_queue.get()
+            if isinstance(item, tuple) and item[0] == 'CHAT':
+                rec = {'from_name': item[1], 'text': item[2]}
+                if item[3] != DEFAULT_CHANNEL:
+                    rec['channel'] = item[3]
+                out.write(json.dumps(rec) + '\n')
+                out.flush()
+
+    threading.Thread(target=printer, daemon=True).start()
+    while client.id is None:
+        time.sleep(0.05)
+
+    src = open(script, encoding='utf-8') if script else sys.stdin
+    try:
+        for line in src:
+            line = line.rstrip('\n')
+            if line.startswith('/sleep'):
+                time.sleep(float(line.split()[1]))
+            elif line == '/quit':
+                return
+            elif line.startswith('/join '):
+                channel = line.split()[1]
+                client.join(channel)
+            elif line.startswith('/leave '):
+                client.leave(line.split()[1])
+                if line.split()[1] == channel:
+                    channel = DEFAULT_CHANNEL
+            elif line.strip():
+                client.send_chat(line.strip(), channel)
+    finally:
+        if script:
+            src.close()
+    while True:
+        time.sleep(3600)
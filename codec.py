@@ -0,0 +1,282 @@
+# codec.py
+# Wire codecs: newline JSON (always understood) and the compact binary framing
+# peers can negotiate in REGISTER/ASSIGN_ID.
+#
+# Binary frame:  0xB1 | u8 type code | u32 body length | body
+# A JSON frame always starts with '{', so a reader can tell the two apart
+# frame by frame and legacy JSON clients can share the same port.
+#
+# Compressed frame:  0xB2 | u8 kind | u32 body length | raw deflate
+# sent only to a side that offered 'deflate' (REGISTER `codecs`, answered by
+# ASSIGN_ID `compress`). The body inflates to one or more whole frames of
+# either kind above. Z_STREAM bodies continue the connection's own deflate
+# stream, sync-flushed per frame, so repeated keys and names cost a few bits;
+# Z_SHARED bodies stand alone against the preset ZDICT, so one copy can go
+# to every recipient of a broadcast.
+
+import json, struct, zlib
+
+from framing import LineFramer, FrameTooLarge
+
+MAGIC = 0xB1
+ZMAGIC = 0xB2
+HEADER = struct.Struct('!BBI')
+Z_STREAM = 1            # compressed frame kinds
+Z_SHARED = 2
+DEFLATE = 'deflate'     # offered next to the codec names when compression is wanted
+COMPRESS_MIN = 64       # frames shorter than this (PING, PONG, acks) go out as they are
+COMPRESS_LEVEL = 6
+ZWBITS = 12             # 4 KB window: about 30 KB of deflate state per compressing connection
+ZMEMLEVEL = 5
+SYNC_TAIL = b'\x00\x00\xff\xff'
+U32 = struct.Struct('!I')
+NO_ID = 0xFFFFFFFF      # packed stand-in for a missing (None) id
+DEFAULT_CHANNEL = 'general'     # channel of a CHAT / FORWARDED_CHAT without a `channel` key
+
+# code -> (type, fields); each field is (key, kind) with kind
+#   'i' u32 id (None allowed), 'f' float64, 's' u32-length-prefixed UTF-8.
+# Code 0 carries any other message as a JSON body.
+SCHEMAS = {
+    1: ('PING', ()),
+    2: ('PONG', (('ts', 'f'),)),
+    3: ('CHAT', (('from_id', 'i'), ('from_name', 's'), ('text', 's'))),
+    4: ('FORWARDED_CHAT', (('orig_id', 'i'), ('name', 's'), ('text', 's'))),
+    5: ('MEASURE_REQUEST', ()),
+    6: ('MEASURE_REPLY', (('ts', 'f'),)),
+    7: ('CHOICE', (('chosen_id', 'i'),)),
+    8: ('PROXY_FOR', (('client_id', 'i'),)),
+    9: ('CHAT', (('text', 's'), ('name', 's'))),
+    10: ('PING', (('req_id', 'i'),)),
+    11: ('PONG', (('ts', 'f'), ('req_id', 'i'))),
+    12: ('MEASURE_REQUEST', (('req_id', 'i'),)),
+    13: ('MEASURE_REPLY', (('ts', 'f'), ('req_id', 'i'))),
+    14: ('CHAT', (('from_id', 'i'), ('from_name', 's'), ('text', 's'), ('seq', 'i'))),
+    15: ('CHAT', (('from_id', 'i'), ('from_name', 's'), ('text', 's'), ('seq', 'i'), ('channel', 's'))),
+    16: ('CHAT', (('text', 's'), ('name', 's'), ('channel', 's'))),
+    17: ('FORWARDED_CHAT', (('orig_id', 'i'), ('name', 's'), ('text', 's'), ('channel', 's'))),
+}
+# (type, sorted keys) -> code, so a message only packs when its keys match exactly
+_BY_SHAPE = {(t, tuple(sorted(k for k, _ in fields))): code
+             for code, (t, fields) in SCHEMAS.items()}
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8') + b'\n'
+
+
+class BinaryCodec:
+    name = 'bin1'
+
+    def encode(self, obj):
+        keys = tuple(sorted(k for k in obj if k != 'type'))
+        code = _BY_SHAPE.get((obj.get('type'), keys))
+        if code is not None:
+            try:
+                body = b''.join(_pack(kind, obj[k]) for k, kind in SCHEMAS[code][1])
+                return HEADER.pack(MAGIC, code, len(body)) + body
+            except (TypeError, ValueError, AttributeError, struct.error, UnicodeError):
+                pass
+        body = json.dumps(obj).encode('utf-8')
+        return HEADER.pack(MAGIC, 0, len(body)) + body
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {c.name: c for c in (JSON, BINARY)}
+CAPABILITIES = frozenset(CODECS) | {DEFLATE}   # what a peer may list in `codecs`
+
+# Preset dictionary for both kinds of compressed frame: the keys and values
+# chat traffic repeats, most common last (deflate reaches the end cheapest).
+ZDICT = (b'"type": "RTT_REPORT", "rtts": [[0, "type": "CLIENT_LIST", "clients": [{"id": '
+         b'"peer": ["127.0.0.1", "codecs": ["bin1", "deflate"], "type": "FORWARD_CHAT_RESULT", '
+         b'"ok": true, "req_id": "type": "FORWARD_TO_SERVER", "action": "FORWARDED_CHAT", '
+         b'"type": "FORWARDED_BATCH", "chats": [["general"], "orig_id": "name": '
+         b'{"type": "CHAT", "from_id": "from_name": "text": "seq": "channel": "general"}\n')
+
+
+def _compressor():
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -ZWBITS, ZMEMLEVEL,
+                            zlib.Z_DEFAULT_STRATEGY, ZDICT)
+
+
+class Deflater:
+    """The sending half of one compressed connection.
+
+    compress() runs encoded frames through the connection's deflate stream
+    and returns a Z_STREAM frame, so calls must happen in the order their
+    results are written. Frames under `threshold`, and frames that are
+    already compressed (compress_shared), pass through unchanged.
+    """
+
+    def __init__(self, threshold=COMPRESS_MIN):
+        self.z = _compressor()
+        self.threshold = threshold
+
+    def compress(self, data):
+        if len(data) < self.threshold or data[0] == ZMAGIC:
+            return data
+        # every sync flush ends in the same empty block; the reader adds it back
+        body = (self.z.compress(data) + self.z.flush(zlib.Z_SYNC_FLUSH))[:-len(SYNC_TAIL)]
+        return HEADER.pack(ZMAGIC, Z_STREAM, len(body)) + body
+
+
+def compress_shared(data, threshold=COMPRESS_MIN):
+    """data as a Z_SHARED frame any compressing connection can carry, or
+    unchanged when it is short or doesn't shrink."""
+    if len(data) < threshold:
+        return data
+    z = _compressor()
+    body = z.compress(data) + z.flush()
+    if HEADER.size + len(body) >= len(data):
+        return data
+    return HEADER.pack(ZMAGIC, Z_SHARED, len(body)) + body
+
+
+def negotiate(offered, allowed=('bin1',)):
+    """Pick the first codec both sides allow; JSON if the peer offered nothing."""
+    for name in offered or ():
+        if name in allowed and name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def _pack(kind, value):
+    if kind == 'i':
+        return U32.pack(NO_ID if value is None else value)
+    if kind == 'f':
+        return struct.pack('!d', value)
+    raw = value.encode('utf-8')
+    return U32.pack(len(raw)) + raw
+
+
+def decode_binary(code, body):
+    if code == 0:
+        return json.loads(body)
+    t, fields = SCHEMAS[code]
+    msg = {'type': t}
+    pos = 0
+    for key, kind in fields:
+        if kind == 'f':
+            msg[key] = struct.unpack_from('!d', body, pos)[0]
+            pos += 8
+            continue
+        n = U32.unpack_from(body, pos)[0]
+        pos += 4
+        if kind == 'i':
+            msg[key] = None if n == NO_ID else n
+        else:
+            msg[key] = body[pos:pos + n].decode('utf-8')
+            pos += n
+    return msg
+
+
+class FrameReader(LineFramer):
+    """LineFramer that also accepts binary frames and yields decoded dicts.
+
+    `codec` is the codec of the most recent message, so a handler can answer
+    in whatever encoding the peer used; `size` is its length on the wire
+    (before compression). Compressed frames are inflated into `inner`, a
+    second reader that is drained first; `compressed` turns True with the
+    first one, and tells a peer link it may compress its replies.
+    """
+
+    codec = JSON
+    size = 0
+    compressed = False
+    inner = None
+    inflater = None
+
+    def next_msg(self):
+        while True:
+            if self.inner is not None:
+                msg = self.inner.next_msg()
+                if msg is not None:
+                    self.codec, self.size = self.inner.codec, self.inner.size
+                    return msg
+            if self.start < self.end and self.buf[self.start] == ZMAGIC:
+                if self.end - self.start < HEADER.size:
+                    return None
+                _, kind, length = HEADER.unpack_from(self.buf, self.start)
+                if length > self.max_frame:
+                    raise FrameTooLarge(length)
+                stop = self.start + HEADER.size + length
+                if self.end < stop:
+                    return None
+                body = bytes(self.buf[self.start + HEADER.size:stop])
+                self.start = self.scan = stop
+                self._inflate(kind, body)
+                continue
+            if self.start < self.end and self.buf[self.start] == MAGIC:
+                if self.end - self.start < HEADER.size:
+                    return None
+                _, code, length = HEADER.unpack_from(self.buf, self.start)
+                if length > self.max_frame:
+                    raise FrameTooLarge(length)
+                stop = self.start + HEADER.size + length
+                if self.end < stop:
+                    return None
+                body = bytes(self.buf[self.start + HEADER.size:stop])
+                self.start = self.scan = stop
+                try:
+                    msg = decode_binary(code, body)
+                except Exception:
+                    continue
+                self.codec = BINARY
+                self.size = HEADER.size + length
+                return msg
+            line = self.next_line()
+            if line is None:
+                return None
+            try:
+                msg = json.loads(line)
+            except Exception:
+                continue
+            self.codec = JSON
+            self.size = len(line) + 1
+            return msg
+
+    def _inflate(self, kind, body):
+        if kind == Z_STREAM:
+            if self.inflater is None:
+                self.inflater = zlib.decompressobj(-ZWBITS, ZDICT)
+            d = self.inflater
+            body += SYNC_TAIL
+        elif kind == Z_SHARED:
+            d = zlib.decompressobj(-ZWBITS, ZDICT)
+        else:
+            return
+        try:
+            plain = d.decompress(body, self.max_frame)
+        except zlib.error:
+            # the stream can't be resynchronised; end the connection
+            raise ConnectionError('corrupt compressed frame')
+        if d.unconsumed_tail:
+            raise FrameTooLarge(self.max_frame)
+        if self.inner is None:
+            self.inner = FrameReader(max_frame=self.max_frame)
+        self.inner.feed(plain)
+        self.compressed = True
+
+    def read_msg(self):
+        """Block until one message arrives; None if the peer closed first."""
+        while True:
+            msg = self.next_msg()
+            if msg is not None:
+                return msg
+            if not self.fill():
+                return None
+
+    def messages(self):
+        """Yield messages until EOF, a socket error or an oversized frame."""
+        try:
+            while True:
+                msg = self.next_msg()
+                if msg is not None:
+                    yield msg
+                elif not self.fill():
+                    return
+        except (OSError, FrameTooLarge):
+            return
@@ -0,0 +1,87 @@
+# framing.py
+# Incremental newline framing shared by server.py and client.py.
+
+MAX_FRAME = 1 << 20     # longest line accepted before the connection is dropped
+RECV_SIZE = 65536
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+class LineFramer:
+    """Splits a byte stream into newline-terminated frames.
+
+    Bytes are received straight into one growing bytearray with recv_into()
+    (or appended with feed()), and every search for b'\\n' resumes where the
+    previous one stopped, so the cost is linear in the bytes received no
+    matter how they are chunked. Consumed bytes are compacted away lazily.
+    """
+
+    def __init__(self, sock=None, max_frame=MAX_FRAME):
+        self.sock = sock
+        self.max_frame = max_frame
+        self.buf = bytearray(RECV_SIZE)
+        self.start = 0      # first byte of the frame being assembled
+        self.scan = 0       # bytes before this offset contain no newline
+        self.end = 0        # end of valid data in buf
+
+    def _reserve(self, n):
+        if self.start == self.end:
+            self.start = self.scan = self.end = 0
+        elif self.start and len(self.buf) - self.end < n:
+            keep = self.end - self.start
+            self.buf[:keep] = self.buf[self.start:self.end]
+            self.scan -= self.start
+            self.start, self.end = 0, keep
+        if len(self.buf) - self.end < n:
+            self.buf.extend(bytes(n))
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def fill(self):
+        """Read once from the socket; returns the byte count (0 on EOF)."""
+        self._reserve(RECV_SIZE)
+        with memoryview(self.buf) as mv, mv[self.end:] as tail:
+            n = self.sock.recv_into(tail)
+        self.end += n
+        return n
+
+    def next_line(self):
+        """Return the next complete frame (without b'\\n'), or None."""
+        i = self.buf.find(b'\n', self.scan, self.end)
+        if i < 0:
+            self.scan = self.end
+            if self.end - self.start > self.max_frame:
+                raise FrameTooLarge(self.end - self.start)
+            return None
+        # a whole oversized frame can arrive in one read, ending in its b'\n'
+        if i - self.start > self.max_frame:
+            raise FrameTooLarge(i - self.start)
+        line = bytes(self.buf[self.start:i])
+        self.start = self.scan = i + 1
+        return line
+
+    def read_line(self):
+        """Block until one frame arrives; None if the peer closed first."""
+        while True:
+            line = self.next_line()
+            if line is not None:
+                return line
+            if not self.fill():
+                return None
+
+    def lines(self):
+        """Yield frames until EOF, a socket error or an oversized frame."""
+        try:
+            while True:
+                line = self.next_line()
+                if line is not None:
+                    yield line
+                elif not self.fill():
+                    return
+        except (OSError, FrameTooLarge):
+            return
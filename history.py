@@ -0,0 +1,123 @@
+# history.py
+# Bounded, sequence-numbered chat history for RESUME.
+#
+# Every channel numbers its chats on its own (`seq`), so a client can tell
+# a gap in the channels it follows from chats it was never meant to get. The
+# newest HISTORY_SIZE frames of all channels share one in-memory ring. With a
+# segment file, every frame is also appended as one JSON line to a
+# preallocated, memory-mapped file; on startup the ring and the sequence
+# counters are rebuilt from it. A full segment is renamed to `<path>.1` and a
+# fresh one started.
+
+import os, json, mmap, threading
+
+from codec import DEFAULT_CHANNEL
+
+HISTORY_SIZE = 4096             # frames kept for replay
+SEGMENT_BYTES = 16 << 20        # size of one memory-mapped segment file
+
+
+class ChatHistory:
+    """Ring of the last `size` chat frames, optionally mirrored to a segment file.
+
+    A frame without a `channel` key belongs to DEFAULT_CHANNEL.
+
+    `lock` orders appends against replays: broadcast_chat holds it while it
+    numbers, records and sends a frame, and RESUME holds it while it attaches
+    a connection and replays, so a resuming client misses nothing in between.
+    """
+
+    def __init__(self, size=HISTORY_SIZE, path=None, segment_bytes=SEGMENT_BYTES):
+        self.size = size
+        self.ring = [None] * size
+        self.count = 0              # frames recorded; the next goes to ring[count % size]
+        self.last = {}              # channel -> newest seq recorded in it
+        self.lock = threading.Lock()
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.map = None
+        self.offset = 0
+        if path:
+            self._open_segment()
+
+    def last_seq(self, channel=DEFAULT_CHANNEL):
+        """Newest seq in channel (0: none yet)."""
+        return self.last.get(channel, 0)
+
+    def append(self, frame):
+        """Record a frame carrying its channel's next seq. Caller holds lock."""
+        self._record(frame)
+        if self.map is not None:
+            line = json.dumps(frame).encode('utf-8') + b'\n'
+            if self.offset + len(line) > self.segment_bytes:
+                self._rotate()
+            self.map[self.offset:self.offset + len(line)] = line
+            self.offset += len(line)
+
+    def since(self, marks):
+        """Frames of the channels in marks (channel -> last seq held) that are
+        newer than their mark, oldest first. The bool is False when some were
+        already evicted (those channels then start at their oldest kept frame)."""
+        frames, oldest = [], {}
+        for i in range(max(0, self.count - self.size), self.count):
+            frame = self.ring[i % self.size]
+            channel = frame.get('channel', DEFAULT_CHANNEL)
+            if channel in marks:
+                oldest.setdefault(channel, frame['seq'])
+                if frame['seq'] > marks[channel]:
+                    frames.append(frame)
+        complete = all(self.last_seq(ch) <= mark or (ch in oldest and oldest[ch] <= mark + 1)
+                       for ch, mark in marks.items())
+        return frames, complete
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+    def _record(self, frame):
+        self.ring[self.count % self.size] = frame
+        self.count += 1
+        self.last[frame.get('channel', DEFAULT_CHANNEL)] = frame['seq']
+
+    # ---- segment file ----
+
+    def _open_segment(self):
+        # Replay whatever an earlier run left behind, then continue after it.
+        for old in (self.path + '.1', self.path):
+            if os.path.exists(old):
+                with open(old, 'rb') as f:
+                    for line in f.read().split(b'\n'):
+                        line = line.rstrip(b'\0')
+                        if not line:
+                            continue
+                        try:
+                            frame = json.loads(line)
+                        except ValueError:
+                            continue
+                        if frame.get('seq', 0) > self.last_seq(frame.get('channel', DEFAULT_CHANNEL)):
+                            self._record(frame)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self.segment_bytes:
+                os.ftruncate(fd, self.segment_bytes)
+            self.map = mmap.mmap(fd, self.segment_bytes)
+        finally:
+            os.close(fd)
+        end = self.map.find(b'\0')
+        self.offset = self.segment_bytes if end < 0 else end
+        if self.offset + 1 >= self.segment_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.map.flush()
+        self.map.close()
+        os.replace(self.path, self.path + '.1')
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.segment_bytes)
+            self.map = mmap.mmap(fd, self.segment_bytes)
+        finally:
+            os.close(fd)
+        self.offset = 0
@@ -0,0 +1,94 @@
+# latency.py
+# Per-peer RTT estimates kept across proxy selections.
+#
+# Each key (a peer address, or (address, kind) for derived measurements) keeps
+# an RFC 6298 style smoothed RTT and deviation, the minimum of its recent
+# samples and a loss rate. Entries not updated for EST_TTL seconds are dropped.
+
+import threading, time
+from collections import deque
+
+EST_ALPHA = 0.125       # smoothed-RTT gain
+EST_BETA = 0.25         # deviation gain
+LOSS_GAIN = 0.2         # weight of one probe in the loss rate
+MIN_WINDOW = 8          # samples the minimum RTT is taken over
+EST_TTL = 120.0         # seconds an estimate survives without a new sample
+FRESH_AGE = 20.0        # an estimate younger than this can replace a probe...
+FRESH_SAMPLES = 2       # ...once it has this many samples,
+FRESH_DEV = 0.5         # a deviation under this fraction of the RTT (or FRESH_DEV_MS)
+FRESH_DEV_MS = 1.0
+FRESH_LOSS = 0.2        # and a loss rate under this
+
+
+class Estimate:
+    __slots__ = ('srtt', 'rttvar', 'recent', 'loss', 'samples', 'updated')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+        self.recent = deque(maxlen=MIN_WINDOW)
+        self.loss = 0.0
+        self.samples = 0
+        self.updated = 0.0
+
+    @property
+    def min_rtt(self):
+        return min(self.recent) if self.recent else None
+
+
+class LatencyEstimator:
+    """Thread-safe key -> Estimate table with TTL expiry."""
+
+    def __init__(self, ttl=EST_TTL):
+        self.ttl = ttl
+        self.table = {}
+        self.lock = threading.Lock()
+
+    def sample(self, key, rtt, now=None):
+        """Record one probe result in milliseconds; None records a loss."""
+        now = time.time() if now is None else now
+        with self.lock:
+            est = self.table.get(key)
+            if est is None or now - est.updated > self.ttl:
+                est = self.table[key] = Estimate()
+            est.updated = now
+            if rtt is None:
+                est.loss += LOSS_GAIN * (1.0 - est.loss)
+                return
+            est.loss -= LOSS_GAIN * est.loss
+            est.samples += 1
+            est.recent.append(rtt)
+            if est.srtt is None:
+                est.srtt, est.rttvar = rtt, rtt / 2
+            else:
+                est.rttvar += EST_BETA * (abs(est.srtt - rtt) - est.rttvar)
+                est.srtt += EST_ALPHA * (rtt - est.srtt)
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            est = self.table.get(key)
+            if est is not None and now - est.updated > self.ttl:
+                del self.table[key]
+                return None
+            return est
+
+    def fresh(self, key, now=None):
+        """The estimate for key is recent and steady enough to skip probing."""
+        now = time.time() if now is None else now
+        est = self.get(key, now)
+        return (est is not None and est.samples >= FRESH_SAMPLES
+                and now - est.updated < FRESH_AGE and est.loss < FRESH_LOSS
+                and est.rttvar <= max(FRESH_DEV * est.srtt, FRESH_DEV_MS))
+
+    def stalest(self, keys):
+        """The key among keys whose estimate is oldest (missing counts as oldest)."""
+        with self.lock:
+            return min(keys, key=lambda k: self.table[k].updated if k in self.table else 0.0,
+                       default=None)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            for key in [k for k, e in self.table.items() if now - e.updated > self.ttl]:
+                del self.table[key]
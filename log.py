@@ -0,0 +1,188 @@
+# log.py
+# Structured, asynchronous logging for the server (and the client, on stderr).
+#
+#   log.info('register', "Registered client {id}", id=7)
+#
+# A call below the configured level is a no-op function (configure() rebinds
+# debug/info/warning/error), so disabled logging costs one empty call. An
+# enabled call only checks its event's sample budget and enqueues the record;
+# a writer thread formats and writes records in batches. If the writer falls
+# behind, the queue fills and new records are dropped rather than blocking
+# the caller.
+#
+# Formats: 'text' (the old "[server] ..." lines), 'json' (one object per
+# line) or 'bin' (codec.BINARY frames, readable with codec.FrameReader).
+
+import sys, os, json, time, threading, queue
+
+import codec
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+QUEUE_SIZE = 65536      # records waiting for the writer before new ones are dropped
+WRITE_BATCH = 256       # records formatted and written per write() call
+SUMMARY_INTERVAL = 5.0  # seconds between "suppressed N records" notes
+MAX_BYTES = 10 << 20    # rotate the log file past this size
+BACKUPS = 3             # rotated files kept: PATH.1 .. PATH.N
+
+_queue = None
+_writer = None
+_prefix = '[server]'
+_sample = {}            # event -> [budget per second, tokens, last refill]
+_suppressed = {}        # event -> records dropped by sampling since the last summary
+_dropped = [0]          # records dropped because the queue was full
+
+
+def _off(event, msg, **fields):
+    pass
+
+
+def _emitter(level):
+    def emit(event, msg, **fields):
+        bucket = _sample.get(event)
+        if bucket is not None:
+            now = time.monotonic()
+            bucket[1] = min(bucket[0], bucket[1] + (now - bucket[2]) * bucket[0])
+            bucket[2] = now
+            if bucket[1] < 1.0:
+                _suppressed[event] = _suppressed.get(event, 0) + 1
+                return
+            bucket[1] -= 1.0
+        try:
+            _queue.put_nowait((time.time(), level, event, msg, fields))
+        except queue.Full:
+            _dropped[0] += 1
+    return emit
+
+
+debug = info = warning = error = _off
+
+
+def configure(level='info', fmt='text', path=None, max_bytes=MAX_BYTES, backups=BACKUPS,
+              sample=None, prefix='[server]', stream=None):
+    """Start the writer and enable the levels at or above `level`.
+
+    `sample` maps an event name to the most records per second kept for it.
+    Without `path`, records go to `stream` (stdout).
+    """
+    global _queue, _writer, _prefix, debug, info, warning, error
+    close()
+    _prefix = prefix
+    _sample.clear()
+    for event, rate in (sample or {}).items():
+        _sample[event] = [float(rate), float(rate), time.monotonic()]
+    _queue = queue.Queue(QUEUE_SIZE)
+    sink = RotatingFile(path, max_bytes, backups) if path else Stream(stream or sys.stdout)
+    _writer = threading.Thread(target=_write_loop, args=(_queue, sink, fmt), daemon=True)
+    _writer.start()
+    threshold = LEVELS[level] if isinstance(level, str) else level
+    debug, info, warning, error = (_emitter(lv) if lv >= threshold else _off
+                                   for lv in (DEBUG, INFO, WARNING, ERROR))
+
+
+def close(timeout=2.0):
+    """Flush what is queued and stop the writer."""
+    global _queue, _writer, debug, info, warning, error
+    if _writer is not None:
+        debug = info = warning = error = _off
+        _queue.put(None)
+        _writer.join(timeout)
+    _queue = _writer = None
+
+
+def _format(record, fmt):
+    ts, level, event, msg, fields = record
+    if fmt == 'text':
+        try:
+            line = msg.format(**fields)
+        except (KeyError, IndexError, ValueError):
+            line = msg
+        if 'trace' in fields:
+            line += '\n' + str(fields['trace']).rstrip('\n')
+        return (f"{_prefix} {line}\n").encode('utf-8', 'replace')
+    obj = {'ts': round(ts, 6), 'level': LEVEL_NAMES.get(level, level), 'event': event, 'msg': msg}
+    obj.update((k, v if isinstance(v, (int, float, str, bool, list, dict, type(None))) else str(v))
+               for k, v in fields.items())
+    if fmt == 'bin':
+        return codec.BINARY.encode(obj)
+    return json.dumps(obj).encode('utf-8') + b'\n'
+
+
+def _write_loop(q, sink, fmt):
+    last_summary = time.monotonic()
+    while True:
+        try:
+            batch = [q.get(timeout=SUMMARY_INTERVAL)]
+        except queue.Empty:
+            batch = []
+        try:
+            while len(batch) < WRITE_BATCH:
+                batch.append(q.get_nowait())
+        except queue.Empty:
+            pass
+        done = None in batch
+        now = time.monotonic()
+        if done or now - last_summary >= SUMMARY_INTERVAL:
+            last_summary = now
+            for event, n in list(_suppressed.items()):
+                if n:
+                    _suppressed[event] -= n
+                    batch.append((time.time(), INFO, 'log', "suppressed {n} '{sampled}' records",
+                                  {'n': n, 'sampled': event}))
+            if _dropped[0]:
+                n, _dropped[0] = _dropped[0], 0
+                batch.append((time.time(), WARNING, 'log', "log queue full; dropped {n} records", {'n': n}))
+        if batch:
+            try:
+                sink.write(b''.join(_format(r, fmt) for r in batch if r is not None))
+            except Exception:
+                pass
+        if done:
+            sink.close()
+            return
+
+
+class Stream:
+    def __init__(self, stream):
+        self.stream = getattr(stream, 'buffer', stream)
+
+    def write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+
+    def close(self):
+        try:
+            self.stream.flush()
+        except Exception:
+            pass
+
+
+class RotatingFile:
+    """Append-only file rotated to PATH.1 .. PATH.backups past max_bytes."""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = open(path, 'ab')
+
+    def write(self, data):
+        self.f.write(data)
+        self.f.flush()
+        if self.max_bytes and self.f.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, 'ab')
+
+    def close(self):
+        self.f.close()
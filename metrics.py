@@ -0,0 +1,230 @@
+# metrics.py
+# In-process counters, gauges and histograms shared by the server and client.
+#
+#   metrics.incr('msg.in.CHAT')
+#   metrics.observe('broadcast.fanout_ms', 0.42)
+#
+# Every thread records into its own shard (two plain dicts reached through
+# threading.local), so recording takes no lock and threads never contend;
+# snapshot() merges the shards. Histograms are log-linear, SUB_BUCKETS buckets
+# per power of two, so a percentile is within about 1/(2*SUB_BUCKETS) of the
+# true value and a histogram stays small whatever it records.
+#
+# The numbers are served as a STATS_REPLY to a STATS message and, with
+# serve(), as plain text on a local port (`nc 127.0.0.1 PORT` or curl).
+
+import math, socket, threading, time
+from math import frexp
+
+SUB_BUCKETS = 8         # histogram buckets per power of two
+MIN_BUCKET = -(1 << 20) # bucket for values <= 0
+PERCENTILES = (50, 90, 99)
+
+_local = threading.local()
+_shards = []            # (thread, (counters, histograms)) for each thread that recorded something
+_retired = ({}, {})     # shards of threads that have exited, folded together
+_reg_lock = threading.Lock()
+_gauges = {}            # name -> callable returning a number or a dict of them
+_started = time.time()
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = ({}, {})
+        with _reg_lock:
+            _shards.append((threading.current_thread(), shard))
+            if len(_shards) % 64 == 0:
+                _fold_dead()
+        return shard
+
+
+def incr(name, n=1):
+    try:
+        counters = _local.shard[0]
+    except AttributeError:
+        counters = _shard()[0]
+    counters[name] = counters.get(name, 0) + n
+
+
+def observe(name, value):
+    try:
+        h = _local.shard[1][name]
+    except (AttributeError, KeyError):
+        h = _shard()[1].setdefault(name, [0, 0.0, value, {}])     # count, sum, max, bucket -> count
+    h[0] += 1
+    h[1] += value
+    if value > h[2]:
+        h[2] = value
+    if value > 0:
+        m, e = frexp(value)     # value = m * 2**e, 0.5 <= m < 1
+        b = e * SUB_BUCKETS + int((m - 0.5) * (2 * SUB_BUCKETS))
+    else:
+        b = MIN_BUCKET
+    buckets = h[3]
+    buckets[b] = buckets.get(b, 0) + 1
+
+
+def gauge(name, fn):
+    """Report fn() under name in every snapshot; a dict result adds name.<key> entries."""
+    _gauges[name] = fn
+
+
+def _bucket_value(b):
+    # midpoint of bucket b
+    if b == MIN_BUCKET:
+        return 0.0
+    e, s = divmod(b, SUB_BUCKETS)
+    return math.ldexp(0.5 + (s + 0.5) / (2 * SUB_BUCKETS), e)
+
+
+def _merge(dst, src):
+    counters, hists = dst
+    for k, v in list(src[0].items()):
+        counters[k] = counters.get(k, 0) + v
+    for k, h in list(src[1].items()):
+        d = hists.get(k)
+        if d is None:
+            d = hists[k] = [0, 0.0, h[2], {}]
+        d[0] += h[0]
+        d[1] += h[1]
+        d[2] = max(d[2], h[2])
+        for b, n in list(h[3].items()):
+            d[3][b] = d[3].get(b, 0) + n
+
+
+def _fold_dead():
+    # Caller holds _reg_lock. A dead thread's shard can't change any more.
+    live = []
+    for thread, shard in _shards:
+        if thread.is_alive():
+            live.append((thread, shard))
+        else:
+            _merge(_retired, shard)
+    _shards[:] = live
+
+
+def summarize(h):
+    count, total, peak, buckets = h
+    out = {'count': count, 'mean': total / count if count else 0.0, 'max': peak}
+    order = sorted(buckets)
+    for p in PERCENTILES:
+        rank, seen = p / 100.0 * count, 0
+        for b in order:
+            seen += buckets[b]
+            if seen >= rank:
+                out[f"p{p}"] = min(_bucket_value(b), peak)
+                break
+    return out
+
+
+def snapshot():
+    """Merged counters, histogram summaries and gauges as plain JSON-able dicts."""
+    merged = ({}, {})
+    with _reg_lock:
+        _fold_dead()
+        shards = [_retired] + [s for _, s in _shards]
+        _merge(merged, shards[0])
+    for shard in shards[1:]:
+        _merge(merged, shard)
+    gauges = {}
+    for name, fn in list(_gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        if isinstance(value, dict):
+            gauges.update((f"{name}.{k}", v) for k, v in value.items())
+        else:
+            gauges[name] = value
+    return {'uptime_s': round(time.time() - _started, 3),
+            'counters': dict(sorted(merged[0].items())),
+            'histograms': {k: summarize(h) for k, h in sorted(merged[1].items())},
+            'gauges': dict(sorted(gauges.items()))}
+
+
+def render(snap):
+    """snapshot() as text, one metric per line."""
+    lines = [f"uptime_s {snap['uptime_s']}"]
+    lines += [f"counter {k} {v}" for k, v in snap['counters'].items()]
+    lines += [f"gauge {k} {v}" for k, v in snap['gauges'].items()]
+    for k, h in snap['histograms'].items():
+        lines.append(f"histogram {k} " + ' '.join(
+            f"{f}={v:.3f}" if isinstance(v, float) else f"{f}={v}" for f, v in h.items()))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='127.0.0.1', source=snapshot):
+    """Answer every connection on host:port with render(source()) and close it.
+
+    An HTTP GET gets a minimal HTTP/1.0 response, so curl works too.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(5)
+
+    def loop():
+        while True:
+            try:
+                c, _ = s.accept()
+            except OSError:
+                return
+            try:
+                c.settimeout(0.2)
+                try:
+                    request = c.recv(1024)
+                except socket.timeout:
+                    request = b''
+                body = render(source()).encode('utf-8')
+                if request.startswith(b'GET'):
+                    body = (b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n"
+                            b"Content-Length: %d\r\n\r\n" % len(body)) + body
+                c.sendall(body)
+            except OSError:
+                pass
+            finally:
+                c.close()
+
+    threading.Thread(target=loop, daemon=True).start()
+    return s
+
+
+class TimedLock:
+    """threading.Lock that records how long callers wait for it and hold it,
+    in the `<name>.wait_ms` and `<name>.hold_ms` histograms."""
+
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self._wait = name + '.wait_ms'
+        self._hold = name + '.hold_ms'
+        self._acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        if ok:
+            self._acquired = t1 = time.perf_counter()
+            observe(self._wait, (t1 - t0) * 1000.0)
+        return ok
+
+    def release(self):
+        held = time.perf_counter() - self._acquired
+        self._lock.release()
+        observe(self._hold, held * 1000.0)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        t0 = time.perf_counter()
+        self._lock.acquire()
+        self._acquired = t1 = time.perf_counter()
+        observe(self._wait, (t1 - t0) * 1000.0)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self._acquired
+        self._lock.release()
+        observe(self._hold, held * 1000.0)
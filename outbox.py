@@ -0,0 +1,107 @@
+# outbox.py
+# Bounded per-connection send queues, used by the server for its clients and
+# by proxies for their downstream peers.
+
+import socket, threading
+from collections import deque
+
+import codec
+
+OUTBOX_LIMIT = 1 << 20    # bytes a connection may have queued before the slow policy applies
+WRITE_BATCH = 64          # max queued frames handed to one sendmsg() call
+
+
+class Outbox:
+    """Bounded send queue for one socket, drained by its own writer thread.
+
+    push() never blocks, so a slow reader only ever stalls its own writer.
+    The writer hands up to WRITE_BATCH queued frames to a single sendmsg().
+    Once `deflate` is set, push() compresses under the queue lock, so the
+    stream is compressed in the order it is written; a frame is only
+    compressed once it is sure to be queued.
+    """
+
+    def __init__(self, conn, limit=OUTBOX_LIMIT, policy='disconnect'):
+        self.conn = conn
+        self.limit = limit
+        self.policy = policy
+        self.codec = codec.JSON     # what send_json() on the server encodes with
+        self.deflate = None         # codec.Deflater once compression is negotiated
+        self.frames = deque()
+        self.queued = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def push(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            # Check the limit first: once a frame has been through the
+            # deflate stream it must be written, or the peer can't inflate
+            # anything after it.
+            if self.queued + len(data) > self.limit:
+                if self.policy == 'disconnect':
+                    self._shutdown()
+                return False
+            if self.deflate is not None:
+                data = self.deflate.compress(data)
+            self.frames.append(data)
+            self.queued += len(data)
+            self.cond.notify()
+            return True
+
+    def depth(self):
+        """Bytes queued and not yet handed to the socket."""
+        return self.queued
+
+    # lets socket-style helpers such as client.send_json write through the queue
+    sendall = push
+
+    def close(self):
+        with self.cond:
+            self._shutdown()
+
+    def _shutdown(self):
+        # Caller holds self.cond. Shutting the socket down wakes the reader,
+        # which then runs its normal disconnect path.
+        if not self.closed:
+            self.closed = True
+            self.frames.clear()
+            self.cond.notify()
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                while not self.frames and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                n = min(len(self.frames), WRITE_BATCH)
+                batch = [self.frames.popleft() for _ in range(n)]
+            size = sum(len(b) for b in batch)
+            try:
+                send_frames(self.conn, batch)
+            except OSError:
+                self.close()
+                return
+            with self.cond:
+                self.queued -= size
+
+
+def send_frames(conn, bufs):
+    if not hasattr(conn, 'sendmsg'):   # Windows
+        conn.sendall(b''.join(bufs))
+        return
+    while bufs:
+        sent = conn.sendmsg(bufs)
+        while sent:
+            if sent >= len(bufs[0]):
+                sent -= len(bufs.pop(0))
+            else:
+                bufs[0] = memoryview(bufs[0])[sent:]
+                sent = 0
@@ -0,0 +1,279 @@
+# peerlistener.py
+# Inbound peer connections for a client acting as proxy: one selector thread
+# does all the socket I/O, and a small, fixed pool of workers runs the
+# requests that need more than a reply (forwarding to the server, relay
+# subscriptions), however many peers are connected.
+
+import socket, selectors, threading, traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+from codec import FrameReader, Deflater
+from framing import FrameTooLarge, RECV_SIZE
+from outbox import OUTBOX_LIMIT
+
+PEER_BACKLOG = 128      # listen() backlog for inbound peer connections
+PEER_WORKERS = 4        # worker threads shared by all peers
+PEER_PENDING = 1024     # queued work items per peer before we stop reading from it
+DRAIN_BATCH = 64        # items a worker runs for one peer before letting others in
+
+
+class PeerLink:
+    """One inbound peer connection.
+
+    push() (alias sendall) may be called from any thread: it writes straight
+    to the non-blocking socket when nothing is queued and otherwise leaves
+    the rest for the selector thread. submit() queues a work item; a peer's
+    items run one at a time and in order. Replies are compressed once the
+    peer has sent a compressed frame itself.
+    """
+
+    def __init__(self, listener, conn, addr, limit=OUTBOX_LIMIT):
+        self.listener = listener
+        self.conn = conn
+        self.addr = addr
+        self.limit = limit
+        self.reader = FrameReader()
+        self.deflate = None         # codec.Deflater for our replies, set by the selector thread
+        self.lock = threading.Lock()
+        self.frames = deque()       # bytes not yet accepted by the socket
+        self.queued = 0
+        self.items = deque()        # work items waiting for a worker
+        self.running = False        # a worker is draining items
+        self.closed = False
+        self.events = selectors.EVENT_READ
+
+    def push(self, data):
+        with self.lock:
+            if self.closed:
+                return False
+            if self.deflate is not None:
+                data = self.deflate.compress(data)
+            if self.queued + len(data) > self.limit:
+                slow = True
+            else:
+                slow = False
+                waiting = bool(self.frames)
+                self.frames.append(data)
+                self.queued += len(data)
+                if not waiting:
+                    self._flush()
+        if slow:
+            self.close()    # too far behind: same policy as Outbox's 'disconnect'
+            return False
+        if self.frames and not waiting:
+            self.listener.update(self)
+        return True
+
+    sendall = push
+
+    def _flush(self):
+        # Caller holds lock. Write as much as the socket takes without blocking.
+        while self.frames:
+            try:
+                n = self.conn.send(self.frames[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.frames.clear()
+                self.queued = 0
+                self.listener.update(self, close=True)
+                return
+            self.queued -= n
+            if n < len(self.frames[0]):
+                self.frames[0] = memoryview(self.frames[0])[n:]
+                return
+            self.frames.popleft()
+
+    def submit(self, item):
+        with self.lock:
+            self.items.append(item)
+            start = not self.running
+            self.running = True
+            full = len(self.items) >= PEER_PENDING
+        if start:
+            self.listener.pool.submit(self.listener._drain, self)
+        if full:
+            self.listener.update(self)
+
+    def close(self):
+        self.listener.update(self, close=True)
+
+    def wanted_events(self):
+        # Caller holds lock.
+        events = selectors.EVENT_READ if len(self.items) < PEER_PENDING else 0
+        if self.frames:
+            events |= selectors.EVENT_WRITE
+        return events
+
+
+class PeerListener:
+    """Accepts peers on `port` and serves them from one selector thread.
+
+    on_message(link, msg, wire) runs on that thread for every decoded frame,
+    so it should only answer cheap requests directly and submit() the rest.
+    handler(item) runs submitted items on the worker pool; when a link
+    closes, handler gets (`closed_item`, link) after the link's other items.
+    """
+
+    def __init__(self, port, on_message, handler, closed_item='PEER_CLOSED',
+                 workers=PEER_WORKERS, backlog=PEER_BACKLOG):
+        self.on_message = on_message
+        self.handler = handler
+        self.closed_item = closed_item
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', port))
+        self.sock.listen(backlog)
+        self.sock.setblocking(False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.sock, selectors.EVENT_READ)
+        # other threads queue interest changes and closes here and wake the loop
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.sel.register(self.wake_r, selectors.EVENT_READ)
+        self.changes = deque()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='peer-worker')
+        self.running = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def update(self, link, close=False):
+        """Ask the selector thread to re-check link's events (or close it)."""
+        self.changes.append((link, close))
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            pass    # the wake buffer is full, so the loop is awake anyway
+
+    def close(self):
+        self.running = False
+        self.update(None, True)
+
+    def _loop(self):
+        while self.running:
+            for key, mask in self.sel.select():
+                if key.fileobj is self.sock:
+                    self._accept()
+                elif key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    link = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        with link.lock:
+                            link._flush()
+                        self._rearm(link)
+                    if mask & selectors.EVENT_READ and not link.closed:
+                        self._read(link)
+            while self.changes:
+                link, close = self.changes.popleft()
+                if link is None:
+                    continue
+                if close:
+                    self._close(link)
+                else:
+                    self._rearm(link)
+        for key in list(self.sel.get_map().values()):
+            if isinstance(key.data, PeerLink):
+                self._close(key.data)
+        self.sock.close()
+        self.sel.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            conn.setblocking(False)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            link = PeerLink(self, conn, addr)
+            self.sel.register(conn, link.events, link)
+
+    def _read(self, link):
+        try:
+            data = link.conn.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(link)
+            return
+        link.reader.feed(data)
+        while True:
+            try:
+                msg = link.reader.next_msg()
+            except (FrameTooLarge, ConnectionError):
+                self._close(link)
+                return
+            if msg is None:
+                return
+            if link.deflate is None and link.reader.compressed:
+                with link.lock:
+                    link.deflate = Deflater()   # the peer compresses, so it can inflate
+            try:
+                self.on_message(link, msg, link.reader.codec)
+            except Exception as e:
+                # one bad message must not cost the frames buffered behind it
+                log.error('error', "peer message error: {error}", error=e, addr=link.addr,
+                          trace=traceback.format_exc())
+
+    def _rearm(self, link):
+        # Selector thread only.
+        with link.lock:
+            if link.closed:
+                return
+            events = link.wanted_events()
+        if events == link.events:
+            return
+        if link.events and events:
+            self.sel.modify(link.conn, events, link)
+        elif events:
+            self.sel.register(link.conn, events, link)     # reading resumes
+        else:
+            self.sel.unregister(link.conn)                 # backlogged: stop reading for now
+        link.events = events
+
+    def _close(self, link):
+        # Selector thread only.
+        with link.lock:
+            if link.closed:
+                return
+            link.closed = True
+            link.frames.clear()
+        if link.events:
+            try:
+                self.sel.unregister(link.conn)
+            except (KeyError, ValueError):
+                pass
+        try:
+            link.conn.close()
+        except OSError:
+            pass
+        link.submit((self.closed_item, link))
+
+    def _drain(self, link):
+        # Worker thread: run up to DRAIN_BATCH of link's items in order, then
+        # requeue behind the other peers if more are waiting.
+        for _ in range(DRAIN_BATCH):
+            with link.lock:
+                if not link.items:
+                    link.running = False
+                    return
+                item = link.items.popleft()
+                resume = len(link.items) == PEER_PENDING - 1
+            if resume:
+                self.update(link)
+            try:
+                self.handler(item)
+            except Exception:
+                pass
+        self.pool.submit(self._drain, link)
@@ -0,0 +1,235 @@
+# peerpool.py
+# Persistent, pipelined client-to-peer connections keyed by peer address.
+
+import socket, threading, time, itertools, heapq
+from concurrent.futures import Future
+
+from codec import FrameReader, JSON, Deflater
+
+CONNECT_TIMEOUT = 2.0
+IDLE_TIMEOUT = 30.0     # close pooled connections unused for this long
+PUSH_TYPES = ('CHAT',)  # unsolicited frames a peer may push (relay delivery)
+
+
+class PendingRequests:
+    """req_id -> Future table for the requests outstanding on one connection.
+
+    Replies are matched on the echoed req_id. A reply without one (from a
+    peer that predates request ids) completes the oldest request instead.
+    Requests made with a timeout fail with TimeoutError once expire() runs
+    past their deadline.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.table = {}
+        self.deadlines = []     # heap of (deadline, req_id)
+
+    def new(self, timeout=None):
+        req_id = next(self._ids)
+        fut = Future()
+        with self.lock:
+            self.table[req_id] = fut
+            if timeout is not None:
+                heapq.heappush(self.deadlines, (time.time() + timeout, req_id))
+        return req_id, fut
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        overdue = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, req_id = heapq.heappop(self.deadlines)
+                fut = self.table.pop(req_id, None)
+                if fut is not None:
+                    overdue.append(fut)
+        for fut in overdue:
+            if not fut.done():
+                fut.set_exception(TimeoutError('request timed out'))
+
+    def resolve(self, req_id, msg):
+        with self.lock:
+            if req_id is None and self.table:
+                req_id = next(iter(self.table))
+            fut = self.table.pop(req_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+
+    def discard(self, req_id):
+        if req_id is not None:
+            with self.lock:
+                self.table.pop(req_id, None)
+
+    def fail(self, req_id, exc):
+        with self.lock:
+            fut = self.table.pop(req_id, None)
+        if fut is not None and not fut.done():
+            fut.set_exception(exc)
+
+    def fail_all(self, exc):
+        with self.lock:
+            futs, self.table = list(self.table.values()), {}
+        for fut in futs:
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def __len__(self):
+        return len(self.table)
+
+
+class PeerConnection:
+    """One persistent connection to a peer; many requests may be in flight."""
+
+    def __init__(self, addr, wire=JSON, on_push=None, on_close=None, compress=False):
+        self.addr = tuple(addr)
+        self.wire = wire
+        self.on_push = on_push      # called with pushed PUSH_TYPES frames
+        self.on_close = on_close    # called with this connection when a socket ends
+        self.compress = compress    # the peer takes deflate; applies from the next socket
+        self.keepalive = False      # exempt from idle reaping (e.g. a relay subscription)
+        self.sock = None
+        self.deflate = None
+        self.pending = PendingRequests()
+        self.send_lock = threading.Lock()
+        self.last_used = time.time()
+
+    def _connect(self, timeout=CONNECT_TIMEOUT):
+        # Caller holds send_lock. Each socket gets its own pending table, so a
+        # dying socket only fails the requests that were actually sent on it,
+        # and its own deflate stream: the peer starts compressing its replies
+        # once it sees the first compressed request.
+        s = socket.create_connection(self.addr, timeout=timeout)
+        s.settimeout(None)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock, self.pending = s, PendingRequests()
+        self.deflate = Deflater() if self.compress else None
+        threading.Thread(target=self._reader, args=(s, self.pending), daemon=True).start()
+
+    def _reader(self, s, pending):
+        for msg in FrameReader(s).messages():
+            if self.on_push and 'req_id' not in msg and msg.get('type') in PUSH_TYPES:
+                self.on_push(msg)
+            else:
+                pending.resolve(msg.get('req_id'), msg)
+        with self.send_lock:
+            if self.sock is s:
+                self.sock = None
+        try: s.close()
+        except OSError: pass
+        pending.fail_all(ConnectionError(f"connection to {self.addr} closed"))
+        if self.on_close:
+            self.on_close(self)
+
+    def request(self, obj, timeout=None):
+        """Send obj with a fresh req_id; the Future completes with the reply.
+
+        With a timeout the Future fails with TimeoutError if no reply has
+        arrived by the time expire() runs past it.
+        """
+        with self.send_lock:
+            self.last_used = time.time()
+            err = None
+            for _ in range(2):      # one transparent reconnect
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    req_id, fut = self.pending.new(timeout)
+                    fut.req_id = req_id
+                    data = self.wire.encode(dict(obj, req_id=req_id))
+                    if self.deflate is not None:
+                        data = self.deflate.compress(data)
+                    self.sock.sendall(data)
+                    return fut
+                except OSError as e:
+                    err = e
+                    self._drop()
+        fut = Future()
+        fut.set_exception(err)
+        return fut
+
+    def open(self, timeout=CONNECT_TIMEOUT):
+        """Connect now if needed, so a following request isn't charged the handshake."""
+        with self.send_lock:
+            if self.sock is None:
+                self._connect(timeout)
+
+    def call(self, obj, timeout):
+        """request() and wait; raises on timeout or connection loss."""
+        fut = self.request(obj)
+        try:
+            return fut.result(timeout)
+        except Exception:
+            self.pending.discard(getattr(fut, 'req_id', None))
+            raise
+
+    def _drop(self):
+        # Caller holds send_lock.
+        if self.sock is not None:
+            try: self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            self.sock = None
+
+    def close(self):
+        with self.send_lock:
+            self._drop()
+
+    def expire(self, now=None):
+        self.pending.expire(now)
+
+    def idle_since(self):
+        return None if self.keepalive or len(self.pending) else self.last_used
+
+
+class PeerPool:
+    """PeerConnections keyed by peer address, reaped after IDLE_TIMEOUT."""
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, on_push=None, on_close=None, compress=None):
+        self.idle_timeout = idle_timeout
+        self.on_push = on_push
+        self.on_close = on_close
+        self.compress = compress    # compress(addr) -> True if that peer offered deflate
+        self.conns = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self._reaper, daemon=True).start()
+
+    def get(self, addr, wire=JSON):
+        addr = tuple(addr)
+        with self.lock:
+            conn = self.conns.get(addr)
+            if conn is None:
+                conn = self.conns[addr] = PeerConnection(addr, wire, self.on_push, self.on_close)
+            conn.wire = wire
+            conn.compress = bool(self.compress and self.compress(addr))
+            return conn
+
+    def request(self, addr, obj, wire=JSON, timeout=None):
+        return self.get(addr, wire).request(obj, timeout)
+
+    def call(self, addr, obj, wire=JSON, timeout=2.0):
+        return self.get(addr, wire).call(obj, timeout)
+
+    def expire(self, now=None):
+        """Fail every pooled request that is past its deadline."""
+        with self.lock:
+            conns = list(self.conns.values())
+        for conn in conns:
+            conn.expire(now)
+
+    def close_all(self):
+        with self.lock:
+            conns, self.conns = list(self.conns.values()), {}
+        for conn in conns:
+            conn.close()
+
+    def _reaper(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            now = time.time()
+            with self.lock:
+                idle = [a for a, c in self.conns.items()
+                        if (c.idle_since() or now) < now - self.idle_timeout]
+                conns = [self.conns.pop(a) for a in idle]
+            for conn in conns:
+                conn.close()
@@ -0,0 +1,115 @@
+# rttstore.py
+# Server-side store of the RTTs clients report, with network coordinates so
+# the server can predict latencies between clients that never probed each other.
+#
+# Node 0 is the server itself; clients are their ids. Coordinates are Vivaldi
+# style: a 2-D position plus a height (the access-link delay), in milliseconds.
+
+import math, random, time
+
+RTT_MAX_AGE = 300.0     # seconds a reported RTT or coordinate stays usable
+RTT_ALPHA = 0.3         # weight of a new report in the per-pair average
+VIVALDI_CE = 0.25       # error adaptation rate
+VIVALDI_CC = 0.25       # coordinate step size
+SERVER = 0
+
+
+class RttStore:
+    """Pairwise RTT reports (EWMA, aged out) plus a coordinate per node."""
+
+    def __init__(self, max_age=RTT_MAX_AGE):
+        self.max_age = max_age
+        self.edges = {}     # (low id, high id) -> [rtt_ms, ts]
+        self.coords = {SERVER: [0.0, 0.0, 0.0, 0.1, math.inf]}  # node -> [x, y, h, err, ts]
+
+    def report(self, a, b, rtt, now=None):
+        """Record one RTT sample between nodes a and b (milliseconds). Samples
+        that aren't a finite positive number between two node ids are ignored."""
+        if a == b or not (valid_node(a) and valid_node(b) and valid_rtt(rtt)):
+            return
+        now = time.time() if now is None else now
+        key = (min(a, b), max(a, b))
+        edge = self.edges.get(key)
+        if edge is None or now - edge[1] > self.max_age:
+            self.edges[key] = [rtt, now]
+        else:
+            edge[0] += RTT_ALPHA * (rtt - edge[0])
+            edge[1] = now
+        self._vivaldi(a, b, rtt, now)
+        self._vivaldi(b, a, rtt, now)
+
+    def forget(self, node):
+        """Drop everything about a node (its id may be reused)."""
+        if node == SERVER:
+            return
+        self.coords.pop(node, None)
+        for key in [k for k in self.edges if node in k]:
+            del self.edges[key]
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        for key in [k for k, e in self.edges.items() if now - e[1] > self.max_age]:
+            del self.edges[key]
+        for node in [n for n, c in self.coords.items() if now - c[4] > self.max_age]:
+            del self.coords[node]
+
+    def coord(self, node, now=None):
+        c = self.coords.get(node)
+        if c is None or (time.time() if now is None else now) - c[4] > self.max_age:
+            return None
+        return c
+
+    def predict(self, a, b, now=None):
+        """Best RTT estimate between a and b: a fresh report, else the coordinate
+        distance, else None."""
+        now = time.time() if now is None else now
+        edge = self.edges.get((min(a, b), max(a, b)))
+        if edge is not None and now - edge[1] <= self.max_age:
+            return edge[0]
+        ca, cb = self.coord(a, now), self.coord(b, now)
+        if ca is None or cb is None:
+            return None
+        return distance(ca, cb)
+
+    def centroid(self, nodes, now=None):
+        """Mean coordinate of the nodes that have one (a guess for a newcomer)."""
+        cs = [c for c in (self.coord(n, now) for n in nodes) if c is not None]
+        if not cs:
+            return None
+        return [sum(c[i] for c in cs) / len(cs) for i in range(3)] + [1.0, math.inf]
+
+    def _vivaldi(self, node, other, rtt, now):
+        # Move `node` so its distance to `other` approaches rtt. The server is
+        # the fixed anchor, and a node without a coordinate pulls nobody.
+        if node == SERVER or self.coord(other, now) is None:
+            return
+        c = self.coord(node, now)
+        if c is None:
+            # first sighting: start all-height against the server, near the origin otherwise
+            h = rtt if other == SERVER else 0.0
+            c = self.coords[node] = [random.uniform(-1, 1), random.uniform(-1, 1), h, 1.0, now]
+        o = self.coords[other]
+        dist = distance(c, o)
+        w = c[3] / (c[3] + o[3])
+        c[3] = max(0.01, abs(dist - rtt) / rtt * VIVALDI_CE * w + c[3] * (1 - VIVALDI_CE * w))
+        step = VIVALDI_CC * w * (rtt - dist) / max(dist, 1e-9)
+        dx, dy = c[0] - o[0], c[1] - o[1]
+        if abs(dx) + abs(dy) < 1e-9:
+            dx, dy = random.uniform(-1, 1), random.uniform(-1, 1)
+        c[0] += step * dx
+        c[1] += step * dy
+        c[2] = max(0.0, c[2] + step * (c[2] + o[2]))
+        c[4] = now
+
+
+def distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1]) + a[2] + b[2]
+
+
+def valid_node(node):
+    return isinstance(node, int) and not isinstance(node, bool)
+
+
+def valid_rtt(rtt):
+    # JSON lets a client send NaN and Infinity; either would poison the averages
+    return isinstance(rtt, (int, float)) and not isinstance(rtt, bool) and 0 < rtt < math.inf
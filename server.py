@@ -2,54 +2,347 @@
 # server.py
 # Accepts client connections, coordinates proxy selection and client-list tests.
 
-import socket, threading, json, time, traceback, sys
+import socket, threading, json, time, traceback, sys, argparse, asyncio, itertools, math, random, secrets
+import os, signal
+from collections import deque
+
+import codec, outbox, rttstore, history as chat_history, log, metrics, bus
+from codec import FrameReader, DEFAULT_CHANNEL
+from outbox import Outbox
+from timerwheel import TimerWheel
+from framing import FrameTooLarge, RECV_SIZE
 
 HOST = '0.0.0.0'
 PORT = 9090
 
-lock = threading.Lock()
-clients = {}        # client_id -> {conn, addr, peer_addr, name}
+lock = metrics.TimedLock('lock')   # records its wait and hold times
+clients = {}        # client_id -> {out, addr, peer_addr, name, codecs, proxy, relayed_by,
+                    #               relay_rate, rate_ts, token, channels}
+reserved = {}       # client_id -> {info, expires}: disconnected clients that may still RESUME
+fan_in = {}         # proxy_id -> number of clients assigned to it
+rtts = rttstore.RttStore()     # RTTs clients report, node 0 being the server
+channels = {}       # channel -> ids of the connected clients in it
+channel_recipients = {}   # channel -> outboxes its chats are written to, replaced under lock on change
 available_ids = []  # freed IDs to reuse (sorted)
 next_id = 1         # next brand-new ID if no reusable ones exist
 
+OUTBOX_LIMIT = outbox.OUTBOX_LIMIT
+SLOW_POLICY = 'disconnect'  # 'drop' new frames or 'disconnect' the consumer
+WIRE_CODECS = ('bin1',)   # codecs offered to clients besides JSON; () keeps everyone on JSON
+COMPRESS = True           # compress connections whose client offers 'deflate'
+DELIVERY = 'direct'       # 'direct': every chat to every client; 'relay': via the proxy tree
+history = chat_history.ChatHistory()   # numbers every CHAT and keeps recent ones for RESUME
+RESUME_GRACE = 30.0       # seconds a disconnected client's id and proxy role are held
+REPLAY_CHUNK = 65536      # bytes per outbox push when replaying missed chats
+HEARTBEAT_INTERVAL = 10.0 # seconds of silence before the server PINGs a connection
+IDLE_TIMEOUT = 30.0       # seconds of silence before it is closed; 0 = never
+LEGACY_IDLE_TIMEOUT = 300.0   # the same for legacy clients, which never answer PING; 0 = never
+wheel = TimerWheel()      # connection -> next idle check
+ping_ids = itertools.count(1)
+LOG_SAMPLE = {'chat': 20, 'forwarded_chat': 20, 'retry_after': 5}   # default records/s kept per hot event
+ADMIT_RATE = 100.0        # REGISTER/RESUMEs admitted per second once the burst is spent; 0 = no limit
+ADMIT_BURST = 100         # admitted at once before the rate applies
+ADMIT_QUEUE = 1000        # registrations waiting for a slot before new ones get RETRY_AFTER
+PROXY_CAPACITY = 8        # clients one proxy may carry; 0 = unlimited
+PROXY_MAX_RATE = 0.0      # relayed chats/s above which a proxy counts as overloaded; 0 = off
+RATE_TAU = 10.0           # seconds; time constant of the relayed-rate average
+REBALANCE_INTERVAL = 5.0
+CANDIDATES = 4            # proxies offered in CLIENT_LIST; 0 = every earlier client
+LOAD_PENALTY_MS = 5.0     # ranking cost of each client a proxy already carries
+MAX_CHANNELS = 32         # channels one client may be in
+CHANNEL_NAME_MAX = 64     # characters
+FORWARD_BATCH_MAX = 256   # chats accepted in one FORWARDED_BATCH; advertised in ASSIGN_ID
+WORKERS = 0               # worker processes sharing the port; 0 = serve in this process
+PUBLISH_MAX = 1024        # chats a worker sends the hub in one PUBLISH
+PUBLISH_BYTES = 1 << 20   # and their text
+STATS_PORT = 0            # local port serving metrics as text; 0 = off
+# message types counted individually in metrics; anything else counts as 'other'
+MESSAGE_TYPES = frozenset(('REGISTER', 'RESUME', 'CHAT', 'CHOICE', 'FORWARDED_CHAT', 'RTT_REPORT',
+                           'RELAY_READY', 'RELAY_LOST', 'MEASURE_REQUEST', 'PING', 'PONG', 'STATS',
+                           'JOIN', 'LEAVE', 'FORWARDED_BATCH'))
+
 running = True      # for clean shutdown flag
+hub = None          # a worker's BusLink to the hub (--workers); None when serving alone
+workers = []        # the hub's BusLinks to its workers, changed under history.lock
+outgoing = deque()  # a worker's (chats, proxy) waiting for the next PUBLISH
+outgoing_cond = threading.Condition()
 
 
-def send_json(conn, obj):
-    data = json.dumps(obj).encode('utf-8') + b'\n'
-    try:
-        conn.sendall(data)
-    except Exception:
-        pass
+def send_json(out, obj):
+    data = out.codec.encode(obj)
+    metrics.incr('msg.out.' + obj['type'])
+    metrics.incr('bytes.out.' + obj['type'], len(data))
+    out.push(data)
 
 
-def recv_lines(conn):
-    buf = b""
-    while True:
-        try:
-            data = conn.recv(4096)
-            if not data:
-                break
-            buf += data
-            while b'\n' in buf:
-                line, buf = buf.split(b'\n', 1)
-                yield line.decode('utf-8')
-        except Exception:
-            break
+def chat_frame(sender_id, text, name, channel):
+    # Caller holds history.lock. The channel's next CHAT frame, numbered and recorded.
+    frame = {
+        'type': 'CHAT',
+        'from_id': sender_id,
+        'from_name': name,
+        'text': text,
+        'seq': history.last_seq(channel) + 1
+    }
+    if channel != DEFAULT_CHANNEL:
+        frame['channel'] = channel
+    history.append(frame)
+    return frame
 
 
-def broadcast_chat(sender_id, text, name):
-    with lock:
-        for cid, info in list(clients.items()):
-            try:
-                send_json(info['conn'], {
-                    'type': 'CHAT',
-                    'from_id': sender_id,
-                    'from_name': name,
-                    'text': text
-                })
-            except Exception:
-                pass
+def broadcast_chat(sender_id, text, name, channel=DEFAULT_CHANNEL, proxy=None):
+    # `proxy` relayed the chat; only the hub of a multi-worker server needs it.
+    if hub is not None:
+        publish([(sender_id, text, name, channel)], proxy)
+        return
+    with history.lock:
+        frame = chat_frame(sender_id, text, name, channel)
+        t0 = time.perf_counter()
+        recipients = channel_recipients.get(channel, ())
+        encoded = {}    # one serialization per (codec, compressed) pair in use
+        sent = 0
+        for out in recipients:
+            key = (out.codec, out.deflate is not None)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = shared_frame(out.codec.encode(frame), key[1])
+            out.push(data)
+            sent += len(data)
+        metrics.observe('broadcast.fanout_ms', (time.perf_counter() - t0) * 1000.0)
+        metrics.incr('msg.out.CHAT', len(recipients))
+        metrics.incr('bytes.out.CHAT', sent)
+
+
+def broadcast_batch(chats, proxy=None):
+    """Fan out [(sender_id, text, name, channel), ...] in order with one pass
+    over the recipients: each gets a single push holding every chat of the
+    batch in the channels it follows."""
+    if hub is not None:
+        publish(chats, proxy)
+        return
+    with history.lock:
+        fan_out([chat_frame(*chat) for chat in chats])
+
+
+def fan_out(frames):
+    # Caller holds history.lock. Write already numbered frames to their channels' recipients.
+    t0 = time.perf_counter()
+    bits, masks = {}, {}    # channel -> its bit; outbox -> the channels of this batch it receives
+    tagged = [(bits.setdefault(f.get('channel', DEFAULT_CHANNEL), 1 << len(bits)), f) for f in frames]
+    for channel, bit in bits.items():
+        for out in channel_recipients.get(channel, ()):
+            masks[out] = masks.get(out, 0) | bit
+    encoded = {}    # (codec, mask, compressed) -> the recipient's push; one per distinct key
+    sent = count = 0
+    for out, mask in masks.items():
+        key = (out.codec, mask, out.deflate is not None)
+        data = encoded.get(key)
+        if data is None:
+            parts = [out.codec.encode(f) for bit, f in tagged if bit & mask]
+            data = encoded[key] = (shared_frame(b''.join(parts), key[2]), len(parts))
+        out.push(data[0])
+        sent += len(data[0])
+        count += data[1]
+    metrics.observe('broadcast.fanout_ms', (time.perf_counter() - t0) * 1000.0)
+    metrics.observe('broadcast.batch', len(frames))
+    metrics.incr('msg.out.CHAT', count)
+    metrics.incr('bytes.out.CHAT', sent)
+
+
+def shared_frame(data, compressed):
+    # A broadcast push, compressed once for every recipient that takes deflate
+    # rather than through each one's own stream.
+    return codec.compress_shared(data) if compressed else data
+
+
+def replay(out, frames):
+    # Missed chats go out as a few large pushes rather than one per frame.
+    batch, size, total = [], 0, 0
+    for frame in frames:
+        data = out.codec.encode(frame)
+        batch.append(data)
+        size += len(data)
+        if size >= REPLAY_CHUNK:
+            out.push(b''.join(batch))
+            total += size
+            batch, size = [], 0
+    if batch:
+        out.push(b''.join(batch))
+    metrics.incr('msg.out.CHAT', len(frames))
+    metrics.incr('bytes.out.CHAT', total + size)
+
+
+def refresh_recipients(channel=None):
+    # Caller holds lock. Rebuild who each channel's chats are written to (just
+    # `channel`'s if given). In relay mode a member that confirmed a relay link
+    # gets chats from its proxy instead, so the server writes to the root of its
+    # branch, and each proxy on the way passes on the channels below it.
+    global channel_recipients
+    table = dict(channel_recipients) if channel is not None else {}
+    for ch in ((channel,) if channel is not None else channels):
+        roots = {}
+        for cid in channels.get(ch, ()):
+            root = relay_root(cid)
+            roots[root] = clients[root]['out']
+        if roots:
+            table[ch] = tuple(roots.values())
+        else:
+            table.pop(ch, None)
+    channel_recipients = table
+
+
+def relay_root(client_id):
+    # Caller holds lock. The client at the top of client_id's relay branch.
+    while clients[client_id]['relayed_by'] in clients:
+        client_id = clients[client_id]['relayed_by']
+    return client_id
+
+
+def valid_channel(channel):
+    return isinstance(channel, str) and 0 < len(channel) <= CHANNEL_NAME_MAX
+
+
+def join_channel(client_id, channel):
+    # Caller holds lock.
+    clients[client_id]['channels'].add(channel)
+    channels.setdefault(channel, set()).add(client_id)
+    refresh_recipients(channel)
+
+
+def leave_channel(client_id, channel):
+    # Caller holds lock.
+    clients[client_id]['channels'].discard(channel)
+    members = channels.get(channel)
+    if members is not None:
+        members.discard(client_id)
+        if not members:
+            del channels[channel]
+        refresh_recipients(channel)
+
+
+def relay_cycle(client_id, proxy_id):
+    # Caller holds lock. True if relaying client_id through proxy_id would loop.
+    seen = set()
+    while proxy_id is not None and proxy_id not in seen:
+        if proxy_id == client_id:
+            return True
+        seen.add(proxy_id)
+        proxy_id = clients[proxy_id]['relayed_by'] if proxy_id in clients else None
+    return False
+
+
+# ----------------------------------------
+# Proxy load: fan-in, relayed rate, assignment
+# ----------------------------------------
+def note_relayed(info, now, n=1):
+    # Exponentially weighted chats/s this client forwarded for others.
+    info['relay_rate'] = relay_rate(info, now) + n / RATE_TAU
+    info['rate_ts'] = now
+
+
+def relay_rate(info, now):
+    return info['relay_rate'] * math.exp(-(now - info['rate_ts']) / RATE_TAU)
+
+
+def overloaded(proxy_id, now, extra=0):
+    # Caller holds lock. True if proxy_id is (or, with `extra` more clients, would be) over capacity.
+    if PROXY_CAPACITY and fan_in.get(proxy_id, 0) + extra > PROXY_CAPACITY:
+        return True
+    return bool(PROXY_MAX_RATE) and relay_rate(clients[proxy_id], now) > PROXY_MAX_RATE
+
+
+def least_loaded(client_id, now, exclude=None):
+    # Caller holds lock. The earlier client with the most room (the nearest one
+    # on a tie), or None if all are full.
+    best, best_key = None, None
+    for cid in clients:
+        if cid < client_id and cid != exclude and not overloaded(cid, now, 1):
+            est = rtts.predict(client_id, cid, now)
+            key = (fan_in.get(cid, 0), math.inf if est is None else est)
+            if best is None or key < best_key:
+                best, best_key = cid, key
+    return best
+
+
+def subnet(addr):
+    return addr[0].rsplit('.', 1)[0]
+
+
+def rank_candidates(client_id, candidates, now):
+    # Caller holds lock. The CANDIDATES earlier clients with the lowest predicted
+    # RTT to client_id plus a load penalty; the last slot goes to a random other
+    # client so the RTT store keeps learning about the rest.
+    if not CANDIDATES or len(candidates) <= CANDIDATES:
+        return candidates
+    me = rtts.coord(client_id, now)
+    if me is None:
+        # a newcomer is guessed to sit with the clients on its subnet
+        net = subnet(clients[client_id]['peer_addr'])
+        me = rtts.centroid([cid for cid in candidates if subnet(clients[cid]['peer_addr']) == net], now)
+
+    def cost(cid):
+        c = rtts.coord(cid, now)
+        if me is not None and c is not None:
+            est = rttstore.distance(me, c)
+        else:
+            est = rtts.predict(cid, rttstore.SERVER, now)   # no position: prefer central clients
+        if est is None:
+            return math.inf
+        return est + LOAD_PENALTY_MS * fan_in.get(cid, 0)
+
+    ranked = sorted(candidates, key=cost)
+    keep = CANDIDATES - 1 if CANDIDATES > 1 else CANDIDATES
+    return ranked[:keep] + random.sample(ranked[keep:], CANDIDATES - keep)
+
+
+def assign_proxy(client_id, proxy_id):
+    # Caller holds lock. Record the assignment and tell both ends; a client
+    # moved off a proxy takes chats directly until it confirms the new link.
+    info = clients[client_id]
+    old = info['proxy']
+    if old != proxy_id:
+        if old in fan_in:
+            fan_in[old] -= 1
+            if old in clients:
+                send_json(clients[old]['out'], {'type': 'PROXY_DROP', 'client_id': client_id})
+        if info['relayed_by'] is not None:
+            info['relayed_by'] = None
+            refresh_recipients()
+        info['proxy'] = proxy_id
+        fan_in[proxy_id] = fan_in.get(proxy_id, 0) + 1
+    send_json(clients[proxy_id]['out'], {
+        'type': 'PROXY_FOR',
+        'client_id': client_id
+    })
+    send_json(info['out'], {
+        'type': 'USE_PROXY',
+        'proxy_id': proxy_id,
+        'proxy_peer': clients[proxy_id]['peer_addr'],
+        'proxy_codecs': clients[proxy_id]['codecs']
+    })
+
+
+def rebalance():
+    # Periodically move clients off proxies that are over capacity or relaying
+    # too much, newest clients first, onto the least-loaded earlier client.
+    while running:
+        time.sleep(REBALANCE_INTERVAL)
+        now = time.time()
+        with lock:
+            for proxy_id in [p for p in fan_in if p in clients and overloaded(p, now)]:
+                riders = sorted((c for c, info in clients.items() if info['proxy'] == proxy_id),
+                                reverse=True)
+                excess = max(1, fan_in[proxy_id] - PROXY_CAPACITY) if PROXY_CAPACITY else 1
+                for cid in riders[:excess]:
+                    target = least_loaded(cid, now, exclude=proxy_id)
+                    if target is not None:
+                        log.info('rebalance', "Rebalance: client {client} from proxy {proxy} to {target}",
+                                 client=cid, proxy=proxy_id, target=target)
+                        assign_proxy(cid, target)
+            rtts.prune(now)
+            # ids whose RESUME grace ran out are released for good
+            for cid in [c for c, held in reserved.items() if held['expires'] <= now]:
+                release_client(cid, reserved.pop(cid)['info'])
 
 
 # ----------------------------------------
@@ -60,14 +353,82 @@ def remove_client(client_id):
         return
     with lock:
         if client_id in clients:
-            del clients[client_id]
-            available_ids.append(client_id)
-            available_ids.sort()
-            print(f"[server] Client {client_id} disconnected. Total: {len(clients)}")
+            gone = clients.pop(client_id)
+            for ch in gone['channels']:
+                members = channels.get(ch)
+                if members is not None:
+                    members.discard(client_id)
+                    if not members:
+                        del channels[ch]
+            # anyone relayed through it falls back to direct delivery
+            for info in clients.values():
+                if info['relayed_by'] == client_id:
+                    info['relayed_by'] = None
+            refresh_recipients()
+            if hub is not None:
+                hub.send({'type': 'GONE', 'id': client_id})     # the hub holds its id
+            else:
+                retire_client(client_id, gone)
+            log.info('disconnect', "Client {client} disconnected. Total: {total}",
+                     client=client_id, total=len(clients))
+
+
+def retire_client(client_id, gone):
+    # Caller holds lock. Keep a departed client's id and its own proxy in case
+    # it comes back with RESUME, or give them up now. The clients it proxied
+    # for move at once either way, rather than wait out the grace period on a
+    # proxy that may not come back.
+    if RESUME_GRACE > 0:
+        gone['relayed_by'] = None
+        reassign_riders(client_id)
+        reserved[client_id] = {'info': gone, 'expires': time.time() + RESUME_GRACE}
+    else:
+        release_client(client_id, gone)
+
+
+def release_client(client_id, gone):
+    # Caller holds lock. Give up a departed client's id and proxy role.
+    rtts.forget(client_id)
+    if gone['proxy'] in fan_in:
+        fan_in[gone['proxy']] -= 1
+    reassign_riders(client_id)
+    available_ids.append(client_id)
+    available_ids.sort()
+
+
+def reassign_riders(proxy_id):
+    # Caller holds lock. proxy_id is gone: the clients it carried move to other
+    # proxies, and held ones that rode on it come back without a proxy.
+    fan_in.pop(proxy_id, None)
+    for held in reserved.values():
+        if held['info']['proxy'] == proxy_id:
+            held['info']['proxy'] = None
+    orphans = []
+    for cid, info in clients.items():
+        if info['proxy'] == proxy_id:
+            info['proxy'] = None
+            orphans.append(cid)
+    # hand the orphans to the least-loaded remaining proxies in one pass
+    # (no room anywhere earlier: the client sends directly)
+    now = time.time()
+    for cid in sorted(orphans):
+        target = least_loaded(cid, now)
+        if target is not None:
+            assign_proxy(cid, target)
+        else:
+            send_json(clients[cid]['out'], {'type': 'NO_PROXY'})
+    if orphans:
+        log.info('reassign', "Reassigned {n} client(s) of proxy {proxy}", n=len(orphans), proxy=proxy_id)
 
 
 def allocate_id():
     global next_id
+    if hub is not None:
+        # ids are global across workers, so the hub hands them out
+        reply = hub.request({'type': 'ALLOC'}).result(bus.BUS_TIMEOUT)
+        if reply is None:
+            raise ConnectionError("hub unreachable")
+        return reply['id']
     with lock:
         if available_ids:
             return available_ids.pop(0)
@@ -76,134 +437,745 @@ def allocate_id():
         return cid
 
 
-def handle_client(conn, addr):
-    global clients
-    my_id = None
-    peer_addr = None
-    name = None
+def place_client(my_id):
+    # Caller holds lock. Special rules for a newly registered client.
+    total = len(clients)
 
-    try:
-        for line in recv_lines(conn):
-            try:
-                msg = json.loads(line)
-            except Exception:
+    # Client 2 uses client 1 as proxy
+    if my_id == 2 and total <= 2:
+        if 1 in clients:
+            assign_proxy(2, 1)
+
+    # Clients >= 3 get a ranked shortlist of earlier clients that still have room
+    if my_id >= 3:
+        now = time.time()
+        earlier = [cid for cid in sorted(clients.keys()) if cid < my_id]
+        open_ = [cid for cid in earlier if not overloaded(cid, now, 1)]
+        lst = []
+        for cid in rank_candidates(my_id, open_ or earlier, now):
+                lst.append({
+                    'id': cid,
+                    'peer': clients[cid]['peer_addr'],
+                    'name': clients[cid]['name'],
+                    'codecs': clients[cid]['codecs']
+                })
+        send_json(clients[my_id]['out'], {'type': 'CLIENT_LIST', 'clients': lst})
+
+
+def choose_proxy(my_id, chosen):
+    # Caller holds lock. Apply a client's CHOICE; a full proxy is swapped for
+    # the least-loaded one with room.
+    if chosen in clients and my_id in clients and chosen != my_id:
+        now = time.time()
+        if clients[my_id]['proxy'] != chosen and overloaded(chosen, now, 1):
+            alt = least_loaded(my_id, now)
+            if alt is not None:
+                log.info('proxy_full', "Proxy {proxy} is full; assigning {alt} to client {client}",
+                         proxy=chosen, alt=alt, client=my_id)
+                chosen = alt
+        assign_proxy(my_id, chosen)
+
+
+def report_rtts(my_id, pairs, now):
+    # Caller holds lock. [[peer_id, rtt_ms], ...] measured by my_id; peer 0 is the server.
+    # The report comes straight from the client, so malformed entries are skipped.
+    if my_id not in clients or not isinstance(pairs, (list, tuple)):
+        return
+    for pair in pairs:
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            continue
+        peer_id, rtt = pair
+        if not rttstore.valid_node(peer_id) or not rttstore.valid_rtt(rtt):
+            continue
+        if peer_id == rttstore.SERVER or peer_id in clients:
+            rtts.report(my_id, peer_id, rtt, now)
+
+
+def reply_to(msg, reply):
+    # Echo the request id so clients can keep several requests in flight.
+    if 'req_id' in msg:
+        reply['req_id'] = msg['req_id']
+    return reply
+
+
+def negotiate_compression(offered):
+    # ASSIGN_ID `compress`: the scheme both directions use from then on, or None.
+    return codec.DEFLATE if COMPRESS and codec.DEFLATE in offered else None
+
+
+def resume_client(session, msg):
+    """Reattach a reconnecting client to its held id and proxy assignment and
+    replay the chats it missed. False if there is nothing to resume."""
+    out = session['out']
+    my_id = msg.get('id')
+    if hub is not None:
+        info = claim_held(my_id, msg.get('token'))
+        if info is None:
+            return False
+    else:
+        with lock:
+            held = reserved.get(my_id)
+            if held is None or held['info']['token'] != msg.get('token'):
+                return False
+            del reserved[my_id]
+        info = held['info']
+    info['out'] = out
+    info['addr'] = session['addr']
+    if msg.get('peer_port'):
+        info['peer_addr'] = (msg.get('peer_ip', session['addr'][0]), int(msg['peer_port']))
+    offered = msg.get('codecs') or []
+    info['codecs'] = [c for c in offered if c in codec.CAPABILITIES]
+    session.update(id=my_id, peer_addr=info['peer_addr'], name=info['name'])
+
+    chosen_codec = codec.negotiate(offered, WIRE_CODECS)
+    compress = negotiate_compression(offered)
+    send_json(out, {'type': 'ASSIGN_ID', 'id': my_id, 'codec': chosen_codec.name,
+                    'delivery': DELIVERY, 'token': info['token'], 'resumed': True,
+                    'batch': FORWARD_BATCH_MAX, 'compress': compress})
+    out.codec = chosen_codec
+    if compress:
+        out.deflate = codec.Deflater()
+
+    # attach and replay under the history lock so no chat falls in between;
+    # `last_seqs` maps each channel to the last seq the client holds in it
+    marks = msg.get('last_seqs')
+    if not isinstance(marks, dict):
+        marks = {DEFAULT_CHANNEL: msg.get('last_seq')}
+    with history.lock:
+        with lock:
+            clients[my_id] = info
+            for ch in info['channels']:
+                channels.setdefault(ch, set()).add(my_id)
+            refresh_recipients()
+        frames, complete = history.since({ch: int(marks.get(ch) or 0) for ch in info['channels']})
+        replay(out, frames)
+
+    if hub is not None:
+        hub.send({'type': 'RESUMED', 'id': my_id, 'peer_addr': info['peer_addr'], 'codecs': info['codecs']})
+    else:
+        with lock:
+            confirm_proxy(my_id)
+    log.info('resume', "Client {client} resumed; replayed {n} chat(s)"
+             + ("" if complete else " (older ones no longer held)"), client=my_id, n=len(frames))
+    return True
+
+
+def confirm_proxy(client_id):
+    # Caller holds lock. Reconfirm a resumed client's proxy (or tell it the proxy is gone).
+    info = clients[client_id]
+    if info['proxy'] in clients:
+        assign_proxy(client_id, info['proxy'])
+    elif info['proxy'] is None:
+        send_json(info['out'], {'type': 'NO_PROXY'})
+
+
+def new_session(out, addr):
+    session = {'out': out, 'addr': addr, 'id': None, 'peer_addr': None, 'name': None,
+               'seen': time.monotonic(), 'answers_ping': True}
+    if IDLE_TIMEOUT:
+        wheel.schedule(out, min(HEARTBEAT_INTERVAL, IDLE_TIMEOUT), session)
+    return session
+
+
+# ----------------------------------------
+# Admission control for REGISTER / RESUME
+# ----------------------------------------
+class Admission:
+    """Token bucket with a bounded line of waiters.
+
+    reserve() hands out `burst` slots at once and then `rate` per second. A
+    caller whose slot lies in the future is told how long to wait for it;
+    once `queue` callers are waiting, reserve() turns new ones away.
+    """
+
+    def __init__(self, rate=ADMIT_RATE, burst=ADMIT_BURST, queue=ADMIT_QUEUE):
+        self.rate = rate
+        self.burst = burst
+        self.queue = queue
+        self.tokens = float(burst)     # negative: slots already promised to waiters
+        self.stamp = time.monotonic()
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, now=None):
+        """Seconds until the caller's slot (0.0: now), or None if the line is full."""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            if self.waiting >= self.queue:
+                return None
+            self.tokens -= 1.0
+            self.waiting += 1
+            return -self.tokens / self.rate
+
+    def done(self):
+        """A waiter reached its slot."""
+        with self.lock:
+            self.waiting -= 1
+
+    def retry_after(self):
+        # when the present line will have been served
+        with self.lock:
+            return max(0.0, -self.tokens) / self.rate + 1.0 / self.rate
+
+
+admission = Admission()
+
+
+def admit(session):
+    # Called by the engines for a REGISTER/RESUME on a connection without an
+    # id. Returns the seconds to hold the message before handling it, or None
+    # after answering RETRY_AFTER (the message is then dropped).
+    wait = admission.reserve()
+    if wait is None:
+        hint = admission.retry_after()
+        send_json(session['out'], {'type': 'RETRY_AFTER', 'seconds': round(hint, 3)})
+        metrics.incr('admission.rejected')
+        log.info('retry_after', "Admission queue full; {addr} told to retry in {seconds:.1f}s",
+                 addr=session['addr'], seconds=hint)
+        return None
+    if wait:
+        metrics.incr('admission.queued')
+        metrics.observe('admission.wait_ms', wait * 1000.0)
+    return wait
+
+
+def needs_admission(session, msg):
+    return session['id'] is None and msg.get('type') in ('REGISTER', 'RESUME')
+
+
+# ----------------------------------------
+# Heartbeats and idle reaping
+# ----------------------------------------
+def heartbeat():
+    # Drive the timer wheel. A connection silent for HEARTBEAT_INTERVAL gets a
+    # PING; one silent for IDLE_TIMEOUT is closed, which wakes its reader and
+    # sends it through remove_client like any other disconnect. Traffic only
+    # updates session['seen']; the wheel entry is re-armed when it fires.
+    # Legacy clients never answer PING, so a short silence proves little:
+    # they get LEGACY_IDLE_TIMEOUT instead. The PINGs still go out, so a dead
+    # legacy peer is also caught as a send failure once TCP gives up on it.
+    while running:
+        time.sleep(wheel.tick)
+        now = time.monotonic()
+        for session in wheel.advance(now):
+            out = session['out']
+            if out.closed:
                 continue
+            idle = now - session['seen']
+            limit = IDLE_TIMEOUT if session['answers_ping'] else LEGACY_IDLE_TIMEOUT
+            if limit and idle >= limit:
+                log.info('idle', "Client {client} {addr} silent for {idle:.0f}s; closing",
+                         client=session['id'], addr=session['addr'], idle=idle)
+                out.close()
+            elif idle >= HEARTBEAT_INTERVAL:
+                send_json(out, {'type': 'PING', 'req_id': next(ping_ids)})
+                wait = min(HEARTBEAT_INTERVAL, limit - idle) if limit else HEARTBEAT_INTERVAL
+                wheel.schedule(out, wait, session, now)
+            else:
+                wheel.schedule(out, HEARTBEAT_INTERVAL - idle, session, now)
 
-            if msg.get('type') == 'REGISTER':
-                # ID allocation
-                my_id = allocate_id()
-
-                with lock:
-                    peer_addr = (msg.get('peer_ip', addr[0]), int(msg.get('peer_port')))
-                    name = msg.get('name') or f"Client{my_id}"
-
-                    clients[my_id] = {
-                        'conn': conn,
-                        'addr': addr,
-                        'peer_addr': peer_addr,
-                        'name': name
-                    }
-
-                send_json(conn, {'type': 'ASSIGN_ID', 'id': my_id})
-                print(f"[server] Registered client {my_id} {addr} peer {peer_addr} name {name}")
-
-                # Special rules
-                with lock:
-                    total = len(clients)
-
-                    # Client 2 uses client 1 as proxy
-                    if my_id == 2 and total <= 2:
-                        if 1 in clients:
-                            proxy_info = clients[1]['peer_addr']
-                            send_json(conn, {
-                                'type': 'USE_PROXY',
-                                'proxy_id': 1,
-                                'proxy_peer': proxy_info
-                            })
-                            send_json(clients[1]['conn'], {
-                                'type': 'PROXY_FOR',
-                                'client_id': 2
-                            })
-
-                    # Clients >= 3 get client list
-                    if my_id >= 3:
-                        lst = []
-                        for cid in sorted(clients.keys()):
-                            if cid < my_id:
-                                lst.append({
-                                    'id': cid,
-                                    'peer': clients[cid]['peer_addr'],
-                                    'name': clients[cid]['name']
-                                })
-                        send_json(conn, {'type': 'CLIENT_LIST', 'clients': lst})
-
-            elif msg.get('type') == 'CHAT':
-                text = msg.get('text', '')
-                name = msg.get('name', name)
-                print(f"[server] CHAT from {my_id} ({name}): {text}")
-                broadcast_chat(my_id, text, name)
-
-            elif msg.get('type') == 'CHOICE':
-                chosen = msg.get('chosen_id')
-                print(f"[server] Client {my_id} chose proxy {chosen}")
-                with lock:
-                    if chosen in clients:
-                        send_json(clients[chosen]['conn'], {
-                            'type': 'PROXY_FOR',
-                            'client_id': my_id
-                        })
-                        send_json(conn, {
-                            'type': 'USE_PROXY',
-                            'proxy_id': chosen,
-                            'proxy_peer': clients[chosen]['peer_addr']
-                        })
-
-            elif msg.get('type') == 'FORWARDED_CHAT':
-                orig_id = msg.get('orig_id')
-                text = msg.get('text', '')
-                name = msg.get('name')
-                print(f"[server] FORWARDED_CHAT on behalf {orig_id} ({name}): {text}")
-                broadcast_chat(orig_id, text, name)
-
-            elif msg.get('type') == 'MEASURE_REQUEST':
-                send_json(conn, {'type': 'MEASURE_REPLY', 'ts': time.time()})
-
-            elif msg.get('type') == 'PING':
-                send_json(conn, {'type': 'PONG', 'ts': time.time()})
 
-    except Exception as e:
-        print("[server] client handler error:", e)
-        traceback.print_exc()
+def stats():
+    # Metrics snapshot plus the bytes queued for each connected client.
+    snap = metrics.snapshot()
+    with lock:
+        snap['queues'] = {str(cid): info['out'].depth() for cid, info in clients.items()}
+    return snap
 
-    finally:
-        remove_client(my_id)
-        try:
-            conn.close()
-        except:
-            pass
+
+def queue_depths():
+    with lock:
+        depths = [info['out'].depth() for info in clients.values()]
+    return {'max': max(depths, default=0), 'total': sum(depths)}
+
+
+def handle_message(session, msg, size=0):
+    """Apply one decoded protocol message; shared by the threaded and async engines."""
+    out = session['out']
+    addr = session['addr']
+    session['seen'] = time.monotonic()
+    kind = msg.get('type')
+    if not isinstance(kind, str) or kind not in MESSAGE_TYPES:
+        kind = 'other'
+    metrics.incr('msg.in.' + kind)
+    metrics.incr('bytes.in.' + kind, size)
+
+    if msg.get('type') in ('REGISTER', 'RESUME'):
+        # Clients that answer PING also send `codecs`; a legacy one never does.
+        session['answers_ping'] = 'codecs' in msg
+
+    if msg.get('type') == 'RESUME' and resume_client(session, msg):
+        return
+
+    if msg.get('type') in ('REGISTER', 'RESUME'):   # a RESUME that can't be honoured registers afresh
+        # ID allocation
+        my_id = allocate_id()
+        session['id'] = my_id
+
+        with lock:
+            peer_addr = (msg.get('peer_ip', addr[0]), int(msg.get('peer_port')))
+            name = msg.get('name') or f"Client{my_id}"
+            session['peer_addr'] = peer_addr
+            session['name'] = name
+
+            offered = msg.get('codecs') or []
+            clients[my_id] = {
+                'out': out,
+                'addr': addr,
+                'peer_addr': peer_addr,
+                'name': name,
+                'codecs': [c for c in offered if c in codec.CAPABILITIES],
+                'proxy': None,
+                'relayed_by': None,
+                'relay_rate': 0.0,
+                'rate_ts': time.time(),
+                'token': secrets.token_hex(8),
+                'channels': set()
+            }
+            wanted = msg.get('channels')
+            if not isinstance(wanted, list):
+                wanted = [DEFAULT_CHANNEL]
+            for ch in [c for c in wanted if valid_channel(c)][:MAX_CHANNELS]:
+                join_channel(my_id, ch)
+            joined = {ch: history.last_seq(ch) for ch in clients[my_id]['channels']}
+
+        # ASSIGN_ID goes out in JSON; everything after it uses the negotiated codec.
+        # `seqs` is where this client's history starts in each channel it joined
+        # (`seq` for the default one), `token` authorises a RESUME, and `batch`
+        # is how many chats a FORWARDED_BATCH from it may carry. With `compress`
+        # set, both directions are compressed from the next frame on.
+        chosen_codec = codec.negotiate(offered, WIRE_CODECS)
+        compress = negotiate_compression(offered)
+        send_json(out, {'type': 'ASSIGN_ID', 'id': my_id, 'codec': chosen_codec.name,
+                        'delivery': DELIVERY, 'token': clients[my_id]['token'],
+                        'seq': history.last_seq(), 'seqs': joined, 'batch': FORWARD_BATCH_MAX,
+                        'compress': compress})
+        out.codec = chosen_codec
+        if compress:
+            out.deflate = codec.Deflater()
+        log.info('register', "Registered client {client} {addr} peer {peer} name {name}",
+                 client=my_id, addr=addr, peer=peer_addr, name=name)
+
+        if hub is not None:
+            # the hub sees every worker's clients, so it places this one
+            info = clients[my_id]
+            hub.send({'type': 'PLACE', 'id': my_id, 'peer_addr': peer_addr, 'name': name,
+                      'codecs': info['codecs'], 'token': info['token'], 'channels': sorted(info['channels'])})
+        else:
+            with lock:
+                place_client(my_id)
+
+    elif msg.get('type') == 'CHAT':
+        my_id = session['id']
+        text = msg.get('text', '')
+        name = session['name'] = msg.get('name', session['name'])
+        channel = msg.get('channel', DEFAULT_CHANNEL)
+        if valid_channel(channel):
+            log.info('chat', "CHAT from {client} ({name}): {text}", client=my_id, name=name, text=text,
+                     channel=channel)
+            broadcast_chat(my_id, text, name, channel)
+
+    elif msg.get('type') == 'CHOICE':
+        my_id = session['id']
+        chosen = msg.get('chosen_id')
+        log.info('choice', "Client {client} chose proxy {proxy}", client=my_id, proxy=chosen)
+        if hub is not None:
+            hub.send({'type': 'CHOICE', 'id': my_id, 'chosen': chosen})
+        else:
+            with lock:
+                choose_proxy(my_id, chosen)
+
+    elif msg.get('type') == 'FORWARDED_CHAT':
+        orig_id = msg.get('orig_id')
+        text = msg.get('text', '')
+        name = msg.get('name')
+        channel = msg.get('channel', DEFAULT_CHANNEL)
+        log.info('forwarded_chat', "FORWARDED_CHAT on behalf {client} ({name}): {text}",
+                 client=orig_id, name=name, text=text, proxy=session['id'], channel=channel)
+        with lock:
+            if session['id'] in clients:
+                note_relayed(clients[session['id']], time.time())
+        if valid_channel(channel):
+            broadcast_chat(orig_id, text, name, channel, session['id'])
+
+    elif msg.get('type') == 'FORWARDED_BATCH':
+        # A proxy's forwards for one window: [[orig_id, name, text, channel], ...],
+        # in the order its downstream clients sent them.
+        entries = msg.get('chats')
+        chats = []
+        for entry in entries[:FORWARD_BATCH_MAX] if isinstance(entries, list) else ():
+            if not isinstance(entry, list) or len(entry) != 4:
+                continue
+            orig_id, name, text, channel = entry
+            if valid_channel(channel):
+                chats.append((orig_id, text if isinstance(text, str) else '', name, channel))
+                log.info('forwarded_chat', "FORWARDED_CHAT on behalf {client} ({name}): {text}",
+                         client=orig_id, name=name, text=text, proxy=session['id'], channel=channel)
+        with lock:
+            if session['id'] in clients:
+                note_relayed(clients[session['id']], time.time(), len(chats))
+        if chats:
+            broadcast_batch(chats, session['id'])
+
+    elif msg.get('type') == 'JOIN':
+        # answered under the history lock, so the seq in JOINED comes before
+        # the channel's next chat on this connection
+        my_id = session['id']
+        channel = msg.get('channel')
+        with history.lock:
+            with lock:
+                info = clients.get(my_id)
+                ok = (info is not None and valid_channel(channel)
+                      and (channel in info['channels'] or len(info['channels']) < MAX_CHANNELS))
+                if ok:
+                    join_channel(my_id, channel)
+                    tell_hub_channels(my_id)
+            send_json(out, reply_to(msg, {'type': 'JOINED', 'channel': channel, 'ok': ok,
+                                          'seq': history.last_seq(channel) if ok else 0}))
+
+    elif msg.get('type') == 'LEAVE':
+        my_id = session['id']
+        channel = msg.get('channel')
+        with lock:
+            if my_id in clients and valid_channel(channel):
+                leave_channel(my_id, channel)
+                tell_hub_channels(my_id)
+        send_json(out, reply_to(msg, {'type': 'LEFT', 'channel': channel}))
+
+    elif msg.get('type') == 'RTT_REPORT':
+        my_id = session['id']
+        if hub is not None:
+            hub.send({'type': 'RTT', 'id': my_id, 'rtts': msg.get('rtts')})
+        else:
+            with lock:
+                report_rtts(my_id, msg.get('rtts'), time.time())
+
+    elif msg.get('type') == 'RELAY_READY':
+        # the client is subscribed to its proxy; stop writing chats to it directly
+        my_id = session['id']
+        proxy_id = msg.get('proxy_id')
+        with lock:
+            info = clients.get(my_id)
+            if (DELIVERY == 'relay' and info and proxy_id in clients
+                    and info['proxy'] == proxy_id and not relay_cycle(my_id, proxy_id)):
+                info['relayed_by'] = proxy_id
+                refresh_recipients()
+                ok = True
+            else:
+                ok = False
+        send_json(out, reply_to(msg, {'type': 'RELAY_ACK', 'proxy_id': proxy_id, 'ok': ok}))
+
+    elif msg.get('type') == 'RELAY_LOST':
+        my_id = session['id']
+        with lock:
+            info = clients.get(my_id)
+            if info and info['relayed_by'] == msg.get('proxy_id'):
+                info['relayed_by'] = None
+                refresh_recipients()
+
+    elif msg.get('type') == 'MEASURE_REQUEST':
+        send_json(out, reply_to(msg, {'type': 'MEASURE_REPLY', 'ts': time.time()}))
+
+    elif msg.get('type') == 'PING':
+        send_json(out, reply_to(msg, {'type': 'PONG', 'ts': time.time()}))
+
+    elif msg.get('type') == 'PONG':
+        session['answers_ping'] = True      # arriving at all is what counts
+
+    elif msg.get('type') == 'STATS':
+        send_json(out, reply_to(msg, {'type': 'STATS_REPLY', 'stats': stats()}))
 
 
 # ----------------------------------------
-# Keybind thread (press ENTER to stop server)
+# Multi-process mode (--workers N)
 # ----------------------------------------
-def key_listener():
+# N forked workers accept on the same port (SO_REUSEPORT) and each serves its
+# own connections as above. The parent process is the hub: it hands out ids,
+# keeps the directory of every worker's clients for proxy placement, CHOICE,
+# RTT reports, rebalancing and RESUME, and numbers every chat. Workers publish
+# chats to the hub, which sends each batch back to all workers as numbered
+# frames; every worker records them and fans them out to its own clients.
+# Relay links are only confirmed between clients on the same worker.
+
+def publish(chats, proxy=None):
+    # Worker: queue chats for the hub's next PUBLISH.
+    with outgoing_cond:
+        outgoing.append((chats, proxy))
+        outgoing_cond.notify()
+
+
+def publisher():
+    # Worker: send everything published since the last PUBLISH as one
+    # message. Idle, a chat goes out at once; under load they batch up.
+    while True:
+        with outgoing_cond:
+            while not outgoing:
+                outgoing_cond.wait()
+            chats, relayed, size = [], {}, 0
+            while outgoing and len(chats) < PUBLISH_MAX and size < PUBLISH_BYTES:
+                batch, proxy = outgoing.popleft()
+                chats.extend(batch)
+                size += sum(len(text) for _, text, _, _ in batch if isinstance(text, str))
+                if proxy is not None:
+                    relayed[proxy] = relayed.get(proxy, 0) + len(batch)
+        hub.send({'type': 'PUBLISH', 'chats': chats, 'relayed': list(relayed.items())})
+
+
+def deliver_frames(frames):
+    # Worker: record the hub's numbered frames and write them to our clients.
+    with history.lock:
+        for frame in frames:
+            history.append(frame)
+        fan_out(frames)
+
+
+def claim_held(client_id, token):
+    # Worker: RESUME against the hub, which holds every departed client, so a
+    # client may come back through any worker. None if it can't be resumed.
+    reply = hub.request({'type': 'RESUME', 'id': client_id, 'token': token}).result(bus.BUS_TIMEOUT)
+    if not reply or not reply.get('ok'):
+        return None
+    return {'out': None, 'addr': None, 'peer_addr': tuple(reply['peer_addr']), 'name': reply['name'],
+            'codecs': [], 'proxy': reply['proxy'], 'relayed_by': None, 'relay_rate': 0.0,
+            'rate_ts': time.time(), 'token': token, 'channels': set(reply['channels'])}
+
+
+def tell_hub_channels(client_id):
+    # Caller holds lock. The hub keeps each client's channels for a RESUME elsewhere.
+    if hub is not None:
+        hub.send({'type': 'CHANNELS', 'id': client_id, 'channels': sorted(clients[client_id]['channels'])})
+
+
+def on_hub_message(link, msg):
+    # Worker: numbered chats, and messages the hub addresses to our clients.
     global running
-    sys.stdin.readline()
-    print("[server] Shutdown requested.")
-    running = False
+    try:
+        t = msg.get('type')
+        if t == 'FRAMES':
+            deliver_frames(msg['frames'])
+        elif t == 'DELIVER':
+            inner = msg['msg']
+            with lock:
+                info = clients.get(msg.get('to'))
+                if info is None:
+                    return
+                if inner.get('type') in ('USE_PROXY', 'NO_PROXY'):
+                    # RELAY_READY is checked against the proxy the hub assigned
+                    proxy = inner.get('proxy_id')
+                    if info['proxy'] != proxy and info['relayed_by'] is not None:
+                        info['relayed_by'] = None
+                        refresh_recipients()
+                    info['proxy'] = proxy
+                send_json(info['out'], inner)
+        elif t == 'STOP':
+            running = False
+    except Exception as e:
+        log.error('error', "hub message error: {error}", error=e, trace=traceback.format_exc())
 
 
-def main():
+def hub_lost(link):
     global running
+    if running:
+        log.error('hub', "Lost the hub; shutting down")
+        running = False
+
+
+class HubOut:
+    """A client's outbox as the hub sees it: what is pushed goes to the
+    client's worker in a DELIVER, and the worker writes it in the client's codec."""
+
+    codec = codec.JSON
+    deflate = None
+    closed = False
+
+    def __init__(self, link, client_id):
+        self.link = link
+        self.client_id = client_id
+
+    def push(self, data):
+        return self.link.send({'type': 'DELIVER', 'to': self.client_id, 'msg': json.loads(data)})
+
+    def depth(self):
+        return 0
+
+    def close(self):
+        pass    # the worker owns the connection
+
+
+def on_worker_message(link, msg):
+    # Hub: one worker's requests. Directory entries look like a single-process
+    # server's `clients` with a HubOut for `out`, so placement, CHOICE,
+    # rebalancing and releasing ids run the same code as without workers.
+    try:
+        t = msg.get('type')
+        my_id = msg.get('id')
+        if t == 'PUBLISH':
+            now = time.time()
+            with lock:
+                for proxy, n in msg.get('relayed') or ():
+                    if proxy in clients:
+                        note_relayed(clients[proxy], now, n)
+            with history.lock:
+                frames = [chat_frame(*chat) for chat in msg['chats']]
+                data = bus.encode({'type': 'FRAMES', 'frames': frames})
+                for worker in workers:
+                    worker.push(data)
+        elif t == 'ALLOC':
+            link.reply(msg, {'id': allocate_id()})
+        elif t == 'PLACE':
+            with lock:
+                clients[my_id] = {
+                    'out': HubOut(link, my_id),
+                    'addr': None,
+                    'peer_addr': tuple(msg['peer_addr']),
+                    'name': msg.get('name'),
+                    'codecs': msg.get('codecs') or [],
+                    'proxy': None,
+                    'relayed_by': None,
+                    'relay_rate': 0.0,
+                    'rate_ts': time.time(),
+                    'token': msg.get('token'),
+                    'channels': set(msg.get('channels') or ())
+                }
+                place_client(my_id)
+        elif t == 'RESUME':
+            with lock:
+                held = reserved.get(my_id)
+                if held is None or held['info']['token'] != msg.get('token'):
+                    link.reply(msg, {'ok': False})
+                    return
+                del reserved[my_id]
+                info = clients[my_id] = held['info']
+                info['out'] = HubOut(link, my_id)
+            link.reply(msg, {'ok': True, 'peer_addr': info['peer_addr'], 'name': info['name'],
+                             'proxy': info['proxy'], 'channels': sorted(info['channels'])})
+        elif t == 'RESUMED':
+            with lock:
+                if my_id in clients:
+                    clients[my_id].update(peer_addr=tuple(msg['peer_addr']), codecs=msg.get('codecs') or [])
+                    confirm_proxy(my_id)
+        elif t == 'CHOICE':
+            with lock:
+                choose_proxy(my_id, msg.get('chosen'))
+        elif t == 'RTT':
+            with lock:
+                report_rtts(my_id, msg.get('rtts'), time.time())
+        elif t == 'CHANNELS':
+            with lock:
+                if my_id in clients:
+                    clients[my_id]['channels'] = set(msg.get('channels') or ())
+        elif t == 'GONE':
+            with lock:
+                if my_id in clients:
+                    retire_client(my_id, clients.pop(my_id))
+    except Exception as e:
+        log.error('error', "worker message error: {error}", error=e, trace=traceback.format_exc())
+
+
+def worker_lost(link):
+    # Hub: a worker exited; its clients are held as if they had disconnected.
+    if running:
+        log.error('worker', "A worker exited; holding its clients for RESUME")
+    with history.lock:
+        if link in workers:
+            workers.remove(link)
+    with lock:
+        for cid in [c for c, info in clients.items() if info['out'].link is link]:
+            retire_client(cid, clients.pop(cid))
+
 
-    # Start key listener
-    threading.Thread(target=key_listener, daemon=True).start()
+def spawn_workers(n):
+    """Fork n workers, each with a bus socket to this process.
 
+    Returns (index, socket) in a worker and (None, [(pid, socket), ...]) in
+    the hub. Call it before any thread is started.
+    """
+    pairs = [socket.socketpair() for _ in range(n)]
+    pids = []
+    for i in range(n):
+        pid = os.fork()
+        if pid == 0:
+            for j, (hub_end, worker_end) in enumerate(pairs):
+                hub_end.close()
+                if j != i:
+                    worker_end.close()
+            return i, pairs[i][1]
+        pids.append(pid)
+    for _, worker_end in pairs:
+        worker_end.close()
+    return None, [(pid, hub_end) for pid, (hub_end, _) in zip(pids, pairs)]
+
+
+def serve_hub(children):
+    with history.lock:
+        for _, sock in children:
+            workers.append(bus.BusLink(sock, on_worker_message, worker_lost))
+    log.info('listen', "Hub for {n} workers on {host}:{port}  (press ENTER to stop)",
+             n=len(children), host=HOST, port=PORT)
+    try:
+        while running:
+            time.sleep(0.5)
+    finally:
+        for worker in list(workers):
+            worker.send({'type': 'STOP'})
+        deadline = time.time() + 5.0
+        for pid, _ in children:
+            while not os.waitpid(pid, os.WNOHANG)[0]:
+                if time.time() > deadline:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.05)
+
+
+# ----------------------------------------
+# Threaded engine: one thread per connection
+# ----------------------------------------
+def handle_client(conn, addr):
+    out = Outbox(conn, OUTBOX_LIMIT, SLOW_POLICY)
+    session = new_session(out, addr)
+
+    try:
+        reader = FrameReader(conn)
+        for msg in reader.messages():
+            if needs_admission(session, msg):
+                wait = admit(session)
+                if wait is None:
+                    continue
+                if wait:
+                    time.sleep(wait)
+                    admission.done()
+            handle_message(session, msg, reader.size)
+
+    except Exception as e:
+        log.error('error', "client handler error: {error}", error=e, client=session['id'],
+                  trace=traceback.format_exc())
+
+    finally:
+        wheel.cancel(out)
+        remove_client(session['id'])
+        out.close()
+        try:
+            conn.close()
+        except:
+            pass
+
+
+def serve_threaded():
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hub is not None:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)     # shared with the other workers
     s.bind((HOST, PORT))
     s.listen(100)
-    print(f"[server] Listening on {HOST}:{PORT}  (press ENTER to stop)")
+    log.info('listen', "Listening on {host}:{port}  (threaded engine, press ENTER to stop)", host=HOST, port=PORT)
 
     s.settimeout(0.5)
 
@@ -214,17 +1186,301 @@ def main():
                 threading.Thread(target=handle_client, args=(c, a), daemon=True).start()
             except socket.timeout:
                 pass
+    finally:
+        s.close()
+
+
+# ----------------------------------------
+# Async engine: every connection on one event loop
+# ----------------------------------------
+class StreamOutbox:
+    """Outbox for an asyncio stream.
+
+    Frames pushed during one loop iteration are handed to the transport in a
+    single writelines() call; the transport's own buffer is the queue that
+    OUTBOX_LIMIT and SLOW_POLICY apply to.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.transport = writer.transport
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.codec = codec.JSON
+        self.deflate = None
+        self.frames = []
+        self.queued = 0
+        self.closed = False
+
+    def push(self, data, plain=False):
+        if self.closed:
+            return False
+        if threading.get_ident() != self.loop_thread:
+            # e.g. the rebalancer: hand the frame to the loop thread, which
+            # also keeps the compressed stream in write order. Whether it is
+            # compressed is settled now, so an ASSIGN_ID sent just before
+            # deflate starts still goes out plain.
+            self.loop.call_soon_threadsafe(self.push, data, self.deflate is None)
+            return True
+        # limit first, as in Outbox.push: a dropped frame must not have
+        # gone through the deflate stream
+        if self.transport.get_write_buffer_size() + self.queued + len(data) > OUTBOX_LIMIT:
+            if SLOW_POLICY == 'disconnect':
+                self.close()
+            return False
+        if self.deflate is not None and not plain:
+            data = self.deflate.compress(data)
+        if not self.frames:
+            self.loop.call_soon(self._flush)
+        self.frames.append(data)
+        self.queued += len(data)
+        return True
+
+    def depth(self):
+        """Bytes waiting to go out on this connection."""
+        return self.transport.get_write_buffer_size() + self.queued
+
+    def _flush(self):
+        frames, self.frames, self.queued = self.frames, [], 0
+        if not self.closed and frames:
+            self.writer.writelines(frames)
+
+    def close(self):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.close)
+            return
+        if not self.closed:
+            self.closed = True
+            self.frames = []
+            self.transport.abort()
+
+
+async def handle_client_async(reader, writer):
+    addr = writer.get_extra_info('peername')
+    out = StreamOutbox(writer)
+    session = new_session(out, addr)
+
+    frames = FrameReader()
+
+    try:
+        while running:
+            try:
+                data = await reader.read(RECV_SIZE)
+            except ConnectionError:
+                break
+            if not data:
+                break
+            frames.feed(data)
+            while (msg := frames.next_msg()) is not None:
+                registering = needs_admission(session, msg)
+                if registering:
+                    wait = admit(session)
+                    if wait is None:
+                        continue
+                    if wait:
+                        try:
+                            await asyncio.sleep(wait)
+                        finally:
+                            admission.done()
+                if registering and hub is not None:
+                    # a worker waits on the hub for the id or the held session
+                    # (allocate_id, claim_held); keep that off the event loop
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, handle_message, session, msg, frames.size)
+                else:
+                    handle_message(session, msg, frames.size)
+            await writer.drain()
+
+    except FrameTooLarge:
+        log.warning('oversized', "{addr} sent an oversized frame; closing", addr=addr)
+
+    except ConnectionError as e:
+        log.warning('bad_frame', "{addr}: {error}; closing", addr=addr, error=e)
+
+    except asyncio.CancelledError:
+        pass    # shutdown: serve_async cancels every handler, which just cleans up
+
+    except Exception as e:
+        log.error('error', "client handler error: {error}", error=e, client=session['id'],
+                  trace=traceback.format_exc())
+
+    finally:
+        wheel.cancel(out)
+        remove_client(session['id'])
+        out.close()
+
+
+async def serve_async():
+    handlers = set()
+
+    async def handle(reader, writer):
+        task = asyncio.current_task()
+        handlers.add(task)
+        try:
+            await handle_client_async(reader, writer)
+        finally:
+            handlers.discard(task)
+
+    server = await asyncio.start_server(handle, HOST, PORT,
+                                        backlog=100, reuse_address=True, reuse_port=hub is not None)
+    log.info('listen', "Listening on {host}:{port}  (async engine, press ENTER to stop)", host=HOST, port=PORT)
+    try:
+        while running:
+            await asyncio.sleep(0.5)
+    finally:
+        server.close()
+        # finish every connection here, rather than leaving asyncio.run to cancel them
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+
+# ----------------------------------------
+# Keybind thread (press ENTER to stop server)
+# ----------------------------------------
+def key_listener():
+    global running
+    sys.stdin.readline()
+    log.info('shutdown', "Shutdown requested.")
+    running = False
+
+
+def main():
+    global HOST, PORT, OUTBOX_LIMIT, SLOW_POLICY, WIRE_CODECS, COMPRESS, DELIVERY
+    global PROXY_CAPACITY, PROXY_MAX_RATE, CANDIDATES, RESUME_GRACE, history
+    global HEARTBEAT_INTERVAL, IDLE_TIMEOUT, LEGACY_IDLE_TIMEOUT, STATS_PORT, admission, WORKERS, hub
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--engine', choices=('threaded', 'async'), default='threaded',
+                        help="thread per connection, or a single asyncio event loop")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="fork this many worker processes that share the port (Linux; 0 = serve in one process)")
+    parser.add_argument('--outbox-limit', type=int, default=OUTBOX_LIMIT,
+                        help="bytes queued for one client before --slow-policy applies")
+    parser.add_argument('--slow-policy', choices=('drop', 'disconnect'), default=SLOW_POLICY,
+                        help="what to do with a client that falls too far behind")
+    parser.add_argument('--binary', action=argparse.BooleanOptionalAction, default=True,
+                        help="offer the compact binary codec to clients that support it")
+    parser.add_argument('--compress', action=argparse.BooleanOptionalAction, default=COMPRESS,
+                        help="deflate connections whose client offers it")
+    parser.add_argument('--delivery', choices=('direct', 'relay'), default=DELIVERY,
+                        help="send every chat to every client, or only to the roots of the proxy tree")
+    parser.add_argument('--proxy-capacity', type=int, default=PROXY_CAPACITY,
+                        help="most clients one proxy may carry (0 = unlimited)")
+    parser.add_argument('--proxy-max-rate', type=float, default=PROXY_MAX_RATE,
+                        help="relayed chats/s above which clients are moved off a proxy (0 = off)")
+    parser.add_argument('--candidates', type=int, default=CANDIDATES,
+                        help="proxies offered to a joining client, ranked by predicted RTT (0 = all)")
+    parser.add_argument('--history-size', type=int, default=chat_history.HISTORY_SIZE,
+                        help="chats kept for clients that RESUME")
+    parser.add_argument('--history-file', default=None,
+                        help="also append chats to this memory-mapped segment file (survives restarts)")
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help="seconds a disconnected client's id is held for RESUME (0 = free at once)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds of silence before the server PINGs a client")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence before a client is disconnected (0 = never)")
+    parser.add_argument('--legacy-idle-timeout', type=float, default=LEGACY_IDLE_TIMEOUT,
+                        help="the same for legacy clients, which never answer PING (0 = never)")
+    parser.add_argument('--admit-rate', type=float, default=ADMIT_RATE,
+                        help="registrations admitted per second after --admit-burst (0 = no limit)")
+    parser.add_argument('--admit-burst', type=int, default=ADMIT_BURST)
+    parser.add_argument('--admit-queue', type=int, default=ADMIT_QUEUE,
+                        help="registrations that may wait for a slot before others get RETRY_AFTER")
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help="serve metrics as text on 127.0.0.1:PORT (0 = off); STATS works regardless")
+    parser.add_argument('--log-level', choices=tuple(log.LEVELS), default='info')
+    parser.add_argument('--log-format', choices=('text', 'json', 'bin'), default='text')
+    parser.add_argument('--log-file', default=None,
+                        help="write the log to this file (rotated) instead of stdout")
+    parser.add_argument('--log-max-bytes', type=int, default=log.MAX_BYTES)
+    parser.add_argument('--log-backups', type=int, default=log.BACKUPS)
+    parser.add_argument('--log-sample', action='append', default=[], metavar='EVENT=RATE',
+                        help="keep at most RATE records/s of EVENT, e.g. chat=20 (repeatable)")
+    args = parser.parse_args()
+    HOST, PORT = args.host, args.port
+    DELIVERY = args.delivery
+    WIRE_CODECS = ('bin1',) if args.binary else ()
+    COMPRESS = args.compress
+    OUTBOX_LIMIT, SLOW_POLICY = args.outbox_limit, args.slow_policy
+    PROXY_CAPACITY, PROXY_MAX_RATE = args.proxy_capacity, args.proxy_max_rate
+    CANDIDATES = args.candidates
+    RESUME_GRACE = args.resume_grace
+    HEARTBEAT_INTERVAL, IDLE_TIMEOUT = args.heartbeat, args.idle_timeout
+    LEGACY_IDLE_TIMEOUT = args.legacy_idle_timeout
+    STATS_PORT = args.stats_port
+    WORKERS = args.workers if args.workers > 1 else 0
+    if WORKERS and args.history_file:
+        parser.error("--history-file can't be used with --workers")
+    admission = Admission(args.admit_rate, args.admit_burst, args.admit_queue)
+
+    sample = dict(LOG_SAMPLE)
+    for spec in args.log_sample:
+        event, _, rate = spec.partition('=')
+        sample[event] = float(rate)
+
+    if WORKERS:
+        index, link = spawn_workers(WORKERS)
+        if index is None:
+            # the hub only numbers chats, so it keeps no history to speak of
+            history = chat_history.ChatHistory(1)
+            log.configure(args.log_level, args.log_format, args.log_file, args.log_max_bytes,
+                          args.log_backups, sample, prefix='[hub]')
+            threading.Thread(target=key_listener, daemon=True).start()
+            threading.Thread(target=rebalance, daemon=True).start()
+            try:
+                serve_hub(link)
+            finally:
+                log.info('shutdown', "Shutdown complete.")
+                log.close()
+            return
+        hub = bus.BusLink(link, on_hub_message, hub_lost)
+        threading.Thread(target=publisher, daemon=True).start()
+        if STATS_PORT:
+            STATS_PORT += index
+        if args.log_file:
+            args.log_file += f".{index}"
+    history = chat_history.ChatHistory(args.history_size, args.history_file)
+    log.configure(args.log_level, args.log_format, args.log_file, args.log_max_bytes,
+                  args.log_backups, sample, prefix=f"[server {index}]" if hub is not None else '[server]')
+
+    metrics.gauge('clients', lambda: len(clients))
+    metrics.gauge('reserved', lambda: len(reserved))
+    metrics.gauge('history.frames', lambda: history.count)
+    metrics.gauge('channels', lambda: len(channels))
+    metrics.gauge('admission.waiting', lambda: admission.waiting)
+    metrics.gauge('idle_timers', lambda: len(wheel))
+    metrics.gauge('queue_bytes', queue_depths)
+    if STATS_PORT:
+        metrics.serve(STATS_PORT, source=stats)
+        log.info('listen', "Metrics on 127.0.0.1:{port}", port=STATS_PORT)
+
+    # Start key listener (a worker is stopped by its hub, which also rebalances)
+    if hub is None:
+        threading.Thread(target=key_listener, daemon=True).start()
+        threading.Thread(target=rebalance, daemon=True).start()
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    try:
+        if args.engine == 'async':
+            asyncio.run(serve_async())
+        else:
+            serve_threaded()
 
     finally:
-        print("[server] Closing sockets...")
+        log.info('shutdown', "Closing sockets...")
         with lock:
             for cid, info in list(clients.items()):
                 try:
-                    info['conn'].close()
+                    info['out'].close()
                 except:
                     pass
-        s.close()
-        print("[server] Shutdown complete.")
+        history.close()
+        log.info('shutdown', "Shutdown complete.")
+        log.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+# tests/test_admission.py
+# Reconnect storms: the server's Admission bucket and the client's backoff.
+# Time is passed in explicitly, so nothing here sleeps.
+
+import os, sys, heapq, random
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from server import Admission
+from client_core import Client, BACKOFF_BASE, BACKOFF_MAX
+
+
+def test_burst_is_admitted_at_once():
+    adm = Admission(rate=10.0, burst=5, queue=100)
+    t = adm.stamp
+    assert [adm.reserve(t) for _ in range(5)] == [0.0] * 5
+    # the sixth waits for the next token
+    assert adm.reserve(t) == pytest.approx(0.1)
+
+
+def test_steady_rate_is_enforced():
+    adm = Admission(rate=10.0, burst=5, queue=100)
+    t = adm.stamp
+    for _ in range(5):
+        adm.reserve(t)
+    waits = [adm.reserve(t) for _ in range(5)]
+    assert waits == pytest.approx([0.1, 0.2, 0.3, 0.4, 0.5])
+    # arrivals spaced at the rate are let straight in once the line has drained
+    t += 0.5
+    for _ in range(5):
+        adm.done()
+    assert [adm.reserve(t + i * 0.1) for i in range(1, 6)] == pytest.approx([0.0] * 5, abs=1e-9)
+
+
+def test_full_queue_is_turned_away():
+    adm = Admission(rate=10.0, burst=2, queue=3)
+    t = adm.stamp
+    assert [adm.reserve(t) for _ in range(5)] == pytest.approx([0.0, 0.0, 0.1, 0.2, 0.3])
+    assert adm.reserve(t) is None
+    # the hint covers the present line plus one slot
+    assert adm.retry_after() == pytest.approx(0.4)
+    adm.done()
+    assert adm.reserve(t) == pytest.approx(0.4)
+
+
+def test_no_rate_admits_everyone():
+    adm = Admission(rate=0, burst=1, queue=0)
+    assert all(adm.reserve() == 0.0 for _ in range(100))
+
+
+def test_storm_is_admitted_at_the_configured_rate():
+    # 500 clients reconnect at once. Turned-away ones come back after the
+    # server's hint plus their own jittered backoff, as Client.server_loop does.
+    rate, burst, clients = 50.0, 20, 500
+    adm = Admission(rate=rate, burst=burst, queue=40)
+    t0 = adm.stamp
+    random.seed(1)
+    states = [SimpleNamespace(attempt=0, retry_after=None) for _ in range(clients)]
+    events = [(t0, 'arrive', i) for i in range(clients)]
+    heapq.heapify(events)
+    admitted, rejected = [], 0
+    while events:
+        now, kind, i = heapq.heappop(events)
+        if kind == 'done':
+            adm.done()
+            continue
+        wait = adm.reserve(now)
+        if wait is None:
+            rejected += 1
+            states[i].retry_after = adm.retry_after()
+            heapq.heappush(events, (now + Client.reconnect_delay(states[i]), 'arrive', i))
+        else:
+            admitted.append(now + wait)
+            if wait:
+                heapq.heappush(events, (now + wait, 'done', i))
+
+    assert len(admitted) == clients
+    assert rejected > 0
+    # token bucket: the k-th admission comes no sooner than (k + 1 - burst) / rate
+    for k, at in enumerate(sorted(admitted)):
+        assert at - t0 >= (k + 1 - burst) / rate - 1e-9
+
+
+def test_backoff_is_jittered():
+    random.seed(2)
+    first = [Client.reconnect_delay(SimpleNamespace(attempt=0, retry_after=None)) for _ in range(200)]
+    assert all(0.0 <= d <= BACKOFF_BASE for d in first)
+    assert len(set(first)) == len(first)
+    assert min(first) < BACKOFF_BASE / 4 and max(first) > BACKOFF_BASE * 3 / 4
+
+
+def test_backoff_is_capped():
+    random.seed(3)
+    state = SimpleNamespace(attempt=0, retry_after=None)
+    for attempt in range(1, 40):
+        d = Client.reconnect_delay(state)
+        assert 0.0 <= d <= min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    late = [Client.reconnect_delay(state) for _ in range(200)]
+    assert max(late) <= BACKOFF_MAX and max(late) > BACKOFF_MAX / 2
+
+
+def test_backoff_adds_retry_after_hint_once():
+    random.seed(4)
+    state = SimpleNamespace(attempt=0, retry_after=2.0)
+    assert 2.0 <= Client.reconnect_delay(state) <= 2.0 + BACKOFF_BASE
+    assert state.retry_after is None
+    assert Client.reconnect_delay(state) <= 2 * BACKOFF_BASE
@@ -0,0 +1,38 @@
+# tests/test_framing.py
+# LineFramer's max_frame holds however a line arrives: in pieces, or whole
+# in a single read together with its newline.
+
+import os, sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from framing import LineFramer, FrameTooLarge
+
+MAX = 100
+
+
+def test_line_at_the_limit_is_returned():
+    framer = LineFramer(max_frame=MAX)
+    framer.feed(b'x' * MAX + b'\nnext\n')
+    assert framer.next_line() == b'x' * MAX
+    assert framer.next_line() == b'next'
+    assert framer.next_line() is None
+
+
+def test_oversized_line_in_one_read_is_refused():
+    framer = LineFramer(max_frame=MAX)
+    framer.feed(b'x' * (MAX + 1) + b'\n')
+    with pytest.raises(FrameTooLarge):
+        framer.next_line()
+
+
+def test_oversized_line_in_pieces_is_refused():
+    framer = LineFramer(max_frame=MAX)
+    framer.feed(b'x' * MAX)
+    assert framer.next_line() is None
+    framer.feed(b'x')
+    with pytest.raises(FrameTooLarge):
+        framer.next_line()
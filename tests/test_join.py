@@ -0,0 +1,174 @@
+# tests/test_join.py
+# Join cost stays flat as the network grows: every CLIENT_LIST is cut to the
+# server's CANDIDATES shortlist, so a joining client probes at most that many
+# peers however many are connected. The first test drives the server's own
+# handle_message; the second runs the real server and selection code through
+# benchmarks/sim_select.py, one forked process per size.
+
+import os, sys, json, math, random, multiprocessing
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codec, rttstore, server
+from benchmarks import sim_select
+from client_core import PROBE_SAMPLES
+
+
+class RecordingOut:
+    """Outbox stand-in that keeps every frame the server sends."""
+
+    codec = codec.JSON
+    closed = False
+
+    def __init__(self):
+        self.msgs = []
+
+    def push(self, data):
+        self.msgs.extend(json.loads(line) for line in data.splitlines() if line.strip())
+        return True
+
+    def depth(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fresh_server(monkeypatch):
+    monkeypatch.setattr(server, 'clients', {})
+    monkeypatch.setattr(server, 'fan_in', {})
+    monkeypatch.setattr(server, 'available_ids', [])
+    monkeypatch.setattr(server, 'next_id', 1)
+    monkeypatch.setattr(server, 'rtts', rttstore.RttStore())
+    monkeypatch.setattr(server, 'channels', {})
+    monkeypatch.setattr(server, 'channel_recipients', {})
+    monkeypatch.setattr(server, 'reserved', {})
+    monkeypatch.setattr(server, 'print', lambda *a, **k: None, raising=False)
+    random.seed(1)
+
+
+def join_all(size):
+    # Clients sit on a plane in four regions; each reports its RTT to the
+    # server and to the proxies it was offered, as a real client would.
+    pos, shortlists = {}, []
+    for i in range(size):
+        out = RecordingOut()
+        session = server.new_session(out, (f"10.{i % 4}.0.{i % 250 + 1}", 40000 + i))
+        server.handle_message(session, {'type': 'REGISTER', 'peer_ip': f"10.{i % 4}.0.{i % 250 + 1}",
+                                        'peer_port': 20000 + i, 'name': f"c{i}"})
+        me = session['id']
+        pos[me] = (100.0 * (i % 4) + random.uniform(0, 10), random.uniform(0, 10))
+        offered = [m for m in out.msgs if m.get('type') == 'CLIENT_LIST']
+        report = [[0, 20.0 + math.dist(pos[me], (150.0, 5.0)) / 4]]
+        for lst in offered:
+            shortlists.append(len(lst['clients']))
+            report += [[e['id'], 1.0 + math.dist(pos[me], pos[e['id']])] for e in lst['clients']]
+            server.handle_message(session, {'type': 'CHOICE', 'chosen_id': lst['clients'][0]['id']})
+        server.handle_message(session, {'type': 'RTT_REPORT', 'rtts': report})
+    return shortlists
+
+
+@pytest.mark.parametrize('size', [10, 100, 1000])
+def test_client_list_bounded_by_candidates(fresh_server, size):
+    shortlists = join_all(size)
+    # clients 1 and 2 get no CLIENT_LIST; everyone after gets one
+    assert len(shortlists) == size - 2
+    assert max(shortlists) == min(server.CANDIDATES, size - 2)
+    assert all(n <= server.CANDIDATES for n in shortlists)
+
+
+def test_bad_rtt_reports_are_skipped(fresh_server):
+    sessions = []
+    for i in range(2):
+        session = server.new_session(RecordingOut(), ('10.0.0.1', 40000 + i))
+        server.handle_message(session, {'type': 'REGISTER', 'peer_ip': '10.0.0.1',
+                                        'peer_port': 20000 + i, 'name': f"c{i}"})
+        sessions.append(session)
+    me, peer = sessions[1]['id'], sessions[0]['id']
+    # NaN and Infinity are what json.loads makes of those literals on the wire
+    report = json.loads(f"""[[{peer}, "fast"], [{peer}, NaN], [{peer}, Infinity], [{peer}, -5],
+                             [{peer}, true], ["{peer}", 10], [[{peer}], 10], [null, 10],
+                             [{peer}], [{peer}, 10, 1], "junk", 7, [{peer}, 12.5]]""")
+    server.handle_message(sessions[1], {'type': 'RTT_REPORT', 'rtts': report})
+    server.handle_message(sessions[1], {'type': 'RTT_REPORT', 'rtts': 'junk'})
+    server.handle_message(sessions[1], {'type': 'RTT_REPORT', 'rtts': 3})
+    assert list(server.rtts.edges) == [(peer, me)]     # only the last entry was recorded
+    assert server.rtts.predict(me, peer) == 12.5
+
+
+def test_departed_proxy_riders_move_at_once(fresh_server):
+    sessions = {}
+    for i in range(3):
+        session = server.new_session(RecordingOut(), ('10.0.0.1', 40000 + i))
+        server.handle_message(session, {'type': 'REGISTER', 'peer_ip': '10.0.0.1',
+                                        'peer_port': 20000 + i, 'name': f"c{i}"})
+        sessions[session['id']] = session
+    for cid in (2, 3):
+        server.handle_message(sessions[cid], {'type': 'CHOICE', 'chosen_id': 1})
+    token = server.clients[1]['token']
+
+    server.remove_client(1)
+    # 1's id waits out the resume grace, but its riders don't wait with it
+    assert 1 in server.reserved
+    assert server.clients[2]['proxy'] is None
+    assert {'type': 'NO_PROXY'} in sessions[2]['out'].msgs
+    assert server.clients[3]['proxy'] == 2
+    assert sessions[3]['out'].msgs[-1]['type'] == 'USE_PROXY'
+    assert sessions[3]['out'].msgs[-1]['proxy_id'] == 2
+    assert 1 not in server.fan_in and server.fan_in[2] == 1
+
+    back = server.new_session(RecordingOut(), ('10.0.0.1', 40100))
+    server.handle_message(back, {'type': 'RESUME', 'id': 1, 'token': token})
+    assert back['id'] == 1
+    assert all(info['proxy'] != 1 for info in server.clients.values())
+
+
+def join_run(size, results):
+    args = sim_select.parse_args(['--clients', str(size)])
+    args.size, args.candidates = size, server.CANDIDATES
+    sim = sim_select.prepare(args)
+    joins = []     # (CLIENT_LIST length, distinct peers probed, probes sent) per selection
+
+    cls = sim_select.SimClient
+    select, ping, measure = cls.perform_latency_selection, cls.ping_peer, cls.measure_via_peer
+
+    def perform_latency_selection(self, client_list):
+        self.probed = set()
+        select(self, client_list)
+        joins.append((len(client_list), len(self.probed), self.last_selection['probes']))
+
+    def ping_peer(self, ip, port, *a, **kw):
+        self.probed.add((ip, port))
+        return ping(self, ip, port, *a, **kw)
+
+    def measure_via_peer(self, peer, *a, **kw):
+        self.probed.add(tuple(peer))
+        return measure(self, peer, *a, **kw)
+
+    cls.perform_latency_selection = perform_latency_selection
+    cls.ping_peer, cls.measure_via_peer = ping_peer, measure_via_peer
+    sim.run()
+    results.put(joins)
+
+
+@pytest.mark.parametrize('size', [10, 100, 1000])
+def test_join_probes_bounded_by_candidates(size):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    p = ctx.Process(target=join_run, args=(size, results))
+    p.start()
+    joins = results.get(timeout=120)
+    p.join()
+
+    candidates = server.CANDIDATES
+    assert len(joins) >= size - 2      # the first client has nobody to probe
+    assert max(n for n, _, _ in joins) == min(candidates, size - 1)
+    for shortlist, probed, probes in joins:
+        assert shortlist <= candidates
+        assert probed <= shortlist
+        # PROBE_SAMPLES pings and one MEASURE_SERVER per shortlisted peer at most
+        assert probes <= candidates * (PROBE_SAMPLES + 1)
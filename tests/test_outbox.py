@@ -0,0 +1,58 @@
+# tests/test_outbox.py
+# Slow-policy drops on a compressed connection: a frame the outbox refuses
+# must not have gone through the deflate stream, or the peer can't inflate
+# anything sent after it.
+
+import os, sys, socket, random, base64, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codec, server
+from outbox import Outbox
+
+LIMIT = 2500
+# random base64 hardly compresses, so the middle frame is over LIMIT either
+# way; the last one repeats part of it, so its deflate output refers back to it
+TEXT = base64.b64encode(random.Random(1).randbytes(3000)).decode()
+CHATS = [{'type': 'CHAT', 'from_id': 1, 'from_name': 'a', 'text': 'hello ' * 20},
+         {'type': 'CHAT', 'from_id': 1, 'from_name': 'a', 'text': TEXT},
+         {'type': 'CHAT', 'from_id': 1, 'from_name': 'a', 'text': TEXT[:1500]}]
+FRAMES = [codec.JSON.encode(c) for c in CHATS]
+
+
+def read_msgs(sock, n):
+    sock.settimeout(5)
+    reader = codec.FrameReader(sock)
+    return [reader.read_msg() for _ in range(n)]
+
+
+def test_outbox_drop_keeps_deflate_in_step():
+    a, b = socket.socketpair()
+    out = Outbox(a, limit=LIMIT, policy='drop')
+    out.deflate = codec.Deflater()
+    assert [out.push(f) for f in FRAMES] == [True, False, True]
+    assert read_msgs(b, 2) == [CHATS[0], CHATS[2]]
+    out.close()
+    b.close()
+
+
+def test_stream_outbox_drop_keeps_deflate_in_step(monkeypatch):
+    monkeypatch.setattr(server, 'OUTBOX_LIMIT', LIMIT)
+    monkeypatch.setattr(server, 'SLOW_POLICY', 'drop')
+    a, b = socket.socketpair()
+
+    async def push_all():
+        _, writer = await asyncio.open_connection(sock=a)
+        out = server.StreamOutbox(writer)
+        out.deflate = codec.Deflater()
+        pushed = [out.push(f) for f in FRAMES]
+        await asyncio.sleep(0)      # let the outbox flush
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+        return pushed
+
+    assert asyncio.run(push_all()) == [True, False, True]
+    assert read_msgs(b, 2) == [CHATS[0], CHATS[2]]
+    b.close()
@@ -0,0 +1,62 @@
+# timerwheel.py
+# Hashed timer wheel: O(1) schedule/cancel and O(1) amortised work per timer
+# per tick, however many connections are being watched.
+
+import threading, time
+
+WHEEL_TICK = 0.5        # seconds per slot
+WHEEL_SLOTS = 512       # slots per revolution; longer delays wait extra rounds
+
+
+class TimerWheel:
+    """Maps keys to deadlines rounded up to the next tick.
+
+    Each key has at most one live deadline. Rescheduling just records the new
+    tick and drops the key into that slot; the stale copy left in the old slot
+    is skipped when that slot comes round, so nothing is ever searched for.
+    """
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.due = {}           # key -> (tick number, value)
+        self.current = int((time.monotonic() if now is None else now) / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, key, delay, value=None, now=None):
+        """(Re)arm key to fire `delay` seconds from now; value is returned when it does."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            t = max(self.current + 1, -int(-(now + delay) // self.tick))
+            self.due[key] = (t, value)
+            self.slots[t % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        with self.lock:
+            self.due.pop(key, None)
+
+    def advance(self, now=None):
+        """Run the wheel up to now; returns the values of the keys that fired."""
+        now = time.monotonic() if now is None else now
+        target = int(now / self.tick)
+        fired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                keep = set()
+                for key in slot:
+                    entry = self.due.get(key)
+                    if entry is None or entry[0] % len(self.slots) != self.current % len(self.slots):
+                        continue            # cancelled, or rescheduled into another slot
+                    if entry[0] <= self.current:
+                        del self.due[key]
+                        fired.append(entry[1])
+                    else:
+                        keep.add(key)       # same slot, a later revolution
+                slot.clear()
+                slot |= keep
+        return fired
+
+    def __len__(self):
+        return len(self.due)